@@ -0,0 +1,313 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Standard Serial I/O channel to a single target."""
+__author__ = "Serge 'q3k' Bazanski <serge@bazanski.pl>"
+
+from migen import *
+from migen.genlib.fifo import SyncFIFOBuffered
+
+
+class Channel(Module):
+    """
+    Drives one target: clocks, reset, command/response FIFOs, the busy timer
+    and a transaction engine that clocks the command FIFO out to the target
+    and the target's response into the response FIFO.
+
+    Everything apart from the engine is controlled by the main state
+    machine, which talks to one channel at a time while the engines of all
+    channels keep running.
+    """
+    def __init__(self, target):
+        # Command (to target) and response (from target) FIFOs. The command
+        # FIFO write port is driven by the main state machine.
+        self.submodules.txbuffer = SyncFIFOBuffered(8, 512)
+        self.submodules.rxbuffer = SyncFIFOBuffered(8, 512)
+        # Drop both FIFOs' contents.
+        self.flush = Signal()
+        # Read enable of the response FIFO.
+        self.rx_re = Signal()
+
+        # Strobe to start a transaction.
+        self.start = Signal()
+        # Bytes to send as 0xFF padding after the command FIFO runs empty,
+        # and received bytes to drop instead of writing to the response FIFO.
+        # Latched on start.
+        self.pad_length = Signal(16)
+        self.skip_length = Signal(16)
+        # Length of the result of the last transaction (in the low 13 bits)
+        # and how to send it (top bits), for the main state machine to keep
+        # track of.
+        self.result_length = Signal(16)
+        # Whether every byte written to the response FIFO since the last
+        # transaction started was 0xFF.
+        self.blank = Signal()
+        # Strobe to start resetting the target.
+        self.reset = Signal()
+        # Whether the engine is done with the last transaction and reset.
+        self.idle = Signal()
+
+        # Target CLK divider.
+        self.tclk_divider = Signal(max=120, reset=4)
+        # Target serial CLK divider.
+        self.sclk_divider = Signal(max=1024, reset=1023)
+
+        # Target busy timer.
+        self.timer = Signal(32)
+        self.timer_running = Signal(reset=0)
+        # Whether the busy timer was started since the last bit was clocked
+        # to the target.
+        self.timer_fresh = Signal()
+
+        # Register signals from target because metastability.
+        target_txd = Signal()
+        target_busy = Signal()
+        self.sync += [
+            target_txd.eq(target.txd),
+            target_busy.eq(target.busy),
+        ]
+
+        tclk_counter = Signal(max=121)
+        self.sync += [
+            If(tclk_counter == self.tclk_divider,
+                tclk_counter.eq(0),
+                target.tclk.eq(~target.tclk),
+            ).Else(
+                tclk_counter.eq(tclk_counter + 1),
+            )
+        ]
+
+        last_busy = Signal()
+        self.sync += last_busy.eq(target_busy)
+        self.sync += \
+            If(~self.timer_running,
+                If((~last_busy) & target_busy,
+                    self.timer_running.eq(1),
+                    self.timer.eq(0),
+                )
+            ).Elif(~target_busy,
+                self.timer_running.eq(0),
+            ).Else(
+                self.timer.eq(self.timer + 1),
+            )
+
+        # Transaction signals.
+        pad_length = Signal(16)
+        skip_length = Signal(16)
+        # Downcounter for target reset.
+        reset_counter = Signal(max=120000)
+        # Byte to be sent to target.
+        send_byte = Signal(8)
+        # Byte being received from target.
+        receive_byte = Signal(8)
+        # Index into both send and receive bytes.
+        bit_index = Signal(max=8)
+        # Downounter for clock rise/fall edges, set to sclk.
+        bit_counter = Signal(max=1024)
+
+        self.submodules.fsm = FSM(reset_state='IDLE')
+        self.fsm.act('IDLE',
+            If(self.reset,
+                NextValue(target.rst, 0),
+                NextValue(reset_counter, 119999),
+                NextState('RESET'),
+            ).Elif(self.start,
+                NextValue(pad_length, self.pad_length),
+                NextValue(skip_length, self.skip_length),
+                NextValue(bit_index, 0),
+                NextValue(self.blank, 1),
+                NextState('PREPARE'),
+            )
+        )
+        self.fsm.act('RESET',
+            If(reset_counter == 0,
+                NextValue(target.rst, 1),
+                NextValue(target.sclk, 1),
+                NextState('IDLE'),
+            ).Else(
+                NextValue(reset_counter, reset_counter-1),
+            )
+        )
+        # Prepare next byte to send or finish transaction.
+        self.fsm.act('PREPARE',
+            If(self.txbuffer.readable,
+                NextValue(send_byte, self.txbuffer.dout),
+                NextState('WAIT'),
+            ).Elif(pad_length != 0,
+                NextValue(send_byte, 0xff),
+                NextValue(pad_length, pad_length-1),
+                NextState('WAIT'),
+            ).Else(
+                NextState('IDLE'),
+            )
+        )
+        # Wait for target to not be busy.
+        self.fsm.act('WAIT',
+            If(~target_busy,
+                NextValue(bit_counter, self.sclk_divider),
+                NextState('FALLING'),
+            )
+        )
+        # Downcount bit_counter, send data to target.
+        self.fsm.act('FALLING',
+            If(bit_counter == 0,
+                NextValue(target.sclk, 0),
+                NextState('RISING'),
+                NextValue(bit_counter, self.sclk_divider),
+                NextValue(target.rxd, (send_byte >> bit_index) & 1),
+            ).Else(
+                NextValue(bit_counter, bit_counter-1),
+            )
+        )
+        # Downcount bit_counter, receive data from target.
+        self.fsm.act('RISING',
+            If(bit_counter == 0,
+                NextValue(receive_byte, (target_txd << 7) | (receive_byte >> 1)),
+                NextValue(target.sclk, 1),
+                If(bit_index == 7,
+                    NextValue(bit_index, 0),
+                    NextState('WRITEBACK'),
+                ).Else(
+                    NextValue(bit_index, bit_index+1),
+                    NextState('FALLING'),
+                    NextValue(bit_counter, self.sclk_divider),
+                )
+            ).Else(
+                NextValue(bit_counter, bit_counter-1),
+            )
+        )
+        # Write received byte to response FIFO, unless it is to be dropped.
+        self.fsm.act('WRITEBACK',
+            If(skip_length != 0,
+                NextValue(skip_length, skip_length-1),
+            ).Elif(receive_byte != 0xff,
+                NextValue(self.blank, 0),
+            ),
+            NextState('PREPARE'),
+        )
+
+        self.sync += \
+            If(self.fsm.ongoing('FALLING') | self.fsm.ongoing('RISING'),
+                self.timer_fresh.eq(0),
+            ).Elif((~self.timer_running) & (~last_busy) & target_busy,
+                self.timer_fresh.eq(1),
+            )
+
+        self.comb += [
+            self.idle.eq(self.fsm.ongoing('IDLE')),
+            self.txbuffer.re.eq(self.fsm.ongoing('PREPARE') | self.flush),
+            self.rxbuffer.we.eq(
+                self.fsm.ongoing('WRITEBACK') & (skip_length == 0)
+            ),
+            self.rxbuffer.re.eq(self.rx_re | self.flush),
+            self.rxbuffer.din.eq(receive_byte),
+        ]
+
+
+from migen import run_simulation
+
+class _TestTarget(Module):
+    """Target that sends back every bit it gets, with a busy line to drive."""
+    def __init__(self):
+        self.rst = Signal()
+        self.txd = Signal()
+        self.rxd = Signal()
+        self.sclk = Signal(reset=1)
+        self.busy = Signal()
+        self.tclk = Signal()
+        self.comb += self.txd.eq(self.rxd)
+
+
+class _TestChannel(Module):
+    def __init__(self):
+        self.submodules.target = _TestTarget()
+        self.submodules.channel = Channel(self.target)
+
+
+def _test_transact(dut):
+    channel = dut.channel
+    yield channel.sclk_divider.eq(3)
+
+    def transact(command, pad_length, skip_length):
+        yield channel.txbuffer.we.eq(1)
+        for b in command:
+            yield channel.txbuffer.din.eq(b)
+            yield
+        yield channel.txbuffer.we.eq(0)
+        yield channel.pad_length.eq(pad_length)
+        yield channel.skip_length.eq(skip_length)
+        yield channel.start.eq(1)
+        yield
+        yield channel.start.eq(0)
+        yield
+        while not (yield channel.idle):
+            yield
+        # Read the response FIFO empty.
+        received = []
+        while (yield channel.rxbuffer.readable):
+            received.append((yield channel.rxbuffer.dout))
+            yield channel.rx_re.eq(1)
+            yield
+            yield channel.rx_re.eq(0)
+            yield
+        blank = (yield channel.blank)
+        return received, blank
+
+    # The command is sent back, the first byte is dropped and padding
+    # follows.
+    received, blank = yield from transact([0x12, 0x34], 2, 1)
+    assert received == [0x34, 0xff, 0xff], received
+    assert not blank
+    # All padding, so the result is blank.
+    received, blank = yield from transact([0xfb], 3, 1)
+    assert received == [0xff, 0xff, 0xff], received
+    assert blank
+
+
+def _test_timer(dut):
+    channel = dut.channel
+    for _ in range(4):
+        yield
+    assert not (yield channel.timer_fresh)
+    yield dut.target.busy.eq(1)
+    for _ in range(100):
+        yield
+    assert (yield channel.timer_running)
+    assert (yield channel.timer_fresh)
+    yield dut.target.busy.eq(0)
+    for _ in range(4):
+        yield
+    assert not (yield channel.timer_running)
+    # Counted from the registered busy line going up until it went down.
+    assert abs((yield channel.timer) - 100) <= 2, (yield channel.timer)
+
+
+def test_transact():
+    dut = _TestChannel()
+    run_simulation(dut, _test_transact(dut), vcd_name='vcd/sio-transact.vcd')
+
+def test_timer():
+    dut = _TestChannel()
+    run_simulation(dut, _test_timer(dut), vcd_name='vcd/sio-timer.vcd')
@@ -29,17 +29,39 @@ __author__ = "Serge 'q3k' Bazanski <serge@bazanski.pl>"
 import sys
 
 from migen import *
-from migen.genlib.fifo import SyncFIFOBuffered
 from migen.build.generic_platform import Subsignal, Pins, IOStandard
 from migen.build.platforms import icestick
 
+import sio
 import uart
 
+def crc32(crc, byte):
+    """
+    Returns crc updated with byte, as an expression. CRC-32 (as in zlib):
+    polynomial 0x04C11DB7, least significant bit first. The host sees the
+    complement of the final value.
+    """
+    bits = [crc[i] for i in range(32)]
+    for i in range(8):
+        feedback = bits[0] ^ byte[i]
+        bits = bits[1:] + [feedback]
+        for j in range(31):
+            if (0xedb88320 >> j) & 1:
+                bits[j] = bits[j] ^ feedback
+    return Cat(*bits)
+
+
 class Top(Module):
     # Board clock frequency.
     CLKFREQ = 12000000
-    # Host UART baud rate.
+    # Host UART baud rate after configuration or a break.
     BAUDRATE = 1200000
+    # Largest host UART baud generator step (highest baud rate, 3 Mbaud) the
+    # host may switch to. Above this, the receiver gets fewer than four
+    # cycles per bit.
+    MAX_STEP = 2**14
+    # Number of targets (SIO channels).
+    CHANNELS = 2
 
     def __init__(self, platform):
         # Instantiate and connect UART cores to host.
@@ -51,6 +73,14 @@ class Top(Module):
             self.uart_rx.rx.eq(serial.rx),
         ]
 
+        # Host UART baud generator step, switched at runtime by the host.
+        default_step = uart.baud_step(self.CLKFREQ, self.BAUDRATE)
+        host_step = Signal(uart.STEP_BITS, reset=default_step)
+        self.comb += [
+            self.uart_rx.step.eq(host_step),
+            self.uart_tx.step.eq(host_step),
+        ]
+
         # Heartbeat LED.
         led = platform.request('user_led')
         counter = Signal(max=12000000)
@@ -61,25 +91,49 @@ class Top(Module):
             counter.eq(counter + 1),
         )
 
-        target = platform.request('sio')
-        # Register signals from target because metastability.
-        target_txd = Signal()
-        target_busy = Signal()
-        self.sync += [
-            target_txd.eq(target.txd),
-            target_busy.eq(target.busy),
-        ]
+        targets = [platform.request('sio', i) for i in range(self.CHANNELS)]
+        channels = [sio.Channel(target) for target in targets]
+        self.submodules += channels
 
-        # More debug LEDs.
+        # More debug LEDs, for the first target.
         self.comb += [
-            platform.request('user_led').eq(target.rxd),
-            platform.request('user_led').eq(target.txd),
-            platform.request('user_led').eq(target.busy),
+            platform.request('user_led').eq(targets[0].rxd),
+            platform.request('user_led').eq(targets[0].txd),
+            platform.request('user_led').eq(targets[0].busy),
         ]
 
-        # Input/output FIFOs.
-        self.submodules.txbuffer = SyncFIFOBuffered(8, 512)
-        self.submodules.rxbuffer = SyncFIFOBuffered(8, 512)
+        # Channel that requests other than channel selection apply to.
+        channel = Signal(max=max(self.CHANNELS, 2))
+
+        def selected(f):
+            """Returns f(channel) of the selected channel."""
+            return Array(f(c) for c in channels)[channel]
+
+        def on_selected(f):
+            """Returns statements f(channel) for the selected channel."""
+            return [If(channel == i, f(c)) for i, c in enumerate(channels)]
+
+        # Signals of the selected channel.
+        txbuffer_readable = selected(lambda c: c.txbuffer.readable)
+        txbuffer_writable = selected(lambda c: c.txbuffer.writable)
+        rxbuffer_readable = selected(lambda c: c.rxbuffer.readable)
+        rxbuffer_dout = selected(lambda c: c.rxbuffer.dout)
+        channel_idle = selected(lambda c: c.idle)
+        timer = selected(lambda c: c.timer)
+        timer_running = selected(lambda c: c.timer_running)
+        timer_fresh = selected(lambda c: c.timer_fresh)
+        result_length = selected(lambda c: c.result_length)
+        channel_blank = selected(lambda c: c.blank)
+
+        # Command template and per-candidate busy times of a sweep.
+        sweep_template = Memory(8, 32)
+        sweep_template_port = sweep_template.get_port(write_capable=True)
+        sweep_results = Memory(32, 256)
+        sweep_results_port = sweep_results.get_port(write_capable=True)
+        self.specials += [
+            sweep_template, sweep_template_port,
+            sweep_results, sweep_results_port,
+        ]
 
 
         # Dispatch and response flops for host communication.
@@ -90,41 +144,81 @@ class Top(Module):
         # words.
         counter = Signal(max=120000)
 
-        # Target CLK divider.
-        tclk_divider = Signal(max=120, reset=4)
-        tclk_counter = Signal(max=121)
-        self.sync += [
-            If(tclk_counter == tclk_divider,
-                tclk_counter.eq(0),
-                target.tclk.eq(~target.tclk),
-            ).Else(
-                tclk_counter.eq(tclk_counter + 1),
-            )
-        ]
+        # Downcounter for bytes remaining in a block write.
+        block_length = Signal(16)
+        # Whether any byte of a block write did not fit in the FIFO.
+        block_overflow = Signal()
+
+        # Downcounter for requested bytes to read from FIFO.
+        fifo_read_counter = Signal(32)
+        # Whether to send check data after the bytes read from FIFO, whether
+        # to drop the bytes instead of sending them, and check data (CRC-32)
+        # of the bytes read so far.
+        send_check = Signal()
+        drop_result = Signal()
+        check = Signal(32)
+        # Whether to leave out the result if it is all 0xFF, sending a byte
+        # saying so first.
+        skip_blank = Signal()
+
+        # Command and result lengths (little endian) of a transact request.
+        transact_header = Signal(32)
+        transact_command_length = transact_header[0:16]
+        transact_result_length = transact_header[16:29]
+        # Whether the transact request wants blank results left out, only
+        # check data instead of the result, and check data after the result.
+        transact_blank = transact_header[29]
+        transact_drop = transact_header[30]
+        transact_check = transact_header[31]
+        # Whether the transact request should wait for the busy timer.
+        transact_timed = Signal()
+        # Whether the transact request should only start the transaction.
+        transact_queued = Signal()
+        # Padding and dropped bytes of the next transaction to start (see
+        # sio.Channel).
+        pad_length = Signal(16)
+        skip_length = Signal(16)
+
+        # Template length, candidate byte offset and round count (in that
+        # order) of a sweep request.
+        sweep_header = Signal(24)
+        sweep_length = sweep_header[0:8]
+        sweep_offset = sweep_header[8:16]
+        sweep_rounds = sweep_header[16:24]
+        # Index into sweep template.
+        sweep_index = Signal(8)
+        # Value currently substituted at sweep_offset.
+        sweep_candidate = Signal(8)
+        # Round currently being swept.
+        sweep_round = Signal(8)
+        # Busy time being stored into or read from the results.
+        sweep_sample = Signal(32)
+
+        # Downcounter for giving up on waiting for the busy timer, ~1.4s.
+        watchdog = Signal(24)
 
-        # Target serial CLK divider, used by the *_EDGE states in the FSM.
-        sclk_divider = Signal(max=1024, reset=1023)
+        # Host UART baud generator step requested by the host, and the one to
+        # go back to if the host doesn't confirm it.
+        baud_step = Signal(uart.STEP_BITS)
+        last_step = Signal(uart.STEP_BITS)
 
-        # Target busy timer.
-        timer = Signal(32)
-        timer_running = Signal(reset=0)
-        last_busy = Signal()
-        self.sync += last_busy.eq(target_busy)
+        # Downcounter for the host holding its TX line low (a break), ~87ms.
+        # A break gets the host link back to a known state: the main state
+        # machine is reset and the UART goes back to BAUDRATE.
+        break_counter = Signal(20, reset=2**20-1)
+        host_break = Signal()
+        self.comb += host_break.eq(break_counter == 0)
         self.sync += \
-            If(~timer_running,
-                If((~last_busy) & target_busy,
-                    timer_running.eq(1),
-                    timer.eq(0),
-                )
-            ).Elif(~target_busy,
-                timer_running.eq(0),
-            ).Else(
-                timer.eq(timer + 1),
+            If(self.uart_rx.rx,
+                break_counter.eq(2**20-1),
+            ).Elif(~host_break,
+                break_counter.eq(break_counter-1),
             )
 
-        
+
         # Main state machine.
-        self.submodules.fsm = FSM(reset_state='IDLE')
+        self.submodules.fsm = ResetInserter()(FSM(reset_state='IDLE'))
+        self.comb += self.fsm.reset.eq(host_break)
         self.fsm.act('IDLE',
             If(self.uart_rx.readable,
                 NextState('DISPATCH'),
@@ -136,7 +230,11 @@ class Top(Module):
                 # Get API version of bitstream.
                 ord('v'): [
                     NextState('RESPOND_BYTE'),
-                    NextValue(response, ord('0')),
+                    NextValue(response, ord('b')),
+                ],
+                # Select channel.
+                ord('C'): [
+                    NextState('SELECT_CHANNEL'),
                 ],
                 # Flush both FIFOs.
                 ord('f'): [
@@ -145,21 +243,60 @@ class Top(Module):
                 # Reset target.
                 ord('r'): [
                     NextState('RESET_TARGET'),
-                    NextValue(target.rst, 0),
-                    NextValue(counter, 119999),
                 ],
                 # Write byte to FIFO.
                 ord('w'): [
                     NextState('FIFO_WRITE'),
                 ],
+                # Write length-prefixed block of bytes to FIFO.
+                ord('b'): [
+                    NextState('FIFO_BLOCK_START'),
+                    NextValue(counter, 1),
+                    NextValue(block_overflow, 0),
+                ],
                 # Perform transaction with target.
                 ord('W'): [
                     NextState('SEND_START'),
+                    NextValue(pad_length, 0),
+                    NextValue(skip_length, 0),
+                ],
+                # Load command, perform transaction and return result.
+                ord('x'): [
+                    NextState('TRANSACT_START'),
+                    NextValue(counter, 3),
+                    NextValue(transact_timed, 0),
+                    NextValue(transact_queued, 0),
+                ],
+                # Same as above, but also wait for and return busy timer.
+                ord('X'): [
+                    NextState('TRANSACT_START'),
+                    NextValue(counter, 3),
+                    NextValue(transact_timed, 1),
+                    NextValue(transact_queued, 0),
+                ],
+                # Load command and start transaction, return at once.
+                ord('q'): [
+                    NextState('TRANSACT_START'),
+                    NextValue(counter, 3),
+                    NextValue(transact_timed, 0),
+                    NextValue(transact_queued, 1),
+                ],
+                # Wait for a started transaction and return result.
+                ord('k'): [
+                    NextState('TRANSACT_WAIT'),
+                    NextValue(transact_timed, 0),
+                ],
+                # Same as above, but also wait for and return busy timer.
+                ord('K'): [
+                    NextState('TRANSACT_WAIT'),
+                    NextValue(transact_timed, 1),
                 ],
                 # Read bytes from FIFO.
                 ord('R'): [
                     NextState('FIFO_READ_START'),
                     NextValue(counter, 3),
+                    NextValue(send_check, 0),
+                    NextValue(drop_result, 0),
                 ],
                 # Get timer value.
                 ord('t'): [
@@ -175,6 +312,12 @@ class Top(Module):
                         NextValue(response, ord('s'))
                     )
                 ],
+                # Perform timed transactions for every value of a command
+                # byte, return busy times.
+                ord('c'): [
+                    NextState('SWEEP_START'),
+                    NextValue(counter, 2),
+                ],
                 # Set target clock.
                 ord('s'): [
                     NextState('SET_TCLK'),
@@ -184,6 +327,16 @@ class Top(Module):
                     NextState('SET_SCLK'),
                     NextValue(counter, 1),
                 ],
+                # Switch host UART baud rate.
+                ord('B'): [
+                    NextState('BAUD_START'),
+                    NextValue(counter, 1),
+                ],
+                # Send length-prefixed block of bytes back to host.
+                ord('e'): [
+                    NextState('ECHO_START'),
+                    NextValue(counter, 1),
+                ],
                 # Default handler.
                 'default': [
                     NextState('RESPOND_BYTE'),
@@ -191,14 +344,28 @@ class Top(Module):
                 ],
             })
         )
+        self.fsm.act('SELECT_CHANNEL',
+            If(self.uart_rx.readable,
+                If(self.uart_rx.dout < self.CHANNELS,
+                    NextValue(channel, self.uart_rx.dout),
+                    NextValue(response, ord('.')),
+                ).Else(
+                    NextValue(response, ord('!')),
+                ),
+                NextState('RESPOND_BYTE'),
+            )
+        )
+        # Wait for the channel to finish what it's doing, then have it reset
+        # the target and wait for that.
         self.fsm.act('RESET_TARGET',
-            If(counter == 0,
-                NextValue(target.rst, 1),
-                NextValue(target.sclk, 1),
+            If(channel_idle,
+                NextState('RESET_WAIT'),
+            )
+        )
+        self.fsm.act('RESET_WAIT',
+            If(channel_idle,
                 NextValue(response, ord('.')),
                 NextState('RESPOND_BYTE'),
-            ).Else(
-                NextValue(counter, counter-1),
             )
         )
         self.fsm.act('GET_TIMER',
@@ -209,7 +376,7 @@ class Top(Module):
         )
         self.fsm.act('FIFO_WRITE',
             If(self.uart_rx.readable,
-                If(self.txbuffer.writable,
+                If(txbuffer_writable,
                     NextValue(response, ord('.')),
                     NextState('RESPOND_BYTE'),
                 ).Else(
@@ -218,16 +385,177 @@ class Top(Module):
                 )
             )
         )
+
+        # Load block length (little endian) from host request.
+        self.fsm.act('FIFO_BLOCK_START',
+            If(self.uart_rx.readable,
+                NextValue(block_length, (block_length >> 8) | (self.uart_rx.dout << 8)),
+                If(counter == 0,
+                    NextState('FIFO_BLOCK_WRITE'),
+                ).Else(
+                    NextValue(counter, counter-1),
+                )
+            )
+        )
+        # Downcount block_length, write host bytes to FIFO. Respond once for
+        # the whole block.
+        self.fsm.act('FIFO_BLOCK_WRITE',
+            If(block_length == 0,
+                If(block_overflow,
+                    NextValue(response, ord('!')),
+                ).Else(
+                    NextValue(response, ord('.')),
+                ),
+                NextState('RESPOND_BYTE'),
+            ).Elif(self.uart_rx.readable,
+                If(~txbuffer_writable,
+                    NextValue(block_overflow, 1),
+                ),
+                NextValue(block_length, block_length-1),
+            )
+        )
+
+        # Start transaction once the channel is idle, wait for it to finish.
+        self.fsm.act('SEND_START',
+            If(channel_idle,
+                NextState('SEND_WAIT'),
+            )
+        )
+        self.fsm.act('SEND_WAIT',
+            If(channel_idle,
+                NextValue(response, ord('.')),
+                NextState('RESPOND_BYTE'),
+            )
+        )
+
+        # Load transact header from host request.
+        self.fsm.act('TRANSACT_START',
+            If(self.uart_rx.readable,
+                NextValue(transact_header, (transact_header >> 8) | (self.uart_rx.dout << 24)),
+                If(counter == 0,
+                    NextState('TRANSACT_FLUSH'),
+                ).Else(
+                    NextValue(counter, counter-1),
+                )
+            )
+        )
+        # Wait for the channel to finish what it's doing, drop stale FIFO
+        # contents, then arm the transaction counters: the target echoes
+        # back a byte for every command byte, those get dropped, and it needs
+        # a padding byte clocked in for every result byte.
+        self.fsm.act('TRANSACT_FLUSH',
+            If(channel_idle & (~rxbuffer_readable) & (~txbuffer_readable),
+                NextValue(block_length, transact_command_length),
+                NextValue(block_overflow, 0),
+                NextValue(skip_length, transact_command_length),
+                NextValue(pad_length, transact_result_length),
+                *on_selected(lambda c: NextValue(c.result_length, Cat(transact_result_length, transact_blank, transact_drop, transact_check))),
+                NextState('TRANSACT_LOAD'),
+            )
+        )
+        # Downcount block_length, write command bytes to FIFO, then start the
+        # transaction.
+        self.fsm.act('TRANSACT_LOAD',
+            If(block_length == 0,
+                If(block_overflow,
+                    NextValue(response, ord('!')),
+                    NextState('RESPOND_BYTE'),
+                ).Else(
+                    NextState('TRANSACT_RUN'),
+                )
+            ).Elif(self.uart_rx.readable,
+                If(~txbuffer_writable,
+                    NextValue(block_overflow, 1),
+                ),
+                NextValue(block_length, block_length-1),
+            )
+        )
+        # Start the transaction, then either ACK at once or wait for it.
+        self.fsm.act('TRANSACT_RUN',
+            If(transact_queued,
+                NextValue(response, ord('.')),
+                NextState('RESPOND_BYTE'),
+            ).Else(
+                NextState('TRANSACT_WAIT'),
+            )
+        )
+        self.fsm.act('TRANSACT_WAIT',
+            If(channel_idle,
+                NextValue(response, ord('.')),
+                If(transact_timed,
+                    NextValue(watchdog, 2**24-1),
+                    NextState('TRANSACT_TIMER_WAIT'),
+                ).Else(
+                    NextState('TRANSACT_ACK'),
+                )
+            )
+        )
+        # Wait for the target to go busy after the last byte and then for the
+        # busy timer to stop. Give up if that takes too long.
+        self.fsm.act('TRANSACT_TIMER_WAIT',
+            If(timer_fresh & ~timer_running,
+                NextState('TRANSACT_ACK'),
+            ).Elif(watchdog == 0,
+                NextValue(response, ord('!')),
+                NextState('RESPOND_BYTE'),
+            ).Else(
+                NextValue(watchdog, watchdog-1),
+            )
+        )
+        # ACK the transaction, then stream the timer (if requested), whether
+        # the result is blank (if requested) and the result to the host.
+        self.fsm.act('TRANSACT_ACK',
+            If(self.uart_tx.writable,
+                NextValue(fifo_read_counter, result_length[0:13]),
+                NextValue(skip_blank, result_length[13]),
+                NextValue(drop_result, result_length[14]),
+                NextValue(send_check, result_length[15]),
+                If(transact_timed,
+                    NextValue(counter, 0),
+                    NextState('TRANSACT_TIMER'),
+                ).Elif(result_length[13],
+                    NextState('TRANSACT_BLANK'),
+                ).Else(
+                    NextState('FIFO_READ'),
+                )
+            )
+        )
+        self.fsm.act('TRANSACT_TIMER',
+            If(counter == 3,
+                If(skip_blank,
+                    NextState('TRANSACT_BLANK'),
+                ).Else(
+                    NextState('FIFO_READ'),
+                )
+            ),
+            NextValue(counter, counter+1),
+        )
+        # Send 1 if the result is all 0xFF and gets dropped, 0 if it follows.
+        self.fsm.act('TRANSACT_BLANK',
+            If(self.uart_tx.writable,
+                NextValue(drop_result, drop_result | channel_blank),
+                NextState('FIFO_READ'),
+            )
+        )
+
+        # Whether the block write should consume a byte - same hack as
+        # fifo_read below.
+        block_write = Signal()
+        self.comb += block_write.eq(
+            (self.fsm.ongoing('FIFO_BLOCK_WRITE') | self.fsm.ongoing('TRANSACT_LOAD')) &
+            (block_length != 0)
+        )
+
         self.fsm.act('SET_TCLK',
             If(self.uart_rx.readable,
-                NextValue(tclk_divider, self.uart_rx.dout),
+                *on_selected(lambda c: NextValue(c.tclk_divider, self.uart_rx.dout)),
                 NextValue(response, ord('.')),
                 NextState('RESPOND_BYTE'),
             )
         )
         self.fsm.act('SET_SCLK',
             If(self.uart_rx.readable,
-                NextValue(sclk_divider, (sclk_divider >> 8) | (self.uart_rx.dout << 8)),
+                *on_selected(lambda c: NextValue(c.sclk_divider, (c.sclk_divider >> 8) | (self.uart_rx.dout << 8))),
                 If(counter == 0,
                     NextValue(response, ord('.')),
                     NextState('RESPOND_BYTE'),
@@ -237,78 +565,244 @@ class Top(Module):
             )
         )
 
-        # Transaction signals.
-        # Byte to be sent to target.
-        send_byte = Signal(8)
-        # Byte being received from target.
-        receive_byte = Signal(8)
-        # Index into both send and receive bytes.
-        bit_index = Signal(max=8)
-        # Downounter for clock rise/fall edges, set to sclk.
-        bit_counter = Signal(max=1024)
-        # Rising/falling edge over, move to next state.
-        bit_strobe = Signal()
-        self.comb += bit_strobe.eq(bit_counter == 0)
-        next_bit = Signal()
-
-        self.fsm.act('SEND_START',
-            NextState('SEND_PREPARE'),
-            NextValue(bit_index, 0),
+        # Load baud generator step (little endian) from host request.
+        self.fsm.act('BAUD_START',
+            If(self.uart_rx.readable,
+                NextValue(baud_step, (baud_step >> 8) | (self.uart_rx.dout << 8)),
+                If(counter == 0,
+                    NextState('BAUD_CHECK'),
+                ).Else(
+                    NextValue(counter, counter-1),
+                )
+            )
         )
-        # Prepare next byte to send or finish transaction.
-        self.fsm.act('SEND_PREPARE',
-            If(self.txbuffer.readable,
-                NextValue(send_byte, self.txbuffer.dout),
-                NextState('SEND_WAIT'),
+        # Refuse steps the UART cores can't work with, ACK others at the
+        # current rate.
+        self.fsm.act('BAUD_CHECK',
+            If((baud_step == 0) | (baud_step > self.MAX_STEP),
+                NextValue(response, ord('!')),
+                NextState('RESPOND_BYTE'),
             ).Else(
                 NextValue(response, ord('.')),
-                NextState('RESPOND_BYTE'),
+                NextState('BAUD_ACK'),
             )
         )
-
-        # Wait for target to not be busy.
-        self.fsm.act('SEND_WAIT',
-            If(~target_busy,
-                NextValue(bit_counter, sclk_divider),
-                NextState('SEND_FALLING'),
+        self.fsm.act('BAUD_ACK',
+            If(self.uart_tx.writable,
+                NextValue(counter, 15),
+                NextState('BAUD_DRAIN'),
             )
         )
-
-        # Downcount bit_counter, send data to target.
-        self.fsm.act('SEND_FALLING',
-            If(bit_counter == 0,
-                NextValue(target.sclk, 0),
-                NextState('SEND_RISING'),
-                NextValue(bit_counter, sclk_divider),
-                NextValue(target.rxd, (send_byte >> bit_index) & 1),
+        # Wait for the ACK to be sent out completely before switching.
+        self.fsm.act('BAUD_DRAIN',
+            If(~self.uart_tx.idle,
+                NextValue(counter, 15),
+            ).Elif(counter == 0,
+                NextState('BAUD_SWITCH'),
             ).Else(
-                NextValue(bit_counter, bit_counter-1),
+                NextValue(counter, counter-1),
             )
         )
-        # Downcount bit_counter, receive data from target.
-        self.fsm.act('SEND_RISING',
-            If(bit_counter == 0,
-                NextValue(receive_byte, (target_txd << 7) | (receive_byte >> 1)),
-                NextValue(target.sclk, 1),
-                If(bit_index == 7,
-                    NextValue(bit_index, 0),
-                    NextState('SEND_WRITEBACK'),
+        self.fsm.act('BAUD_SWITCH',
+            NextValue(watchdog, 2**24-1),
+            NextState('BAUD_CONFIRM'),
+        )
+        # The host confirms the switch by sending a 'B' at the new rate. Go
+        # back to the old rate if it sends anything else, or nothing.
+        self.fsm.act('BAUD_CONFIRM',
+            If(self.uart_rx.readable,
+                If(self.uart_rx.dout == ord('B'),
+                    NextValue(response, ord('.')),
+                    NextState('RESPOND_BYTE'),
                 ).Else(
-                    NextValue(bit_index, bit_index+1),
-                    NextState('SEND_FALLING'),
-                    NextValue(bit_counter, sclk_divider),
+                    NextState('BAUD_REVERT'),
                 )
+            ).Elif(watchdog == 0,
+                NextState('BAUD_REVERT'),
             ).Else(
-                NextValue(bit_counter, bit_counter-1),
+                NextValue(watchdog, watchdog-1),
             )
         )
-        # Write received byte to read FIFO.
-        self.fsm.act('SEND_WRITEBACK',
-            NextState('SEND_PREPARE')
+        self.fsm.act('BAUD_REVERT',
+            NextState('IDLE'),
         )
+        self.sync += \
+            If(host_break,
+                host_step.eq(default_step),
+            ).Elif(self.fsm.ongoing('BAUD_SWITCH'),
+                last_step.eq(host_step),
+                host_step.eq(baud_step),
+            ).Elif(self.fsm.ongoing('BAUD_REVERT'),
+                host_step.eq(last_step),
+            )
 
-        # Downcounter for requested bytes to read from FIFO.
-        fifo_read_counter = Signal(32)
+        # Load echo length (little endian) from host request.
+        self.fsm.act('ECHO_START',
+            If(self.uart_rx.readable,
+                NextValue(block_length, (block_length >> 8) | (self.uart_rx.dout << 8)),
+                If(counter == 0,
+                    NextState('ECHO'),
+                ).Else(
+                    NextValue(counter, counter-1),
+                )
+            )
+        )
+        # Downcount block_length, send host bytes back to host.
+        self.fsm.act('ECHO',
+            If(block_length == 0,
+                NextState('IDLE'),
+            ).Elif(self.uart_rx.readable & self.uart_tx.writable,
+                NextValue(block_length, block_length-1),
+            )
+        )
+        # Whether a byte should be echoed - same hack as fifo_read below.
+        echo = Signal()
+        self.comb += echo.eq(
+            self.fsm.ongoing('ECHO') & (block_length != 0) &
+            self.uart_rx.readable & self.uart_tx.writable
+        )
+
+        # A sweep sends the command template once for every candidate value
+        # of the byte at sweep_offset, measuring the busy time after each.
+        # Results of a round are kept in block RAM and only sent to the host
+        # once the round is over, so that the host link is quiet during
+        # measurements.
+
+        # Load sweep header from host request.
+        self.fsm.act('SWEEP_START',
+            If(self.uart_rx.readable,
+                NextValue(sweep_header, (sweep_header >> 8) | (self.uart_rx.dout << 16)),
+                If(counter == 0,
+                    NextValue(sweep_index, 0),
+                    NextState('SWEEP_TEMPLATE'),
+                ).Else(
+                    NextValue(counter, counter-1),
+                )
+            )
+        )
+        # Write command template from host into memory.
+        self.fsm.act('SWEEP_TEMPLATE',
+            If(sweep_index == sweep_length,
+                NextValue(sweep_index, 0),
+                NextValue(sweep_candidate, 0),
+                NextValue(sweep_round, 0),
+                NextValue(pad_length, 0),
+                NextValue(skip_length, sweep_length),
+                If(sweep_rounds == 0,
+                    NextState('IDLE'),
+                ).Else(
+                    NextState('SWEEP_FLUSH'),
+                )
+            ).Elif(self.uart_rx.readable,
+                NextValue(sweep_index, sweep_index+1),
+            )
+        )
+        # Wait for the channel to finish what it's doing and drop stale FIFO
+        # contents.
+        self.fsm.act('SWEEP_FLUSH',
+            If(channel_idle & (~rxbuffer_readable) & (~txbuffer_readable),
+                NextState('SWEEP_FETCH'),
+            )
+        )
+        # Wait for template memory read.
+        self.fsm.act('SWEEP_FETCH',
+            NextState('SWEEP_LOAD'),
+        )
+        # Write template byte (or candidate) to FIFO, start the transaction
+        # once the template is loaded.
+        self.fsm.act('SWEEP_LOAD',
+            If(sweep_index == sweep_length,
+                NextState('SWEEP_RUN'),
+            ).Else(
+                NextValue(sweep_index, sweep_index+1),
+                NextState('SWEEP_FETCH'),
+            )
+        )
+        self.fsm.act('SWEEP_RUN',
+            NextState('SWEEP_WAIT'),
+        )
+        self.fsm.act('SWEEP_WAIT',
+            If(channel_idle,
+                NextValue(watchdog, 2**20-1),
+                NextState('SWEEP_TIMER_WAIT'),
+            )
+        )
+        # Wait for busy timer like TRANSACT_TIMER_WAIT, but with a shorter
+        # timeout, and store all ones on timeout instead of giving up.
+        self.fsm.act('SWEEP_TIMER_WAIT',
+            If(timer_fresh & ~timer_running,
+                NextValue(sweep_sample, timer),
+                NextState('SWEEP_STORE'),
+            ).Elif(watchdog == 0,
+                NextValue(sweep_sample, 0xffffffff),
+                NextState('SWEEP_STORE'),
+            ).Else(
+                NextValue(watchdog, watchdog-1),
+            )
+        )
+        # Write busy time into results, move on to next candidate or send
+        # results to host.
+        self.fsm.act('SWEEP_STORE',
+            NextValue(sweep_index, 0),
+            NextValue(sweep_candidate, sweep_candidate+1),
+            If(sweep_candidate == 255,
+                NextState('SWEEP_DRAIN_FETCH'),
+            ).Else(
+                NextState('SWEEP_FETCH'),
+            )
+        )
+        # Wait for results memory read.
+        self.fsm.act('SWEEP_DRAIN_FETCH',
+            NextState('SWEEP_DRAIN_LATCH'),
+        )
+        self.fsm.act('SWEEP_DRAIN_LATCH',
+            NextValue(sweep_sample, sweep_results_port.dat_r),
+            NextValue(counter, 0),
+            NextState('SWEEP_DRAIN'),
+        )
+        # Send busy time to host, move on to next candidate, next round or
+        # finish sweep.
+        self.fsm.act('SWEEP_DRAIN',
+            If(self.uart_tx.writable,
+                NextValue(counter, counter+1),
+                If(counter == 3,
+                    NextValue(sweep_candidate, sweep_candidate+1),
+                    If(sweep_candidate != 255,
+                        NextState('SWEEP_DRAIN_FETCH'),
+                    ).Elif(sweep_round + 1 == sweep_rounds,
+                        NextState('IDLE'),
+                    ).Else(
+                        NextValue(sweep_round, sweep_round+1),
+                        NextState('SWEEP_FETCH'),
+                    )
+                )
+            )
+        )
+        # Whether the template write should consume a byte - same hack as
+        # fifo_read below.
+        sweep_template_write = Signal()
+        self.comb += sweep_template_write.eq(
+            self.fsm.ongoing('SWEEP_TEMPLATE') & (sweep_index != sweep_length)
+        )
+        # Whether a template byte should be written to the FIFO.
+        sweep_load = Signal()
+        self.comb += sweep_load.eq(
+            self.fsm.ongoing('SWEEP_LOAD') & (sweep_index != sweep_length)
+        )
+        sweep_byte = Signal(8)
+        self.comb += [
+            If(sweep_index == sweep_offset,
+                sweep_byte.eq(sweep_candidate),
+            ).Else(
+                sweep_byte.eq(sweep_template_port.dat_r),
+            ),
+            sweep_template_port.adr.eq(sweep_index),
+            sweep_template_port.dat_w.eq(self.uart_rx.dout),
+            sweep_template_port.we.eq(sweep_template_write & self.uart_rx.readable),
+            sweep_results_port.adr.eq(sweep_candidate),
+            sweep_results_port.dat_w.eq(sweep_sample),
+            sweep_results_port.we.eq(self.fsm.ongoing('SWEEP_STORE')),
+        ]
 
         # Set downcounter based on host request.
         self.fsm.act('FIFO_READ_START',
@@ -322,43 +816,86 @@ class Top(Module):
             )
         )
 
-        # Downcount fifo_read_counter, send FIFO bytes to host.
+        # Downcount fifo_read_counter, send FIFO bytes to host (or drop
+        # them). Stall while the host UART is backed up, so that results of
+        # back to back requests don't get dropped.
         self.fsm.act('FIFO_READ',
             If(fifo_read_counter == 0,
-                NextState('IDLE'),
-            ).Else(
+                If(send_check,
+                    NextValue(counter, 0),
+                    NextState('TRANSACT_CHECK'),
+                ).Else(
+                    NextState('IDLE'),
+                )
+            ).Elif(self.uart_tx.writable | drop_result,
                 NextValue(fifo_read_counter, fifo_read_counter-1),
             )
         )
         # Whether the read FIFO should emit a byte - somewhat of a hack.
         fifo_read = Signal()
-        self.comb += fifo_read.eq(self.fsm.ongoing('FIFO_READ') & (fifo_read_counter != 0))
+        self.comb += fifo_read.eq(self.fsm.ongoing('FIFO_READ') & (fifo_read_counter != 0) & (self.uart_tx.writable | drop_result))
+
+        # Send check data (little endian) of the result to host.
+        self.fsm.act('TRANSACT_CHECK',
+            If(self.uart_tx.writable,
+                If(counter == 3,
+                    NextState('IDLE'),
+                ),
+                NextValue(counter, counter+1),
+            )
+        )
+        self.sync += \
+            If(self.fsm.ongoing('TRANSACT_ACK'),
+                check.eq(0xffffffff),
+            ).Elif(fifo_read,
+                check.eq(crc32(check, self.uart_tx.din)),
+            )
 
+        # Wait for the channel to finish what it's doing, then drop FIFO
+        # contents.
         self.fsm.act('FIFO_FLUSH',
-            If((~self.rxbuffer.readable) & (~self.txbuffer.readable),
+            If(channel_idle & (~rxbuffer_readable) & (~txbuffer_readable),
                 NextValue(response, ord('.')),
                 NextState('RESPOND_BYTE'),
             )
         )
 
-        # Enables and data connections for FIFOs.
-        self.comb += [
-            self.txbuffer.we.eq(
-                self.fsm.ongoing('FIFO_WRITE') & self.uart_rx.readable
-            ),
-            self.txbuffer.re.eq(
-                self.fsm.ongoing('SEND_PREPARE') |
-                self.fsm.ongoing('FIFO_FLUSH')
-            ),
-            self.txbuffer.din.eq(self.uart_rx.dout),
-
-            self.rxbuffer.we.eq(self.fsm.ongoing('SEND_WRITEBACK')),
-            self.rxbuffer.re.eq(
-                fifo_read |
-                self.fsm.ongoing('FIFO_FLUSH')
-            ),
-            self.rxbuffer.din.eq(receive_byte),
-        ]
+        # Strobes, enables and data connections for the selected channel.
+        flush = Signal()
+        self.comb += flush.eq(channel_idle & (
+            self.fsm.ongoing('FIFO_FLUSH') |
+            self.fsm.ongoing('TRANSACT_FLUSH') |
+            self.fsm.ongoing('SWEEP_FLUSH')
+        ))
+        start = Signal()
+        self.comb += start.eq(
+            (self.fsm.ongoing('SEND_START') & channel_idle) |
+            self.fsm.ongoing('TRANSACT_RUN') |
+            self.fsm.ongoing('SWEEP_RUN')
+        )
+        reset = Signal()
+        self.comb += reset.eq(self.fsm.ongoing('RESET_TARGET') & channel_idle)
+        txbuffer_we = Signal()
+        self.comb += txbuffer_we.eq(
+            ((self.fsm.ongoing('FIFO_WRITE') | block_write) &
+             self.uart_rx.readable) |
+            sweep_load
+        )
+        for i, c in enumerate(channels):
+            self.comb += [
+                c.flush.eq(flush & (channel == i)),
+                c.start.eq(start & (channel == i)),
+                c.reset.eq(reset & (channel == i)),
+                c.pad_length.eq(pad_length),
+                c.skip_length.eq(skip_length),
+                c.txbuffer.we.eq(txbuffer_we & (channel == i)),
+                If(sweep_load,
+                    c.txbuffer.din.eq(sweep_byte),
+                ).Else(
+                    c.txbuffer.din.eq(self.uart_rx.dout),
+                ),
+                c.rx_re.eq(fifo_read & (channel == i)),
+            ]
 
         # Generic 1-byte response state.
         self.fsm.act('RESPOND_BYTE',
@@ -371,23 +908,49 @@ class Top(Module):
         self.comb += [
             self.uart_rx.re.eq(
                 self.fsm.ongoing('IDLE') |
+                self.fsm.ongoing('SELECT_CHANNEL') |
                 self.fsm.ongoing('FIFO_WRITE') |
+                self.fsm.ongoing('FIFO_BLOCK_START') |
+                self.fsm.ongoing('TRANSACT_START') |
+                self.fsm.ongoing('SWEEP_START') |
+                sweep_template_write |
+                block_write |
                 self.fsm.ongoing('SET_TCLK') |
                 self.fsm.ongoing('SET_SCLK') |
+                self.fsm.ongoing('BAUD_START') |
+                self.fsm.ongoing('BAUD_CONFIRM') |
+                self.fsm.ongoing('ECHO_START') |
+                echo |
                 self.fsm.ongoing('FIFO_READ_START')
             ),
             self.uart_tx.we.eq(
                 self.fsm.ongoing('RESPOND_BYTE') |
+                self.fsm.ongoing('TRANSACT_ACK') |
                 self.fsm.ongoing('GET_TIMER') |
-                fifo_read
+                self.fsm.ongoing('TRANSACT_TIMER') |
+                self.fsm.ongoing('SWEEP_DRAIN') |
+                self.fsm.ongoing('BAUD_ACK') |
+                self.fsm.ongoing('TRANSACT_CHECK') |
+                self.fsm.ongoing('TRANSACT_BLANK') |
+                echo |
+                (fifo_read & ~drop_result)
             ),
-            If(self.fsm.ongoing('RESPOND_BYTE'),
+            If(self.fsm.ongoing('RESPOND_BYTE') | self.fsm.ongoing('TRANSACT_ACK') |
+               self.fsm.ongoing('BAUD_ACK'),
                 self.uart_tx.din.eq(response),
-            ).Elif(self.fsm.ongoing('GET_TIMER'),
+            ).Elif(echo,
+                self.uart_tx.din.eq(self.uart_rx.dout),
+            ).Elif(self.fsm.ongoing('GET_TIMER') | self.fsm.ongoing('TRANSACT_TIMER'),
                 self.uart_tx.din.eq(timer >> (counter * 8)),
+            ).Elif(self.fsm.ongoing('SWEEP_DRAIN'),
+                self.uart_tx.din.eq(sweep_sample >> (counter * 8)),
+            ).Elif(self.fsm.ongoing('TRANSACT_CHECK'),
+                self.uart_tx.din.eq(~check >> (counter * 8)),
+            ).Elif(self.fsm.ongoing('TRANSACT_BLANK'),
+                self.uart_tx.din.eq(channel_blank),
             ).Elif(fifo_read,
-                If(self.rxbuffer.readable,
-                    self.uart_tx.din.eq(self.rxbuffer.dout),
+                If(rxbuffer_readable,
+                    self.uart_tx.din.eq(rxbuffer_dout),
                 ).Else(
                     self.uart_tx.din.eq(0xff),
                 ),
@@ -401,6 +964,174 @@ class Top(Module):
         ]
 
 
+
+import binascii
+
+class _TestPads(object):
+    pass
+
+
+class _TestPlatform(object):
+    """Stands in for the board, handing out plain signals as pads."""
+    def __init__(self):
+        self.serial = None
+        self.sio = []
+
+    def request(self, name, number=None):
+        if name == 'serial':
+            self.serial = _TestPads()
+            self.serial.tx = Signal(reset=1)
+            self.serial.rx = Signal(reset=1)
+            return self.serial
+        if name == 'sio':
+            pads = _TestPads()
+            for n in ['rst', 'txd', 'rxd', 'sclk', 'busy', 'tclk']:
+                setattr(pads, n, Signal(name='sio{}_{}'.format(number, n)))
+            self.sio.append(pads)
+            return pads
+        return Signal()
+
+
+class _TestHost(object):
+    """Host end of the UART link, at rates that divide the clock."""
+    def __init__(self, pads):
+        self.pads = pads
+        self.rate = Top.BAUDRATE
+        self.received = []
+        self.done = False
+
+    def _period(self):
+        return Top.CLKFREQ // self.rate
+
+    def _wait(self, cycles):
+        for _ in range(cycles):
+            yield
+
+    def send(self, data):
+        for byte in data:
+            for bit in [0] + [(byte >> i) & 1 for i in range(8)] + [1]:
+                yield self.pads.rx.eq(bit)
+                yield from self._wait(self._period())
+
+    def monitor(self):
+        """Collects bytes sent by the adapter until done."""
+        while not self.done:
+            if (yield self.pads.tx):
+                yield
+                continue
+            # Sample in the middle of every bit.
+            yield from self._wait(self._period() // 2)
+            byte = 0
+            for i in range(8):
+                yield from self._wait(self._period())
+                byte |= (yield self.pads.tx) << i
+            yield from self._wait(self._period())
+            self.received.append(byte)
+
+    def request(self, data, length):
+        """
+        Sends a request, returns its response of length bytes, which has to
+        arrive in time and not be followed by anything else.
+        """
+        start = len(self.received)
+        yield from self.send(data)
+        for _ in range(20000):
+            if len(self.received) >= start + length:
+                break
+            yield
+        yield from self._wait(30 * self._period())
+        response = bytes(self.received[start:])
+        assert len(response) == length, (data, response)
+        return response
+
+
+# Result length bits of transact requests.
+_CHECK = 0x8000
+_DROP = 0x4000
+_BLANK = 0x2000
+
+def _transact(result_length, flags=0):
+    """Returns a transact request for a single byte command."""
+    return b'x\x01\x00' + (result_length | flags).to_bytes(2, 'little') + b'\xfb'
+
+def _check(data):
+    return binascii.crc32(data).to_bytes(4, 'little')
+
+def _select(host, channel):
+    """Selects channel and makes its serial clock fast."""
+    assert (yield from host.request(b'C' + bytes([channel]), 1)) == b'.'
+    assert (yield from host.request(b'S\x00\x00', 1)) == b'.'
+
+def _test_channel_select(host, platform):
+    # Channel 0 reads all zeroes, channel 1 all ones.
+    yield platform.sio[1].txd.eq(1)
+    assert (yield from host.request(b'v', 1)) == b'b'
+    for channel, result in [(0, b'\x00\x00'), (1, b'\xff\xff'),
+                            (0, b'\x00\x00')]:
+        yield from _select(host, channel)
+        assert (yield from host.request(_transact(2), 3)) == b'.' + result
+    assert (yield from host.request(b'C\x02', 1)) == b'!'
+
+def _test_transact_flags(host, platform):
+    yield from _select(host, 0)
+    zeroes = b'\x00' * 4
+    assert (yield from host.request(_transact(4), 5)) == b'.' + zeroes
+    assert (yield from host.request(_transact(4, _CHECK), 9)) == \
+        b'.' + zeroes + _check(zeroes)
+    assert (yield from host.request(_transact(4, _DROP), 1)) == b'.'
+    assert (yield from host.request(_transact(4, _CHECK | _DROP), 5)) == \
+        b'.' + _check(zeroes)
+    assert (yield from host.request(_transact(4, _BLANK), 6)) == \
+        b'.\x00' + zeroes
+    # Erased: the result is left out, but still checked.
+    yield platform.sio[0].txd.eq(1)
+    ones = b'\xff' * 4
+    assert (yield from host.request(_transact(4, _BLANK), 2)) == b'.\x01'
+    assert (yield from host.request(_transact(4, _BLANK | _CHECK), 6)) == \
+        b'.\x01' + _check(ones)
+    assert (yield from host.request(_transact(4), 5)) == b'.' + ones
+
+def _test_baud_switch(host, platform):
+    def step(rate):
+        return uart.baud_step(Top.CLKFREQ, rate).to_bytes(2, 'little')
+    # Steps the UART cores can't work with are refused.
+    assert (yield from host.request(b'B\x00\x00', 1)) == b'!'
+    assert (yield from host.request(
+        b'B' + (Top.MAX_STEP + 1).to_bytes(2, 'little'), 1)) == b'!'
+    # Switch, confirm at the new rate.
+    assert (yield from host.request(b'B' + step(2400000), 1)) == b'.'
+    host.rate = 2400000
+    assert (yield from host.request(b'B', 1)) == b'.'
+    assert (yield from host.request(b'v', 1)) == b'b'
+    # Anything but a confirmation goes back to the old rate.
+    assert (yield from host.request(b'B' + step(2000000), 1)) == b'.'
+    host.rate = 2000000
+    assert (yield from host.request(b'v', 0)) == b''
+    host.rate = 2400000
+    assert (yield from host.request(b'v', 1)) == b'b'
+
+def _run_test(test, name):
+    platform = _TestPlatform()
+    dut = Top(platform)
+    host = _TestHost(platform.serial)
+    def run():
+        # Give the cores time to reset.
+        yield from host._wait(16)
+        yield from test(host, platform)
+        host.done = True
+    run_simulation(dut, [run(), host.monitor()],
+                   vcd_name='vcd/top-{}.vcd'.format(name))
+
+def test_channel_select():
+    _run_test(_test_channel_select, 'channel-select')
+
+def test_transact_flags():
+    _run_test(_test_transact_flags, 'transact-flags')
+
+def test_baud_switch():
+    _run_test(_test_baud_switch, 'baud-switch')
+
+
 def main():
     plat = icestick.Platform()
     debugpins = [119, 118, 117, 116, 115, 114, 113, 112]
@@ -414,6 +1145,16 @@ def main():
             Subsignal('tclk', Pins('47')),
             IOStandard('LVCMOS33'),
         ),
+        # Second target on the PMOD connector.
+        ('sio', 1,
+            Subsignal('rst', Pins('78')),
+            Subsignal('txd', Pins('79')),
+            Subsignal('rxd', Pins('80')),
+            Subsignal('sclk', Pins('81')),
+            Subsignal('busy', Pins('87')),
+            Subsignal('tclk', Pins('88')),
+            IOStandard('LVCMOS33'),
+        ),
     ] + [
         ('debug', i, Pins(str(p)), IOStandard('LVCMOS33')) for i, p in enumerate(debugpins)
     ])
@@ -26,6 +26,45 @@
 from migen import Module, Signal, If, FSM, NextState, Cat, NextValue
 from migen.genlib.fifo import SyncFIFOBuffered
 
+# Fractional bits of baud generator steps.
+STEP_BITS = 16
+
+
+def baud_step(clk_freq, baud_rate):
+    """
+    Returns the baud generator step for baud_rate: the fraction of a bit
+    that passes every clock cycle, in 1/2**STEP_BITS.
+    """
+    return (baud_rate * 2**STEP_BITS + clk_freq // 2) // clk_freq
+
+
+class BaudGenerator(Module):
+    """
+    Fractional baud generator. Advances a phase by step every clock cycle
+    and strobes when it wraps, at the end of every bit. Bits are a whole
+    number of cycles long, but average out to the exact rate, so rates
+    that don't divide the clock frequency work too.
+    """
+    def __init__(self, step):
+        self.phase = Signal(STEP_BITS)
+        self.strobe = Signal()
+        # Load load_phase instead of advancing.
+        self.load = Signal()
+        self.load_phase = Signal(STEP_BITS)
+
+        carry = Signal(STEP_BITS + 1)
+        self.comb += [
+            carry.eq(self.phase + step),
+            self.strobe.eq(carry[STEP_BITS] & ~self.load),
+        ]
+        self.sync += \
+                If(self.load,
+                    self.phase.eq(self.load_phase)
+                ).Else(
+                    self.phase.eq(carry[:STEP_BITS])
+                )
+
+
 class RX(Module):
     def __init__(self, clk_freq, baud_rate):
         self.data = Signal(8)
@@ -33,61 +72,96 @@ class RX(Module):
         self.ack = Signal()
         self.error = Signal()
         self.rx = Signal(reset=1)
+        # Baud generator step (see baud_step), can be changed at runtime.
+        self.step = Signal(STEP_BITS, reset=baud_step(clk_freq, baud_rate))
+
+        # Register rx because metastability, keep the two samples before
+        # the current one for a majority vote.
+        rx_meta = Signal(reset=1)
+        rx_sync = Signal(reset=1)
+        samples = Signal(2, reset=0b11)
+        self.sync += [
+            rx_meta.eq(self.rx),
+            rx_sync.eq(rx_meta),
+            samples.eq(Cat(rx_sync, samples[0])),
+        ]
+        bit = Signal()
+        self.comb += bit.eq(
+            (samples[0] & samples[1]) |
+            (samples[0] & rx_sync) |
+            (samples[1] & rx_sync)
+        )
 
-        divisor = clk_freq // baud_rate
+        # Start the baud generator half a bit in on the start bit edge, so
+        # that it strobes about a cycle after the middle of every bit, with
+        # the three samples around the middle in.
+        self.submodules.baud = BaudGenerator(self.step)
+        self.rx_strobe = self.baud.strobe
+        self.comb += self.baud.load_phase.eq(2**(STEP_BITS-1))
 
-        rx_counter = Signal(max=divisor)
-        self.rx_strobe = Signal()
-        self.comb += self.rx_strobe.eq(rx_counter == 0)
-        self.sync += \
-                If(rx_counter == 0,
-                    rx_counter.eq(divisor - 1)
-                ).Else(
-                    rx_counter.eq(rx_counter - 1)
-                )
+        # Byte being received.
+        shift = Signal(8)
+        # Strobe when a byte was received.
+        done = Signal()
 
         self.rx_bitno = Signal(3)
         self.submodules.rx_fsm = FSM(reset_state='IDLE')
         self.rx_fsm.act('IDLE',
-            If(~self.rx,
-                NextValue(rx_counter, divisor // 2),
+            self.baud.load.eq(1),
+            If(~rx_sync,
                 NextState('START')
             )
         )
+        # Go back to IDLE if the start bit was just a glitch.
         self.rx_fsm.act('START',
             If(self.rx_strobe,
-                NextState('DATA')
+                If(bit,
+                    NextState('IDLE')
+                ).Else(
+                    NextValue(self.rx_bitno, 0),
+                    NextState('DATA')
+                )
             )
         )
         self.rx_fsm.act('DATA',
             If(self.rx_strobe,
-                NextValue(self.data, Cat(self.data[1:8], self.rx)),
+                NextValue(shift, Cat(shift[1:8], bit)),
                 NextValue(self.rx_bitno, self.rx_bitno + 1),
                 If(self.rx_bitno == 7,
                     NextState('STOP')
                 )
             )
         )
+        # Go back to IDLE in the middle of the stop bit already, so that
+        # back to back bytes don't drift.
         self.rx_fsm.act('STOP',
             If(self.rx_strobe,
-                If(~self.rx,
+                If(~bit,
                     NextState('ERROR')
                 ).Else(
-                    NextState('FULL'),
+                    done.eq(1),
+                    NextState('IDLE'),
                 )
             )
         )
-        self.rx_fsm.act('FULL',
-            self.ready.eq(1),
-            If(self.ack,
+        # Stay here until the line goes idle again, so that a framing error
+        # (e.g. from a wrong baud rate or a break) can be recovered from.
+        self.rx_fsm.act('ERROR',
+            self.error.eq(1),
+            If(rx_sync,
                 NextState('IDLE')
-            ).Elif(~self.rx,
-                NextState('ERROR')
             )
         )
-        self.rx_fsm.act('ERROR',
-            self.error.eq(1)
-        )
+
+        # Hold received byte until acked. A byte that isn't acked before
+        # the next one is received is lost.
+        self.sync += \
+                If(done,
+                    self.data.eq(shift),
+                    self.ready.eq(1),
+                ).Elif(self.ack,
+                    self.ready.eq(0),
+                )
 
 class RXFIFO(Module):
     def __init__(self, clk_freq, baud_rate):
@@ -119,36 +193,28 @@ class RXFIFO(Module):
         self.re = self.fifo.re
         self.readable = self.fifo.readable
         self.rx = self.rxcore.rx
+        self.step = self.rxcore.step
 
         self.io = { self.dout, self.re, self.readable, self.rx }
 
 
 class TXFIFO(Module):
     def __init__(self, clk_freq, baud_rate):
-        divisor = clk_freq // baud_rate
-
         self.submodules.fifo = SyncFIFOBuffered(8, 1024)
         
         self.din = self.fifo.din
         self.we = self.fifo.we
         self.writable = self.fifo.writable
         self.tx = Signal()
+        # Baud generator step (see baud_step), can be changed at runtime.
+        self.step = Signal(STEP_BITS, reset=baud_step(clk_freq, baud_rate))
+        # Whether everything written has been sent out.
+        self.idle = Signal()
         self.io = { self.din, self.we, self.fifo.writable, self.tx }
 
-        # strobe_counter counts down from divisor to 0, resets automatically=
-        # or when strobe-start is asserted.
-        strobe_counter = Signal(max=divisor)
-        strobe_start = Signal()
-        strobe = Signal()
-        self.comb += strobe.eq(strobe_counter == 0)
-        self.sync += (
-            If(strobe | strobe_start,
-                strobe_counter.eq(divisor - 1),
-            ).Else(
-                strobe_counter.eq(strobe_counter-1)
-            )
-        )
-        
+        self.submodules.baud = BaudGenerator(self.step)
+        strobe = self.baud.strobe
+
         # Main bit sender FSM.
         bit_counter = Signal(max=8)
         tx_data = Signal(8)
@@ -174,17 +240,25 @@ class TXFIFO(Module):
                 )
             )
         )
+        # Go straight on to the next byte if there is one.
         self.fsm.act('STOP',
             If(strobe,
-                NextState('IDLE'),
+                If(self.fifo.readable,
+                    NextState('START'),
+                    NextValue(tx_data, self.fifo.dout),
+                ).Else(
+                    NextState('IDLE'),
+                )
             ),
         )
 
         self.comb += [
             # FIFO readout.
-            self.fifo.re.eq(self.fsm.ongoing('IDLE')),
-            # Keep resetting the counter when in IDLE.
-            strobe_start.eq(self.fsm.ongoing('IDLE')),
+            self.fifo.re.eq(self.fsm.ongoing('IDLE') |
+                            (self.fsm.ongoing('STOP') & strobe)),
+            # Keep the baud generator at the start of a bit when in IDLE.
+            self.baud.load.eq(self.fsm.ongoing('IDLE')),
+            self.idle.eq(self.fsm.ongoing('IDLE') & ~self.fifo.readable),
             # TX line logic.
             If(self.fsm.ongoing('START'),
                 self.tx.eq(0),
@@ -251,8 +325,13 @@ def _test_loopback(dut, divisor):
 
 
 def _test_rx(dut, divisor):
+    # Time in cycles, bits of fractional length get spread over whole
+    # cycles.
+    now = [0.0]
     def tick(cb=None):
-        for _ in range(divisor):
+        start = int(round(now[0]))
+        now[0] += divisor
+        for _ in range(int(round(now[0])) - start):
             if cb is not None:
                 yield from cb()
             else:
@@ -318,14 +397,21 @@ def _test_rx(dut, divisor):
     print('Sending "{}" to RX'.format(text))
     for c in text:
         yield from byte(ord(c), getbyte)
+    # Idle for a bit, the receiver is a few cycles behind the line.
+    yield from bit(1, getbyte)
     received = ''.join(chr(c) for c in out)
     print('Received: "{}"'.format(received))
     assert received == text
 
 
 def _test_rx_fifo(dut, divisor):
+    # Time in cycles, bits of fractional length get spread over whole
+    # cycles.
+    now = [0.0]
     def tick(cb=None):
-        for _ in range(divisor):
+        start = int(round(now[0]))
+        now[0] += divisor
+        for _ in range(int(round(now[0])) - start):
             if cb is not None:
                 yield from cb()
             else:
@@ -367,15 +453,38 @@ def _test_rx_fifo(dut, divisor):
     print('Received: "{}"'.format(received))
     assert received == text
 
+    # Hold the line low for a while (framing error), make sure the receiver
+    # picks up again once it goes idle.
+    yield dut.re.eq(0)
+    yield from bits([0] * 20)
+    yield from bits([1, 1])
+    yield from byte(0x42)
+    yield from bits([1, 1])
+    assert (yield dut.readable) == 1
+    assert (yield dut.dout) == 0x42
+
+
+def _test_step(dut, clk_freq, baud_rate):
+    # Switch both sides to another rate at runtime.
+    step = baud_step(clk_freq, baud_rate)
+    yield dut.rx.step.eq(step)
+    yield dut.tx.step.eq(step)
+    yield from _test_loopback(dut, clk_freq/baud_rate)
+
 
 from migen.fhdl import verilog
 
+# Host link rates to prove the UART at, on the real clock: the rate the
+# adapter starts at and fast ones, including some that don't divide the
+# clock frequency.
+FAST_RATES = [1200000, 2000000, 2500000, 2666667, 3000000]
+
 def test_tx():
     # Real values divided by 100 to make for a faster test.
     clk_freq = 12000000//100
     baud_rate = 921600//100
     dut = TXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
-    run_simulation(dut, _test_tx_fifo(dut, clk_freq//baud_rate), vcd_name='vcd/uart-tx-fifo.vcd')
+    run_simulation(dut, _test_tx_fifo(dut, clk_freq/baud_rate), vcd_name='vcd/uart-tx-fifo.vcd')
 
 def test_rx():
     # Real values divided by 100 to make for a faster test.
@@ -383,21 +492,46 @@ def test_rx():
     baud_rate = 921600//100
     dut = RX(clk_freq=clk_freq, baud_rate=baud_rate)
     dut.clock_domains.cd_sys = ClockDomain('sys')
-    run_simulation(dut, _test_rx(dut, clk_freq//baud_rate), vcd_name='vcd/uart-rx.vcd')
+    run_simulation(dut, _test_rx(dut, clk_freq/baud_rate), vcd_name='vcd/uart-rx.vcd')
 
     dut = RXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
-    run_simulation(dut, _test_rx_fifo(dut, clk_freq//baud_rate), vcd_name='vcd/uart-rx-fifo.vcd')
+    run_simulation(dut, _test_rx_fifo(dut, clk_freq/baud_rate), vcd_name='vcd/uart-rx-fifo.vcd')
+
+def test_rx_fast():
+    clk_freq = 12000000
+    for baud_rate in FAST_RATES:
+        # Sender 1% slow, exact and 1% fast.
+        for error in [-0.01, 0, 0.01]:
+            divisor = clk_freq / (baud_rate * (1 + error))
+            name = 'uart-rx-{}{:+.0f}'.format(baud_rate, error * 100)
+            dut = RX(clk_freq=clk_freq, baud_rate=baud_rate)
+            dut.clock_domains.cd_sys = ClockDomain('sys')
+            run_simulation(dut, _test_rx(dut, divisor), vcd_name='vcd/{}.vcd'.format(name))
+
+            dut = RXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
+            run_simulation(dut, _test_rx_fifo(dut, divisor), vcd_name='vcd/{}-fifo.vcd'.format(name))
+
+class _Loopback(Module):
+    def __init__(self, clk_freq, baud_rate):
+        self.submodules.rx = RXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
+        self.submodules.tx = TXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
+        self.comb += self.rx.rx.eq(self.tx.tx)
 
 def test_loopback():
     clk_freq = 12000000//100
     baud_rate = 921600//100
-    class _Top(Module):
-        def __init__(self):
-            self.submodules.rx = RXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
-            self.submodules.tx = TXFIFO(clk_freq=clk_freq, baud_rate=baud_rate)
-            self.comb += self.rx.rx.eq(self.tx.tx)
-    dut = _Top()
-    run_simulation(dut, _test_loopback(dut, clk_freq//baud_rate), vcd_name='vcd/uart-loopback.vcd')
+    dut = _Loopback(clk_freq, baud_rate)
+    run_simulation(dut, _test_loopback(dut, clk_freq/baud_rate), vcd_name='vcd/uart-loopback.vcd')
+
+    clk_freq = 12000000
+    for baud_rate in FAST_RATES:
+        dut = _Loopback(clk_freq, baud_rate)
+        run_simulation(dut, _test_loopback(dut, clk_freq/baud_rate), vcd_name='vcd/uart-loopback-{}.vcd'.format(baud_rate))
+
+def test_step():
+    clk_freq = 12000000
+    dut = _Loopback(clk_freq, 1200000)
+    run_simulation(dut, _test_step(dut, clk_freq, 3000000), vcd_name='vcd/uart-step.vcd')
 
 import sys
 
@@ -410,12 +544,15 @@ def verilog_gen():
 
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        sys.argv += ['test_tx', 'test_rx', 'test_loopback']
+        sys.argv += ['test_tx', 'test_rx', 'test_rx_fast', 'test_loopback',
+                     'test_step']
 
     actions = {
         'test_tx': test_tx,
         'test_rx': test_rx,
         'test_loopback': test_loopback,
+        'test_rx_fast': test_rx_fast,
+        'test_step': test_step,
         'verilog': verilog,
     }
 
@@ -26,6 +26,8 @@
 """Implementation of adapter protocol."""
 __author__ = "Serge 'q3k' Bazanski <serge@bazanski.pl>"
 
+import binascii
+import copy
 import logging
 import struct
 import sys
@@ -33,17 +35,130 @@ import time
 
 import serial
 
+import timings
+import tracefile
+
 
 class AdapterException(Exception):
     pass
 
 
+class CheckDataException(AdapterException):
+    """A transaction result did not match its check data."""
+    pass
+
+
+def crc32(data):
+    """Returns the check data the adapter computes for a result."""
+    return binascii.crc32(data) & 0xffffffff
+
+
+class Link(object):
+    """State of the host link, shared by all channel handles of an adapter."""
+
+    def __init__(self, baud_rate):
+        # Baud rate the host link runs at.
+        self.baud_rate = baud_rate
+        # Channel that requests apply to, None until selected.
+        self.channel = None
+        # Channels with non-blocking handles (see aio), bytes those received
+        # but did not read yet, whether one of them is waiting for a
+        # response, and those waiting to send a request, in order.
+        self.async_channels = set()
+        self.buffer = ''
+        self.busy = False
+        self.waiting = []
+
+
 class Adapter(object):
+    """
+    Handle of one SIO channel of an adapter. Adapter(port) opens the host
+    link and handles channel 0, channel(index) returns handles of the other
+    channels on the same link.
+
+    Handles select their channel before each request, so requests of
+    different handles may be interleaved, but not while results of pipelined
+    or started transactions (see pipeline and start) are still to be read.
+    """
     TIMEOUT = 3.0
+    # Bitstream API version this host code speaks.
+    VERSION = 11
+    # Adapter clock frequency.
+    CLKFREQ = 12000000
+    # Host link baud rate the adapter starts at, and goes back to on a break.
+    BAUD_RATE = 1200000
+    # Fractional bits of the adapter's host UART baud generator step, and
+    # the largest step (3 Mbaud) it can work with.
+    STEP_BITS = 16
+    MAX_STEP = 2**14
+    # Host link baud rates to try when tuning, slowest first. All of them
+    # are exact on the FT2232H.
+    BAUD_RATES = [1200000, 1500000, 2000000, 2400000, 2666667, 3000000]
+    # How long to hold the host link low for a break.
+    BREAK_TIME = 0.25
+    # Size of the echo test pattern when tuning the baud rate.
+    ECHO_PATTERN_SIZE = 4096
+    # Number of SIO channels (targets) of the adapter.
+    CHANNELS = 2
+    # Depth of the command FIFO in the adapter.
+    FIFO_SIZE = 512
+    # Result length bits of transact requests asking for check data, for
+    # only check data instead of the result, and for results that are all
+    # 0xFF to be left out.
+    CHECK_FLAG = 0x8000
+    DROP_FLAG = 0x4000
+    BLANK_FLAG = 0x2000
+    # Maximum length of a sweep command template.
+    SWEEP_TEMPLATE_SIZE = 32
+    # Busy timer value of a sweep transaction after which the target did not
+    # go busy.
+    SWEEP_TIMEOUT = 0xffffffff
+    # Time to wait for the results of a single sweep round.
+    SWEEP_ROUND_TIMEOUT = 30.0
 
-    def __init__(self, port, baud_rate=1200000, logger=None):
-        self.serial = serial.Serial(port, baud_rate, timeout=self.TIMEOUT)
+    def __init__(self, port, baud_rate=BAUD_RATE, logger=None, tracer=None,
+                 device=None, timings=None):
+        """
+        Args:
+            port: Adapter serial port.
+            baud_rate: Host link baud rate.
+            logger: Logger for bytes sent to and received from the adapter.
+            tracer: tracefile.TraceWriter to record bytes sent to and
+                received from the adapter to.
+            device: Serial port-like object to use instead of opening port.
+            timings: timings.Timings to record request latencies to, by
+                opcode and by phase of execute and busy_timer.
+        """
+        if device is None:
+            device = serial.Serial(port, baud_rate, timeout=self.TIMEOUT)
+        self.serial = device
         self.logger = logger
+        self.tracer = tracer
+        self.timings = timings
+        self.link = Link(baud_rate)
+        self.index = 0
+        # Last set target clock and serial clock counters (bitstream defaults
+        # until set).
+        self.tclk = 4
+        self.sclk = 1023
+        # Whether transaction results are checked against check data (a
+        # CRC-32 of the result computed by the adapter), see
+        # CheckDataException.
+        self.check_data = False
+        # Whether the adapter leaves out transaction results that are all
+        # 0xFF (e.g. erased flash pages), saying so in a byte instead. The
+        # results are still returned as read.
+        self.skip_blank = False
+
+    def channel(self, index):
+        """Returns a handle of channel index, on the same host link."""
+        if not 0 <= index < self.CHANNELS:
+            raise AdapterException("No channel {}.".format(index))
+        res = copy.copy(self)
+        res.index = index
+        res.tclk = 4
+        res.sclk = 1023
+        return res
 
     def _log(self, msg):
         if self.logger is None:
@@ -51,14 +166,34 @@ class Adapter(object):
         self.logger.info(msg)
 
     def _write(self, data):
-        self._log("Host -> FPGA {}".format(`data`))
+        # Check before formatting, this is on every path to the adapter.
+        if self.logger is not None:
+            self._log("Host -> FPGA {}".format(`data`))
+        if self.tracer is not None:
+            self.tracer.frame(tracefile.HOST_TO_ADAPTER, data)
         return self.serial.write(data)
 
     def _read(self, l):
         data = self.serial.read(l)
-        self._log("Host <- FPGA {}".format(`data`))
+        self._received(data)
         return data
 
+    def _received(self, data):
+        """Logs and traces bytes read from the adapter."""
+        if self.logger is not None:
+            self._log("Host <- FPGA {}".format(`data`))
+        if self.tracer is not None:
+            self.tracer.frame(tracefile.ADAPTER_TO_HOST, data)
+
+    def _clock(self):
+        if self.timings is None:
+            return 0
+        return timings.clock()
+
+    def _record(self, name, start):
+        if self.timings is not None:
+            self.timings.add(name, timings.clock() - start)
+
     def _read_byte(self):
         res = self._read(1)
         if not res:
@@ -73,20 +208,34 @@ class Adapter(object):
             raise AdapterException("Timed out.")
 
     def connect(self):
-        """Ensures the adapter is connected."""
-        version = self.version()
-        if version != 0:
+        """
+        Ensures the adapter is connected. If it doesn't respond (e.g. because
+        an earlier run left it at another baud rate), resets the host link
+        with a break and tries again.
+        """
+        try:
+            version = self.version()
+        except AdapterException:
+            version = None
+        if version != self.VERSION:
+            self._log("Adapter not responding, resetting host link.")
+            self.reset_link()
+            version = self.version()
+        if version != self.VERSION:
             raise AdapterException("Unexpected adapter version: {}"
                     .format(version))
 
     def version(self):
         """Returns version of FPGA bitstream API."""
+        start = self._clock()
         self._write('v')
         data = self._read(1)
+        self._record('v', start)
         if not data:
-            return AdapterException("Adapter did not respond with version.")
+            raise AdapterException("Adapter did not respond with version.")
         try:
-            return int(data)
+            # Hexadecimal digit, for versions past 9.
+            return int(data, 16)
         except ValueError:
             raise AdapterException("Invalid adapter version: {:02x}"
                     .format(ord(data)))
@@ -96,30 +245,69 @@ class Adapter(object):
         if self._read(1) != '.':
             raise AdapterException("No ACK from adapter.")
 
+    def _select(self):
+        """Makes following requests apply to the channel of this handle."""
+        if self.link.channel == self.index:
+            return
+        start = self._clock()
+        self._write('C' + chr(self.index))
+        self._check_ack()
+        self._record('C', start)
+        self.link.channel = self.index
+
     def reset_target(self):
         """Resets the target MCU."""
+        self._select()
+        start = self._clock()
         self._write('r')
-        return self._check_ack()
+        self._check_ack()
+        self._record('r', start)
     
     def flush(self):
         """Flushes (drops) the adapter FIFOs."""
+        self._select()
+        start = self._clock()
         self._write('f')
-        return self._check_ack()
+        self._check_ack()
+        self._record('f', start)
     
     def busy_timer(self):
         """Waits until the busy timer stops running, returns it value."""
+        self._select()
+        wait_start = self._clock()
         while True:
+            start = self._clock()
             self._write('T')
-            if self._read_byte() == 's':
+            status = self._read_byte()
+            self._record('T', start)
+            if status == 's':
                 break
+        self._record('busy_timer:wait', wait_start)
+        start = self._clock()
         self._write('t')
-        return self._read_word()
+        timer = self._read_word()
+        self._record('t', start)
+        return timer
+
+    def _fifo_write(self, data):
+        """Writes a block of bytes into the adapter command FIFO."""
+        if len(data) > self.FIFO_SIZE:
+            raise AdapterException("Block of {} bytes does not fit in FIFO."
+                    .format(len(data)))
+        self._select()
+        start = self._clock()
+        self._write('b' + struct.pack('<H', len(data)) + data)
+        self._check_ack()
+        self._record('b', start)
 
     def _fifo_read(self, count):
+        self._select()
+        start = self._clock()
         self._write('R' + struct.pack('<I', count))
         data = self._read(count)
         if len(data) != count:
             raise AdapterException("Adapter stopped responding.")
+        self._record('R', start)
         return data
 
     def execute(self, command, result_size):
@@ -136,29 +324,394 @@ class Adapter(object):
         Raises:
             AdapterException: If there was an issue with the adapter.
         """
+        start = self._clock()
         self.flush()
+        self._record('execute:flush', start)
         # We need to fill the FIFO with the command + enough 0xFFs to read the
         # resulting data.
-        data = command + ('\xff' * result_size)
-        # Send 64 bytes at a time and batch read acks (for speed):
-        for i in range(0, len(data), 64):
-            block = data[i:i+64]
-            buf = ''.join("w" + c for c in block)
-            self._write(buf)
-            acks = self._read(len(block))
-            if any(a != '.' for a in acks):
-                raise AdapterException("No ACK from adapter.")
+        start = self._clock()
+        self._fifo_write(command + ('\xff' * result_size))
+        self._record('execute:fill', start)
 
         # Tell adapter to perform transaction.
+        self._select()
+        start = self._clock()
         self._write('W')
         self._check_ack()
+        self._record('W', start)
 
         # Read back all the bytes that we received when transmitting the
         # command and throw them away.
+        start = self._clock()
         self._fifo_read(len(command))
+        self._record('execute:echo', start)
 
         # Return response bytes.
-        return self._fifo_read(result_size)
+        start = self._clock()
+        data = self._fifo_read(result_size)
+        self._record('execute:result', start)
+        return data
+
+    def transact(self, command, result_size):
+        """
+        Executes a command via Standard Serial I/O in one round trip.
+
+        The adapter flushes its FIFOs, loads the command, pads it with 0xFFs,
+        performs the transaction and drops the echoed command bytes by
+        itself, so only the result is sent back.
+
+        Args:
+            command: String containing command bytes.
+            result_size: Size of the result to read.
+
+        Returns:
+            String containing result_size bytes.
+
+        Raises:
+            AdapterException: If there was an issue with the adapter.
+        """
+        start = self._clock()
+        self._transact_request('x', command, result_size)
+        self._check_ack()
+        data = self._transact_result(result_size)
+        self._record('x', start)
+        return data
+
+    def check(self, command, result_size):
+        """
+        Executes a command like transact, but has the adapter send only
+        check data of the result (see crc32) instead of the result.
+
+        Returns:
+            Check data of the result_size result bytes, as an integer.
+        """
+        start = self._clock()
+        self._transact_request('x', command, result_size, check_only=True)
+        self._check_ack()
+        check = self._transact_result(result_size, check_only=True)
+        self._record('x:check', start)
+        return check
+
+    def pipeline(self, requests, depth=2, check_only=False):
+        """
+        Executes commands like transact, keeping several in flight.
+
+        Up to depth requests are sent to the adapter before the result of the
+        first one is read back, so the link and the target are not left idle
+        during host round trips.
+
+        Args:
+            requests: Iterable of (command, result_size) tuples.
+            depth: Maximum number of requests awaiting results.
+            check_only: Whether to get check data of results instead, like
+                check.
+
+        Yields:
+            String containing result_size bytes (or check data) for every
+            request, in order.
+
+        Raises:
+            AdapterException: If there was an issue with the adapter.
+        """
+        if depth < 1:
+            raise AdapterException("Invalid pipeline depth.")
+        pending = []
+        try:
+            for command, result_size in requests:
+                if len(pending) == depth:
+                    yield self._pipeline_result(pending.pop(0), check_only)
+                self._transact_request('x', command, result_size, check_only)
+                pending.append(result_size)
+            while pending:
+                yield self._pipeline_result(pending.pop(0), check_only)
+        except (GeneratorExit, CheckDataException):
+            # Don't leave results of requests in flight on the link if the
+            # caller stopped early or is going to retry.
+            self._drain_pipeline(pending, check_only)
+            raise
+        except Exception:
+            # The adapter may have stopped responding, and reading results
+            # would wait out every request in flight. Drop them instead.
+            if pending:
+                self.reset_link()
+            raise
+
+    def _drain_pipeline(self, pending, check_only):
+        """Reads and drops results of pipelined requests still in flight."""
+        try:
+            for result_size in pending:
+                try:
+                    self._pipeline_result(result_size, check_only)
+                except CheckDataException:
+                    pass
+        except AdapterException:
+            self.reset_link()
+
+    def _pipeline_result(self, result_size, check_only):
+        # Only the wait for the result, the request went out earlier.
+        start = self._clock()
+        self._check_ack()
+        data = self._transact_result(result_size, check_only)
+        self._record('x:pipelined', start)
+        return data
+
+    def timed_transact(self, command, result_size):
+        """
+        Executes a command like transact, then measures the busy time.
+
+        The adapter waits for the target to go busy after the last command
+        byte and for the busy timer to stop before responding.
+
+        Returns:
+            Tuple of busy timer value and string containing result_size
+            bytes.
+
+        Raises:
+            AdapterException: If there was an issue with the adapter, or the
+                target did not go busy.
+        """
+        start = self._clock()
+        self._transact_request('X', command, result_size)
+        self._check_ack()
+        timer = self._read_word()
+        data = self._transact_result(result_size)
+        self._record('X', start)
+        return timer, data
+
+    def start(self, command, result_size):
+        """
+        Starts executing a command like transact, without waiting for it.
+
+        The adapter is free to take requests for other channels while the
+        transaction runs. Its result is read with finish or timed_finish.
+
+        Raises:
+            AdapterException: If there was an issue with the adapter.
+        """
+        start = self._clock()
+        self._transact_request('q', command, result_size)
+        self._check_ack()
+        self._record('q', start)
+
+    def finish(self, result_size):
+        """
+        Waits for the transaction started last on this channel.
+
+        Returns:
+            String containing result_size bytes.
+        """
+        self._select()
+        start = self._clock()
+        self._write('k')
+        self._check_ack()
+        data = self._transact_result(result_size)
+        self._record('k', start)
+        return data
+
+    def timed_finish(self, result_size):
+        """
+        Waits for the transaction started last on this channel like
+        finish, then measures the busy time like timed_transact.
+
+        Returns:
+            Tuple of busy timer value and string containing result_size
+            bytes.
+        """
+        self._select()
+        start = self._clock()
+        self._write('K')
+        self._check_ack()
+        timer = self._read_word()
+        data = self._transact_result(result_size)
+        self._record('K', start)
+        return timer, data
+
+    def sweep(self, template, offset, rounds):
+        """
+        Executes timed transactions for every value of one command byte.
+
+        The adapter sends the template with the byte at offset replaced by
+        every value from 0 to 255 in turn, measuring the busy time after
+        each, and repeats that for the given number of rounds.
+
+        Args:
+            template: String containing command bytes.
+            offset: Index of the byte in template to sweep.
+            rounds: Number of times to sweep all values, 1 to 255.
+
+        Returns:
+            List of rounds, each a list of 256 busy timer values indexed by
+            byte value. Transactions after which the target did not go busy
+            have a value of SWEEP_TIMEOUT.
+
+        Raises:
+            AdapterException: If there was an issue with the adapter.
+        """
+        if len(template) > self.SWEEP_TEMPLATE_SIZE:
+            raise AdapterException("Sweep template too long.")
+        if not 0 <= offset < len(template):
+            raise AdapterException("Sweep offset outside of template.")
+        if not 0 < rounds < 256:
+            raise AdapterException("Invalid sweep round count.")
+        self._select()
+        start = self._clock()
+        self._write('c' + struct.pack('<BBB', len(template), offset, rounds) +
+                    template)
+
+        results = []
+        timeout = self.serial.timeout
+        self.serial.timeout = self.SWEEP_ROUND_TIMEOUT
+        try:
+            for _ in range(rounds):
+                data = self._read(256 * 4)
+                if len(data) != 256 * 4:
+                    raise AdapterException("Adapter stopped responding.")
+                results.append(list(struct.unpack('<256I', data)))
+                # Per round, sweeps with more rounds just take longer.
+                self._record('c', start)
+                start = self._clock()
+        finally:
+            self.serial.timeout = timeout
+        return results
+
+    def _transact_request(self, opcode, command, result_size,
+                          check_only=False):
+        if len(command) > self.FIFO_SIZE or result_size > self.FIFO_SIZE:
+            raise AdapterException("Transaction does not fit in FIFOs.")
+        if check_only:
+            result_size |= self.CHECK_FLAG | self.DROP_FLAG
+        else:
+            if self.check_data:
+                result_size |= self.CHECK_FLAG
+            if self.skip_blank:
+                result_size |= self.BLANK_FLAG
+        self._select()
+        self._write(opcode + struct.pack('<HH', len(command), result_size) +
+                    command)
+
+    def _transact_result(self, result_size, check_only=False):
+        if check_only:
+            check = self._read(4)
+            if len(check) != 4:
+                raise AdapterException("Adapter stopped responding.")
+            return struct.unpack('<I', check)[0]
+        if self.skip_blank and self._blank_result():
+            data = '\xff' * result_size
+        else:
+            data = self._read(result_size)
+        if len(data) != result_size:
+            raise AdapterException("Adapter stopped responding.")
+        if self.check_data:
+            self._check_result(data, self._read(4))
+        return data
+
+    def _blank_result(self):
+        """Reads whether the adapter left out a result for being blank."""
+        blank = self._read(1)
+        if blank not in ('\x00', '\x01'):
+            raise AdapterException("Adapter stopped responding.")
+        return blank == '\x01'
+
+    def _check_result(self, data, check):
+        """Checks a transaction result against its check data."""
+        if len(check) != 4:
+            raise AdapterException("Adapter stopped responding.")
+        if struct.unpack('<I', check)[0] != crc32(data):
+            raise CheckDataException("Result does not match check data.")
+
+    def reset_link(self):
+        """
+        Sends a break, which gets the adapter back to BAUD_RATE and out of
+        whatever request it was in the middle of, and drops what it sent.
+        """
+        self._set_host_baud_rate(self.BAUD_RATE)
+        self.serial.send_break(self.BREAK_TIME)
+        self.serial.reset_input_buffer()
+        # The break also resets channel selection and clock settings.
+        self.link.channel = None
+        self.tclk = 4
+        self.sclk = 1023
+
+    def _set_host_baud_rate(self, rate):
+        self.serial.baudrate = rate
+        self.link.baud_rate = rate
+
+    def set_baud_rate(self, rate):
+        """
+        Switches the host link to rate. The adapter's baud generator gets
+        within 0.02% of any rate up to 3 Mbaud. The adapter goes back to the
+        old rate if it doesn't hear from the host at the new one.
+
+        Returns:
+            The baud rate switched to.
+
+        Raises:
+            AdapterException: If the adapter can't do rate or the switch
+                failed.
+        """
+        step = int(round(float(rate) * 2**self.STEP_BITS / self.CLKFREQ))
+        if not 0 < step <= self.MAX_STEP:
+            raise AdapterException("Baud rate {} out of range.".format(rate))
+        old_rate = self.link.baud_rate
+        start = self._clock()
+        self._write('B' + struct.pack('<H', step))
+        if self._read(1) != '.':
+            raise AdapterException("Adapter refused baud rate {}."
+                                   .format(rate))
+        # Confirm at the new rate.
+        self._set_host_baud_rate(rate)
+        self._write('B')
+        if self._read(1) != '.':
+            self._set_host_baud_rate(old_rate)
+            self.serial.reset_input_buffer()
+            raise AdapterException("Switching to baud rate {} failed."
+                                   .format(rate))
+        self._record('B', start)
+        return rate
+
+    def echo(self, data):
+        """Has the adapter send data back, returns what it sent."""
+        if len(data) > 0xffff:
+            raise AdapterException("Echo of {} bytes too long."
+                                   .format(len(data)))
+        start = self._clock()
+        self._write('e' + struct.pack('<H', len(data)) + data)
+        res = self._read(len(data))
+        self._record('e', start)
+        return res
+
+    def tune_baud_rate(self, rates=None):
+        """
+        Steps the host link up through rates (default BAUD_RATES), checking
+        every rate by having the adapter echo a test pattern, and settles on
+        the fastest rate that passed. Rates from the first failing one on
+        aren't tried.
+
+        Returns:
+            The baud rate settled on.
+        """
+        pattern = str(bytearray(i % 256 for i in range(self.ECHO_PATTERN_SIZE)))
+        best = self.link.baud_rate
+        for rate in rates or self.BAUD_RATES:
+            if rate <= best:
+                continue
+            try:
+                ok = (self.set_baud_rate(rate) == rate and
+                      self.echo(pattern) == pattern)
+            except AdapterException:
+                ok = False
+            self._log("Baud rate {}: {}".format(rate, "ok" if ok else
+                                                 "failed"))
+            if not ok:
+                # Don't trust the link after a failure, the adapter may have
+                # switched even if the host didn't see it confirm. Start over
+                # from a known state.
+                self.reset_link()
+                if best != self.BAUD_RATE:
+                    self.set_baud_rate(best)
+                break
+            best = rate
+        return best
 
     def set_tclk(self, val):
         """Sets target clock counter.
@@ -172,11 +725,19 @@ class Adapter(object):
            11: 500 KHz
         """
 
+        self._select()
+        start = self._clock()
         self._write('s' + chr(val))
         self._check_ack()
+        self._record('s', start)
+        self.tclk = val
 
     def set_sclk(self, val):
         """Sets adapter serial clock counter."""
+        self._select()
+        start = self._clock()
         self._write('S' + struct.pack('<H', val))
         self._check_ack()
+        self._record('S', start)
+        self.sclk = val
 
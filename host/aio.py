@@ -0,0 +1,558 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Non-blocking adapter and Serial I/O API.
+
+Python 2 has no asyncio, so this comes with a small event loop running
+generator based coroutines instead. A coroutine yields:
+ - another coroutine, to run it and get its result,
+ - a Read, to wait for bytes from an adapter,
+ - an Acquire, to wait for the host link of an adapter to be free,
+ - a Task, to wait for it to finish and get its result,
+ - None, to let other tasks run.
+and returns a value by raising Return. For example:
+
+    def dump(s, f):
+        for page in range(0xe00, 0x1000):
+            data = yield s.read_page(page)
+            f.write(data)
+
+    loop = aio.Loop()
+    loop.run_until_complete(dump(aio.AsyncSerialIO(s), f))
+
+Reads from all adapters are multiplexed with select, so several adapters
+and any computation between reads share one thread. Channels of one adapter
+share its host link, so their requests take turns, but the transactions
+they start run at the same time.
+"""
+
+import select
+import struct
+import sys
+import types
+
+import adapter
+import timings
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Read(object):
+    """
+    Waits for count bytes from an AsyncAdapter. Results in fewer bytes if
+    they didn't come within timeout seconds.
+    """
+
+    def __init__(self, source, count, timeout):
+        self.source = source
+        self.count = count
+        self.deadline = timings.clock() + timeout
+
+    def ready(self, now):
+        return len(self.source.buffer) >= self.count or now >= self.deadline
+
+    def take(self):
+        data = self.source.buffer[:self.count]
+        self.source.buffer = self.source.buffer[self.count:]
+        return data
+
+
+class Acquire(object):
+    """
+    Waits for the host link of an AsyncAdapter, then holds it. The link is
+    handed out in the order it was asked for, so that a task letting go of
+    it can't take it right back while others are waiting.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        source.adapter.link.waiting.append(self)
+
+    def ready(self, now):
+        link = self.source.adapter.link
+        return not link.busy and link.waiting[0] is self
+
+    def take(self):
+        link = self.source.adapter.link
+        link.waiting.remove(self)
+        link.busy = True
+
+    def cancel(self):
+        """Stops waiting, for tasks that won't be resumed."""
+        self.source.adapter.link.waiting.remove(self)
+
+
+class Task(object):
+    """A coroutine running in a Loop."""
+
+    def __init__(self, coroutine):
+        # Coroutines that called each other, innermost last.
+        self.stack = [coroutine]
+        # Value or exception info to resume the innermost coroutine with.
+        self.value = None
+        self.exc_info = None
+        # Read, Acquire or Task being waited for.
+        self.waiting = None
+        self.done = False
+        self.result = None
+
+
+class Loop(object):
+    """Runs tasks until they wait for bytes, waits for bytes with select."""
+
+    def __init__(self):
+        self.tasks = []
+
+    def spawn(self, coroutine):
+        """Starts running coroutine in the loop, returns its Task."""
+        task = Task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    def _resume(self, task):
+        """Resumes task if what it waits for is there, returns if it was."""
+        waiting = task.waiting
+        if isinstance(waiting, (Read, Acquire)):
+            if not waiting.ready(timings.clock()):
+                return False
+            task.value = waiting.take()
+        elif isinstance(waiting, Task):
+            if not waiting.done:
+                return False
+            task.value = waiting.result
+        task.waiting = None
+        return True
+
+    def _step(self, task):
+        """Runs task until it waits for something or finishes."""
+        while True:
+            coroutine = task.stack[-1]
+            try:
+                if task.exc_info is not None:
+                    exc_info, task.exc_info = task.exc_info, None
+                    yielded = coroutine.throw(*exc_info)
+                else:
+                    value, task.value = task.value, None
+                    yielded = coroutine.send(value)
+            except Return as e:
+                result = e.value
+            except StopIteration:
+                result = None
+            except Exception:
+                task.stack.pop()
+                if not task.stack:
+                    raise
+                # Pass the exception on to the calling coroutine.
+                task.exc_info = sys.exc_info()
+                continue
+            else:
+                if isinstance(yielded, types.GeneratorType):
+                    task.stack.append(yielded)
+                    continue
+                if yielded is None:
+                    return
+                if not isinstance(yielded, (Read, Acquire, Task)):
+                    task.exc_info = (TypeError, TypeError(
+                        "Coroutine yielded {!r}.".format(yielded)), None)
+                    continue
+                task.waiting = yielded
+                if not self._resume(task):
+                    return
+                continue
+            task.stack.pop()
+            if not task.stack:
+                task.done = True
+                task.result = result
+                return
+            task.value = result
+
+    def _wait(self):
+        """Waits for bytes from any adapter a task is waiting for."""
+        reads = [t.waiting for t in self.tasks
+                 if isinstance(t.waiting, Read)]
+        if not reads:
+            return
+        timeout = max(0, min(r.deadline for r in reads) - timings.clock())
+        sources = set(r.source for r in reads)
+        readable, _, _ = select.select(list(sources), [], [], timeout)
+        for source in readable:
+            source.fill()
+
+    def run(self, until=None):
+        """
+        Runs tasks until until (a Task) or all tasks are done. Exceptions of
+        tasks are raised from here.
+        """
+        try:
+            self._run(until)
+        except Exception:
+            # The other tasks won't be resumed, don't keep the host link
+            # from whoever uses it next.
+            for task in self.tasks:
+                if isinstance(task.waiting, Acquire):
+                    task.waiting.cancel()
+            raise
+
+    def _run(self, until):
+        while True:
+            self.tasks = [t for t in self.tasks if not t.done]
+            if until is not None and until.done:
+                return
+            if not self.tasks:
+                return
+            progress = False
+            for task in self.tasks:
+                if task.waiting is None or self._resume(task):
+                    self._step(task)
+                    progress = True
+            if not progress:
+                self._wait()
+
+    def run_until_complete(self, coroutine):
+        """Runs coroutine (and other tasks meanwhile), returns its result."""
+        task = self.spawn(coroutine)
+        self.run(until=task)
+        return task.result
+
+    def gather(self, coroutines):
+        """Runs coroutines concurrently, returns a list of their results."""
+        tasks = [self.spawn(c) for c in coroutines]
+        for task in tasks:
+            self.run(until=task)
+        return [task.result for task in tasks]
+
+
+class AsyncAdapter(object):
+    """
+    Non-blocking counterpart of adapter.Adapter. Methods are coroutines.
+
+    Shares the serial port, logger, tracer and timings of the wrapped
+    Adapter, which can still be used between coroutines, but not while one
+    is waiting for a response. Handles of channels on the same host link
+    hold it for one request at a time, and split transactions into starting
+    and finishing them, so that the transactions of all channels overlap.
+    """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        adapter.link.async_channels.add(adapter.index)
+
+    @property
+    def buffer(self):
+        """Bytes received but not read yet, shared with the other channels."""
+        return self.adapter.link.buffer
+
+    @buffer.setter
+    def buffer(self, data):
+        self.adapter.link.buffer = data
+
+    def fileno(self):
+        return self.adapter.serial.fileno()
+
+    def fill(self):
+        """Takes bytes that arrived from the serial port."""
+        waiting = self.adapter.serial.in_waiting
+        if not waiting:
+            return
+        data = self.adapter.serial.read(waiting)
+        self.adapter._received(data)
+        self.buffer += data
+
+    def _read(self, count, timeout=None):
+        self.fill()
+        return Read(self, count, timeout or self.adapter.TIMEOUT)
+
+    def _check_ack(self):
+        ack = yield self._read(1)
+        if ack != '.':
+            raise adapter.AdapterException("No ACK from adapter.")
+
+    def _read_exactly(self, count, timeout=None):
+        data = yield self._read(count, timeout)
+        if len(data) != count:
+            raise adapter.AdapterException("Adapter stopped responding.")
+        raise Return(data)
+
+    def _exclusive(self, coroutine):
+        """Runs coroutine holding the host link, with the channel selected."""
+        a = self.adapter
+        yield Acquire(self)
+        try:
+            if a.link.channel != a.index:
+                start = a._clock()
+                a._write('C' + chr(a.index))
+                yield self._check_ack()
+                a._record('C', start)
+                a.link.channel = a.index
+            res = yield coroutine
+        finally:
+            a.link.busy = False
+        raise Return(res)
+
+    def version(self):
+        """Returns version of FPGA bitstream API."""
+        return self._exclusive(self._version())
+
+    def _version(self):
+        a = self.adapter
+        start = a._clock()
+        a._write('v')
+        data = yield self._read_exactly(1)
+        a._record('v', start)
+        try:
+            raise Return(int(data, 16))
+        except ValueError:
+            raise adapter.AdapterException("Invalid adapter version: {:02x}"
+                    .format(ord(data)))
+
+    def flush(self):
+        """Flushes (drops) the adapter FIFOs."""
+        return self._exclusive(self._flush())
+
+    def _flush(self):
+        a = self.adapter
+        start = a._clock()
+        a._write('f')
+        yield self._check_ack()
+        a._record('f', start)
+
+    def busy_timer(self):
+        """Waits until the busy timer stops running, returns it value."""
+        return self._exclusive(self._busy_timer())
+
+    def _busy_timer(self):
+        a = self.adapter
+        wait_start = a._clock()
+        while True:
+            start = a._clock()
+            a._write('T')
+            status = yield self._read_exactly(1)
+            a._record('T', start)
+            if status == 's':
+                break
+        a._record('busy_timer:wait', wait_start)
+        start = a._clock()
+        a._write('t')
+        data = yield self._read_exactly(4)
+        a._record('t', start)
+        raise Return(struct.unpack('<I', data)[0])
+
+    def execute(self, command, result_size):
+        """Same as Adapter.execute."""
+        a = self.adapter
+        if len(command) + result_size > a.FIFO_SIZE:
+            raise adapter.AdapterException("Block of {} bytes does not fit in "
+                                           "FIFO.".format(len(command) +
+                                                          result_size))
+        return self._exclusive(self._execute(command, result_size))
+
+    def _execute(self, command, result_size):
+        a = self.adapter
+        yield self._flush()
+        start = a._clock()
+        a._write('b' + struct.pack('<H', len(command) + result_size) +
+                 command + '\xff' * result_size)
+        yield self._check_ack()
+        a._record('b', start)
+        start = a._clock()
+        a._write('W')
+        yield self._check_ack()
+        a._record('W', start)
+        start = a._clock()
+        a._write('R' + struct.pack('<I', len(command)))
+        yield self._read_exactly(len(command))
+        a._write('R' + struct.pack('<I', result_size))
+        data = yield self._read_exactly(result_size)
+        a._record('R', start)
+        raise Return(data)
+
+    def _shared(self):
+        """Returns whether handles of other channels use the host link."""
+        return len(self.adapter.link.async_channels) > 1
+
+    def transact(self, command, result_size):
+        """Same as Adapter.transact."""
+        if self._shared():
+            yield self._exclusive(self._start(command, result_size))
+            data = yield self._exclusive(self._finish('k', result_size))
+        else:
+            data = yield self._exclusive(self._transact('x', command,
+                                                        result_size))
+        raise Return(data)
+
+    def check(self, command, result_size):
+        """Same as Adapter.check."""
+        if self._shared():
+            yield self._exclusive(self._start(command, result_size, True))
+            check = yield self._exclusive(self._finish('k', result_size,
+                                                       True))
+        else:
+            check = yield self._exclusive(self._transact('x', command,
+                                                         result_size, True))
+        raise Return(check)
+
+    def timed_transact(self, command, result_size):
+        """Same as Adapter.timed_transact."""
+        if self._shared():
+            yield self._exclusive(self._start(command, result_size))
+            res = yield self._exclusive(self._finish('K', result_size))
+        else:
+            res = yield self._exclusive(self._transact('X', command,
+                                                       result_size))
+        raise Return(res)
+
+    def _transact(self, opcode, command, result_size, check_only=False):
+        a = self.adapter
+        start = a._clock()
+        a._transact_request(opcode, command, result_size, check_only)
+        res = yield self._result(opcode, result_size, check_only)
+        a._record(opcode, start)
+        raise Return(res)
+
+    def _start(self, command, result_size, check_only=False):
+        a = self.adapter
+        start = a._clock()
+        a._transact_request('q', command, result_size, check_only)
+        yield self._check_ack()
+        a._record('q', start)
+
+    def _finish(self, opcode, result_size, check_only=False):
+        a = self.adapter
+        start = a._clock()
+        a._write(opcode)
+        res = yield self._result(opcode, result_size, check_only)
+        a._record(opcode, start)
+        raise Return(res)
+
+    def _result(self, opcode, result_size, check_only=False):
+        """
+        Reads the response of a transaction, timed for opcode X or K, or
+        only its check data. Blank results left out by the adapter (see
+        Adapter.skip_blank) are returned as 0xFF bytes.
+        """
+        yield self._check_ack()
+        if check_only:
+            check = yield self._read_exactly(4)
+            raise Return(struct.unpack('<I', check)[0])
+        timer = None
+        if opcode in 'XK':
+            timer = yield self._read_exactly(4)
+        blank = False
+        if self.adapter.skip_blank:
+            blank = yield self._read_exactly(1)
+            if blank not in ('\x00', '\x01'):
+                raise adapter.AdapterException("Adapter stopped responding.")
+            blank = blank == '\x01'
+        if blank:
+            data = '\xff' * result_size
+        else:
+            data = yield self._read_exactly(result_size)
+        if self.adapter.check_data:
+            check = yield self._read(4)
+            self.adapter._check_result(data, check)
+        if timer is not None:
+            raise Return((struct.unpack('<I', timer)[0], data))
+        raise Return(data)
+
+    def sweep(self, template, offset, rounds):
+        """Same as Adapter.sweep."""
+        a = self.adapter
+        if len(template) > a.SWEEP_TEMPLATE_SIZE:
+            raise adapter.AdapterException("Sweep template too long.")
+        if not 0 <= offset < len(template):
+            raise adapter.AdapterException("Sweep offset outside of template.")
+        if not 0 < rounds < 256:
+            raise adapter.AdapterException("Invalid sweep round count.")
+        return self._exclusive(self._sweep(template, offset, rounds))
+
+    def _sweep(self, template, offset, rounds):
+        a = self.adapter
+        start = a._clock()
+        a._write('c' + struct.pack('<BBB', len(template), offset, rounds) +
+                 template)
+        results = []
+        for _ in range(rounds):
+            data = yield self._read_exactly(256 * 4, a.SWEEP_ROUND_TIMEOUT)
+            results.append(list(struct.unpack('<256I', data)))
+            a._record('c', start)
+            start = a._clock()
+        raise Return(results)
+
+
+class AsyncSerialIO(object):
+    """
+    Non-blocking counterpart of serialio.SerialIO. Methods are coroutines.
+    """
+
+    def __init__(self, s):
+        self.s = s
+        self.adapter = AsyncAdapter(s.adapter)
+
+    def version(self):
+        return self.adapter.transact(self.s.CMD_VERSION, 8)
+
+    def unlock(self, code):
+        yield self.adapter.transact(self.s.CMD_UNLOCK + code, 0)
+
+    def timed_unlock(self, code):
+        """Attempts to unlock, returns the busy time of the target."""
+        timer, _ = yield self.adapter.timed_transact(self.s.CMD_UNLOCK + code,
+                                                     0)
+        raise Return(timer)
+
+    def sweep_unlock(self, code, index, rounds):
+        """Same as SerialIO.sweep_unlock."""
+        results = yield self.adapter.sweep(self.s.CMD_UNLOCK + code,
+                                           len(self.s.CMD_UNLOCK) + index,
+                                           rounds)
+        timeout = self.s.adapter.SWEEP_TIMEOUT
+        raise Return([[t for t in times if t != timeout]
+                      for times in zip(*results)])
+
+    def unlock_status(self):
+        status = yield self.adapter.transact('\x70', 2)
+        raise Return((ord(status[1]) >> 2) & 3)
+
+    def check_page(self, page):
+        return self.adapter.check(self.s.read_command(page), 256)
+
+    def read_page(self, page):
+        """Same as SerialIO.read_page."""
+        retries = 0
+        while True:
+            try:
+                data = yield self.adapter.transact(
+                        self.s.read_command(page), 256)
+                raise Return(data)
+            except adapter.CheckDataException:
+                retries = self.s.retry(page, retries)
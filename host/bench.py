@@ -0,0 +1,360 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Throughput and latency benchmarks of the host stack."""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+import adapter
+import emulator
+import main
+import serialio
+
+
+# Latency percentiles to report.
+PERCENTILES = [50, 90, 99]
+# Code that does not unlock the target.
+WRONG_CODE = '\x00' * 7
+# Benchmarks on all channels of the adapter at once, and the one channel
+# benchmarks they have to keep up with: transactions of different channels
+# overlap, so doing the same on every channel may take only a bit longer.
+OVERLAPPED = {'dump_channels': 'dump'}
+OVERLAP_SLOWDOWN = 1.5
+
+
+class Result(object):
+    """Timings of one benchmark."""
+
+    def __init__(self):
+        self.latencies = []
+        self.commands = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def run(self, fn, *args):
+        """Runs fn as one command and times it, returns its result."""
+        start = time.time()
+        res = fn(*args)
+        self.latencies.append(time.time() - start)
+        self.commands += 1
+        return res
+
+    def report(self):
+        res = collections.OrderedDict()
+        res['seconds'] = self.seconds
+        res['commands'] = self.commands
+        res['commands_per_second'] = self.commands / self.seconds
+        if self.bytes:
+            res['bytes'] = self.bytes
+            res['bytes_per_second'] = self.bytes / self.seconds
+        if self.latencies:
+            latency = collections.OrderedDict()
+            values = numpy.percentile(self.latencies, PERCENTILES)
+            for p, value in zip(PERCENTILES, values):
+                latency['p{}'.format(p)] = value
+            latency['max'] = max(self.latencies)
+            res['latency'] = latency
+        return res
+
+
+def bench_execute(s, args, res):
+    for _ in range(args.count):
+        res.run(s.adapter.execute, s.CMD_VERSION, 8)
+        res.bytes += 8
+
+
+def bench_transact(s, args, res):
+    for _ in range(args.count):
+        res.run(s.adapter.transact, s.CMD_VERSION, 8)
+        res.bytes += 8
+
+
+def bench_read_page(s, args, res):
+    for page in range(args.count):
+        res.bytes += len(res.run(s.read_page, 0xe00 + page % 0x200))
+
+
+def bench_read_pages(s, args, res):
+    pages = s.read_pages(0xe00, 0xe00 + args.count - 1, depth=args.depth)
+    while True:
+        try:
+            _, data = res.run(next, pages)
+        except StopIteration:
+            break
+        res.bytes += len(data)
+
+
+def bench_busy_timer(s, args, res):
+    for _ in range(args.count):
+        s.unlock(WRONG_CODE)
+        res.run(s.adapter.busy_timer)
+
+
+def bench_timed_unlock(s, args, res):
+    for _ in range(args.count):
+        res.run(s.timed_unlock, WRONG_CODE)
+
+
+def bench_sweep(s, args, res):
+    res.run(s.sweep_unlock, WRONG_CODE, 0, 1)
+    res.commands = 256
+
+
+def bench_dump(s, args, res):
+    dump_args = main.parser.parse_args(['dump', '-o', os.devnull, '-c',
+                                        args.pin, '--depth', str(args.depth)])
+    dump_args.targets = [s]
+    runs = main.find_device(dump_args).plan()
+    res.run(main.dump, dump_args, s)
+    res.bytes = sum(last - first + 1 for first, last in runs) * 256
+
+
+def channel_targets(s, args):
+    """Returns handles of all channels of the adapter of s, unlocked."""
+    targets = [s]
+    for index in range(1, adapter.Adapter.CHANNELS):
+        target = serialio.SerialIO(s.adapter.channel(index))
+        target.connect()
+        target.unlock(args.pin.decode('hex'))
+        targets.append(target)
+    return targets
+
+
+def bench_dump_channels(s, args, res):
+    targets = channel_targets(s, args)
+    output = tempfile.mkdtemp()
+    try:
+        dump_args = main.parser.parse_args([
+                'dump', '-o', os.path.join(output, 'dump'), '-c', args.pin,
+                '--depth', str(args.depth)])
+        dump_args.targets = targets
+        runs = main.find_device(dump_args).plan()
+        res.run(main.dump, dump_args, s)
+    finally:
+        shutil.rmtree(output)
+    res.bytes = (sum(last - first + 1 for first, last in runs) * 256 *
+                 len(targets))
+
+
+def bench_crack(s, args, res):
+    crack_args = main.parser.parse_args(['crack'])
+    crack_args.targets = [s]
+    res.run(main.crack, crack_args, s)
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('execute', bench_execute),
+    ('transact', bench_transact),
+    ('read_page', bench_read_page),
+    ('read_pages', bench_read_pages),
+    ('busy_timer', bench_busy_timer),
+    ('timed_unlock', bench_timed_unlock),
+    ('sweep', bench_sweep),
+    ('dump', bench_dump),
+    ('crack', bench_crack),
+    ('dump_channels', bench_dump_channels),
+])
+
+
+def start_emulator(args):
+    """
+    Starts an emulator in the background.
+
+    Returns:
+        Tuple of the Emulator, the thread serving it and its port.
+    """
+    rng = random.Random(args.seed)
+    flash = emulator.default_flash(rng)
+    targets = [emulator.Target(args.pin.decode('hex'), flash, rng=rng)
+               for _ in range(adapter.Adapter.CHANNELS)]
+    fd, port = emulator.open_pty()
+    e = emulator.Emulator(fd, targets, latency=args.latency,
+                          realtime=args.realtime)
+    thread = threading.Thread(target=e.serve)
+    thread.start()
+    return e, thread, port
+
+
+def stop_emulator(e, thread):
+    """Stops an emulator started with start_emulator and closes its pty."""
+    e.stop()
+    thread.join()
+    os.close(e.fd)
+    for fd in e.stop_fds:
+        os.close(fd)
+
+
+def serialized(report):
+    """
+    Returns names of benchmarks on all channels that took too much longer
+    than on one, as if the channels took turns instead of overlapping.
+    """
+    res = []
+    benchmarks = report['benchmarks']
+    for name, single in OVERLAPPED.items():
+        if name not in benchmarks or single not in benchmarks:
+            continue
+        if (benchmarks[name]['seconds'] >
+                benchmarks[single]['seconds'] * OVERLAP_SLOWDOWN):
+            res.append(name)
+    return res
+
+
+def regressions(report, baseline, tolerance):
+    """Returns names of benchmarks that got slower than in baseline."""
+    res = []
+    for name, result in report['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            continue
+        if result['seconds'] > before['seconds'] * (1 + tolerance):
+            res.append(name)
+    return res
+
+
+parser = argparse.ArgumentParser(
+        description='Benchmark the host stack against an emulated or real '
+                    'adapter.')
+parser.add_argument('--port', '-p', help='Adapter serial port (default: '
+                    'start an emulator).', type=str)
+parser.add_argument('--benchmark', '-b', help='Benchmark to run (repeatable, '
+                    'default all).', action='append',
+                    choices=BENCHMARKS.keys())
+parser.add_argument('--count', '-n', help='Commands per benchmark.', type=int,
+                    default=64)
+parser.add_argument('--depth', help='Page reads to keep in flight.',
+                    type=int, default=2)
+parser.add_argument('--pin', help='Target ID code (hexadecimal).',
+                    default='4ddeadbeefcafe')
+parser.add_argument('--latency', help='Host link latency of the emulator in '
+                    'seconds.', type=float, default=0.0)
+parser.add_argument('--realtime', help='Run the emulator at the speed of real '
+                    'hardware.', action='store_true')
+parser.add_argument('--seed', help='Random seed of the emulator.', type=int,
+                    default=0)
+parser.add_argument('--output', '-o', help='Write JSON report to file instead '
+                    'of stdout.', type=str)
+parser.add_argument('--baseline', help='JSON report to compare against, exit '
+                    'with an error on regressions.', type=str)
+parser.add_argument('--tolerance', help='Fraction by which a benchmark may be '
+                    'slower than the baseline.', type=float, default=0.1)
+parser.add_argument('--baud-rate', help='Host link baud rate, or "auto" to '
+                    'use the fastest one that works.', type=main.baud_rate)
+parser.add_argument('--verbose', '-v', help='Increase output verbosity.',
+                    action='store_true')
+
+
+def run():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else
+                        logging.WARNING, format='%(message)s')
+
+    if args.port:
+        return run_benchmarks(args, args.port)
+    e, thread, port = start_emulator(args)
+    try:
+        return run_benchmarks(args, port)
+    finally:
+        stop_emulator(e, thread)
+
+
+def run_benchmarks(args, port):
+    """Runs the benchmarks on the adapter at port, returns the exit status."""
+    a = adapter.Adapter(port)
+    s = serialio.SerialIO(a)
+    a.connect()
+    if args.baud_rate == 'auto':
+        a.tune_baud_rate()
+    elif args.baud_rate:
+        a.set_baud_rate(args.baud_rate)
+    s.connect()
+    # Unlock once, so that reads return flash contents.
+    s.unlock(args.pin.decode('hex'))
+
+    report = collections.OrderedDict()
+    report['adapter_version'] = a.version()
+    report['target_version'] = s.version()
+    report['baud_rate'] = a.link.baud_rate
+    report['emulator'] = args.port is None
+    if args.port is None:
+        report['latency'] = args.latency
+        report['realtime'] = args.realtime
+    report['count'] = args.count
+    report['depth'] = args.depth
+    report['benchmarks'] = collections.OrderedDict()
+
+    for name in args.benchmark or BENCHMARKS.keys():
+        res = Result()
+        start = time.time()
+        BENCHMARKS[name](s, args, res)
+        res.seconds = time.time() - start
+        report['benchmarks'][name] = res.report()
+        logging.info("{}: {:.3f}s".format(name, res.seconds))
+
+    data = json.dumps(report, indent=2, separators=(',', ': '))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    else:
+        print data
+
+    # Without real timing, the emulator is only as fast as the host can
+    # run it, and channels can't overlap.
+    if args.port or args.realtime:
+        slow = serialized(report)
+        for name in slow:
+            logging.error("{} took {:.3f}s, {} on one channel {:.3f}s".format(
+                name, report['benchmarks'][name]['seconds'], OVERLAPPED[name],
+                report['benchmarks'][OVERLAPPED[name]]['seconds']))
+        if slow:
+            return 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report, baseline, args.tolerance)
+        for name in slower:
+            logging.error("{} regressed: {:.3f}s, was {:.3f}s".format(
+                name, report['benchmarks'][name]['seconds'],
+                baseline['benchmarks'][name]['seconds']))
+        if slower:
+            return 1
+
+
+if __name__ == '__main__':
+    sys.exit(run() or 0)
@@ -0,0 +1,193 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Tuning of target clock and serial clock settings."""
+
+import json
+import logging
+import os
+
+
+class ClockException(Exception):
+    pass
+
+
+# Serial clock setting every target keeps up with (1.5MHz at 6MHz target
+# clock), and the one tuning starts from.
+SAFE_SCLK = 127
+# Default file to keep tuned settings in.
+DEFAULT_CACHE = os.path.expanduser('~/.m16c-clocks.json')
+
+
+class ClockCache(object):
+    """
+    Tuned serial clock settings by device and target clock setting, kept in
+    a JSON file. A setting of None marks a target clock setting the device
+    doesn't work at.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.settings = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.settings = json.load(f)
+
+    def tuned(self, device, tclk):
+        return str(tclk) in self.settings.get(device, {})
+
+    def sclk(self, device, tclk):
+        return self.settings[device][str(tclk)]
+
+    def set(self, device, tclk, sclk):
+        self.settings.setdefault(device, {})[str(tclk)] = sclk
+
+    def save(self):
+        # Write a new file and rename it over the old one, so that an
+        # interrupted write doesn't lose settings of other devices.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.settings, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        os.rename(tmp, self.path)
+
+
+def sclk_settings(start):
+    """Returns serial clock settings from start down, halving the period."""
+    res = [start]
+    while res[-1] > 0:
+        res.append((res[-1] + 1) // 2 - 1)
+    return res
+
+
+class ClockTuner(object):
+    """
+    Finds the fastest serial clock setting a target works with.
+
+    Every setting is checked by reading the target's version and a few pages
+    several times, all of which have to match what was read at SAFE_SCLK.
+    Pages don't have to be readable (the target may still be locked), they
+    only have to read back the same. Settings get faster until a check
+    fails; after that, the target is reset, as it may have taken garbled
+    bytes for a command.
+    """
+
+    def __init__(self, s, pages=(0xfff,), rounds=8):
+        self.s = s
+        self.pages = pages
+        self.rounds = rounds
+
+    def _read(self):
+        return [self.s.version()] + [self.s.read_page(p) for p in self.pages]
+
+    def _check(self, reference):
+        for _ in range(self.rounds):
+            if self._read() != reference:
+                return False
+        return True
+
+    def tune_sclk(self, tclk):
+        """
+        Returns the fastest serial clock setting that works at target clock
+        setting tclk, or None if the target doesn't work at tclk at all.
+        The target is left at tclk and SAFE_SCLK.
+        """
+        adapter = self.s.adapter
+        adapter.set_tclk(tclk)
+        adapter.set_sclk(SAFE_SCLK)
+        if not self.s.version().startswith('VER'):
+            self._recover()
+            return None
+        reference = self._read()
+        best = None
+        for sclk in sclk_settings(SAFE_SCLK):
+            adapter.set_sclk(sclk)
+            ok = self._check(reference)
+            logging.debug("tclk {}, sclk {}: {}".format(
+                tclk, sclk, "ok" if ok else "failed"))
+            if not ok:
+                self._recover()
+                break
+            best = sclk
+        adapter.set_sclk(SAFE_SCLK)
+        return best
+
+    def check_sclk(self, tclk, sclk):
+        """
+        Returns whether serial clock setting sclk still works at target clock
+        setting tclk, checked like while tuning. The target is left at tclk
+        and sclk if it does, at SAFE_SCLK otherwise.
+        """
+        adapter = self.s.adapter
+        adapter.set_tclk(tclk)
+        adapter.set_sclk(SAFE_SCLK)
+        if not self.s.version().startswith('VER'):
+            self._recover()
+            return False
+        reference = self._read()
+        adapter.set_sclk(sclk)
+        if self._check(reference):
+            return True
+        self._recover()
+        return False
+
+    def _recover(self):
+        self.s.adapter.set_sclk(SAFE_SCLK)
+        self.s.adapter.reset_target()
+
+
+def set_clocks(s, device, tclks, cache):
+    """
+    Sets the first target clock setting of tclks (fastest first) that the
+    target works at, and the fastest serial clock setting for it. Settings
+    are taken from cache if they were tuned for device before and still
+    pass a check (the target behind a name may have changed), otherwise
+    they're tuned and added to the cache.
+
+    Returns:
+        Tuple of the target clock and serial clock settings set.
+    """
+    tuner = ClockTuner(s)
+    for tclk in tclks:
+        if not cache.tuned(device, tclk):
+            logging.info("Tuning serial clock of {} at tclk {}...".format(
+                device, tclk))
+            tune = True
+        else:
+            sclk = cache.sclk(device, tclk)
+            tune = sclk is not None and not tuner.check_sclk(tclk, sclk)
+            if tune:
+                logging.info("Cached serial clock of {} at tclk {} failed, "
+                             "tuning again.".format(device, tclk))
+        if tune:
+            cache.set(device, tclk, tuner.tune_sclk(tclk))
+            cache.save()
+        sclk = cache.sclk(device, tclk)
+        if sclk is not None:
+            s.adapter.set_tclk(tclk)
+            s.adapter.set_sclk(sclk)
+            return tclk, sclk
+    raise ClockException("{} works at none of tclk {}.".format(device, tclks))
@@ -0,0 +1,154 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Profiles of supported target devices."""
+
+import collections
+
+import clocks
+
+
+class DeviceException(Exception):
+    pass
+
+
+# Target clock settings to use, fastest first, unless a device has others.
+# Cracking stays at 3MHz, as the busy timer resolution depends on it.
+CRACK_TCLKS = [1]
+DUMP_TCLKS = [0, 1, 2, 3, 4]
+
+
+class Region(object):
+    """
+    Pages first to last (inclusive) of a device's memory, erased in blocks
+    of at least block_size bytes.
+    """
+
+    def __init__(self, name, first, last, block_size):
+        self.name = name
+        self.first = first
+        self.last = last
+        self.block_size = block_size
+
+
+class Device(object):
+    """
+    Memory map, clock settings and ID code busy time leak of a device.
+    """
+
+    def __init__(self, name, versions, regions, crack_tclks=CRACK_TCLKS,
+                 dump_tclks=DUMP_TCLKS, sclk=clocks.SAFE_SCLK, leak=None):
+        """
+        Args:
+            name: Part number.
+            versions: Target version strings (see SerialIO.version) that
+                identify the device.
+            regions: List of Regions of the memory to dump.
+            crack_tclks: Target clock settings to crack at, fastest first.
+                The busy timer resolution depends on the target clock.
+            dump_tclks: Target clock settings to dump at, fastest first.
+            sclk: Serial clock setting to use without tuning.
+            leak: Busy time added by every correct leading ID code byte, in
+                target clock cycles, None if unknown.
+        """
+        self.name = name
+        self.versions = versions
+        self.regions = sorted(regions, key=lambda r: r.first)
+        self.crack_tclks = list(crack_tclks)
+        self.dump_tclks = list(dump_tclks)
+        self.sclk = sclk
+        self.leak = leak
+        for region in self.regions:
+            if ((region.first << 8) % region.block_size or
+                    ((region.last + 1) << 8) % region.block_size):
+                raise DeviceException("Region {} of {} is not block aligned."
+                                      .format(region.name, name))
+            if region.last > 0xffff:
+                raise DeviceException("Region {} of {} is not addressable."
+                                      .format(region.name, name))
+
+    def leak_ticks(self, tclk):
+        """
+        Returns the leak in busy timer ticks (adapter clock cycles) at
+        target clock setting tclk, None if unknown.
+        """
+        if self.leak is None:
+            return None
+        return self.leak * 2 * (tclk + 1)
+
+    @property
+    def size(self):
+        """Size in bytes of the span from the first to the last region."""
+        return (self.regions[-1].last - self.regions[0].first + 1) << 8
+
+    def plan(self, names=None):
+        """
+        Returns runs of pages to dump as (first, last) tuples in address
+        order: the regions named in names (all by default), with adjacent
+        regions merged.
+        """
+        regions = self.regions
+        if names:
+            known = set(r.name for r in regions)
+            unknown = [n for n in names if n not in known]
+            if unknown:
+                raise DeviceException("{} has no region {}.".format(
+                    self.name, ', '.join(unknown)))
+            regions = [r for r in regions if r.name in names]
+        res = []
+        for region in regions:
+            if res and res[-1][1] + 1 == region.first:
+                res[-1] = (res[-1][0], region.last)
+            else:
+                res.append((region.first, region.last))
+        return res
+
+
+DEVICES = collections.OrderedDict((d.name, d) for d in [
+    Device('M306K9FCLRP', ['VER.1.01'],
+           [Region('rom', 0xe00, 0xfff, 0x1000)]),
+])
+
+
+def by_name(name):
+    try:
+        return DEVICES[name]
+    except KeyError:
+        raise DeviceException("Unknown device {}, known are {}.".format(
+            name, ', '.join(DEVICES)))
+
+
+def by_version(version):
+    """Returns the device that identifies with target version version."""
+    res = [d for d in DEVICES.values() if version in d.versions]
+    if not res:
+        raise DeviceException("Unknown target version {}, select the device "
+                              "with --device.".format(version))
+    if len(res) > 1:
+        raise DeviceException("Target version {} matches {}, select the "
+                              "device with --device.".format(
+                                  version, ', '.join(d.name for d in res)))
+    return res[0]
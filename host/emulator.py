@@ -0,0 +1,705 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Software stand-in for the adapter and target, served on a pseudo-terminal.
+
+Run it and point main.py at the printed port:
+
+    $ python2 emulator.py
+    Emulating adapter on /dev/pts/5
+    $ python2 main.py -p /dev/pts/5 crack
+"""
+
+import argparse
+import binascii
+import collections
+import logging
+import os
+import pty
+import random
+import select
+import struct
+import sys
+import time
+import tty
+
+import devices
+import serialio
+
+
+class Target(object):
+    """
+    Behavioral model of an M16C in Standard Serial I/O mode.
+
+    Bytes are clocked in and out at the same time. Commands get parsed from
+    the bytes clocked in, their results are clocked out on the following
+    bytes, and while there's no result to send the target sends 0xFF.
+    Busy times are in target clock cycles.
+    """
+    VERSION = 'VER.1.01'
+    # Default size of the address space, flash is at its end.
+    MEMORY_SIZE = 0x100000
+    # Command lengths, by first byte.
+    LENGTHS = {
+        0x50: 1,
+        0x70: 1,
+        0xf5: 12,
+        0xfb: 1,
+        0xff: 3,
+    }
+    # Status register bits that are always set (ready).
+    SRD = 0x80
+
+    def __init__(self, pin, flash, busy_base=250, leak=2, jitter=0.0,
+                 read_busy=20, sio_cycles=4, version=VERSION,
+                 memory_size=MEMORY_SIZE, rng=None):
+        """
+        Args:
+            pin: String containing the 7 byte ID code.
+            flash: String containing the flash image, mapped to the end of
+                the address space.
+            busy_base: Busy time after a wrong first ID code byte.
+            leak: Busy time added by every correct leading ID code byte,
+                apart from a correct last byte, which takes it away.
+            jitter: Standard deviation of noise added to busy times.
+            read_busy: Busy time after a read command.
+            sio_cycles: Target clock cycles needed per serial clock half
+                period. With a faster serial clock, bits sent by the target
+                get corrupted.
+            version: Version string.
+            memory_size: Size of the address space.
+            rng: random.Random to draw noise from.
+        """
+        if len(pin) != 7:
+            raise ValueError("ID code must be 7 bytes long.")
+        if len(flash) > memory_size:
+            raise ValueError("Flash image too large.")
+        self.pin = [ord(c) for c in pin]
+        # Only the flash is kept, the rest of the address space is erased.
+        self.flash = bytearray(flash)
+        self.flash_start = memory_size - len(flash)
+        self.busy_base = busy_base
+        self.leak = leak
+        self.jitter = jitter
+        self.read_busy = read_busy
+        self.sio_cycles = sio_cycles
+        self.version = version
+        self.rng = rng or random.Random()
+        self.reset()
+
+    def reset(self):
+        self.unlock_status = serialio.UNLOCK_NOT_ATTEMPTED
+        self.command = []
+        self.output = collections.deque()
+
+    def _busy(self, cycles):
+        if self.jitter:
+            cycles += self.rng.gauss(0, self.jitter)
+        return max(1, int(round(cycles)))
+
+    def _unlock(self, code):
+        matched = 0
+        while matched < 7 and code[matched] == self.pin[matched]:
+            matched += 1
+        if matched == 7:
+            self.unlock_status = serialio.UNLOCK_SUCCESSFUL
+            return self._busy(self.busy_base + self.leak * 5)
+        self.unlock_status = serialio.UNLOCK_FAILED
+        return self._busy(self.busy_base + self.leak * matched)
+
+    def _read(self, page):
+        address = (page << 8) - self.flash_start
+        if (self.unlock_status != serialio.UNLOCK_SUCCESSFUL or
+                address < 0):
+            # Protected or erased, reads back as erased.
+            self.output.extend([0xff] * 256)
+        else:
+            self.output.extend(self.flash[address:address+256])
+        return self._busy(self.read_busy)
+
+    def _run(self, command):
+        """Executes a command, returns busy time (zero if not busy)."""
+        opcode = command[0]
+        if opcode == 0xfb:
+            self.output.extend(bytearray(self.version))
+        elif opcode == 0x70:
+            self.output.extend([self.SRD, self.unlock_status << 2])
+        elif opcode == 0x50:
+            self.unlock_status = serialio.UNLOCK_NOT_ATTEMPTED
+        elif opcode == 0xf5:
+            return self._unlock(command[5:12])
+        elif opcode == 0xff:
+            return self._read(command[1] | (command[2] << 8))
+        return 0
+
+    def keeps_up(self, tclk, sclk):
+        """
+        Returns whether the target can follow the serial clock at the given
+        adapter clock settings.
+        """
+        # Serial clock half period and target clock cycle, in adapter cycles.
+        return sclk + 1 >= self.sio_cycles * 2 * (tclk + 1)
+
+    def exchange(self, byte):
+        """
+        Clocks one byte in and one byte out.
+
+        Returns:
+            Tuple of the byte clocked out and the busy time that follows.
+        """
+        if self.output:
+            # Bytes clocked in while a result is sent only provide the clock.
+            return self.output.popleft(), 0
+        self.command.append(byte)
+        if len(self.command) < self.LENGTHS.get(self.command[0], 1):
+            return 0xff, 0
+        command, self.command = self.command, []
+        return 0xff, self._run(command)
+
+
+class Channel(object):
+    """
+    SIO channel of the adapter (see adapter/sio.py): FIFOs, clock dividers
+    and busy timer of one target, and the time its engine is done with the
+    last transaction.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.txbuffer = collections.deque()
+        self.rxbuffer = collections.deque()
+        self.tclk = 4
+        self.sclk = 1023
+        self.timer = 0
+        self.timer_start = 0
+        self.busy_until = 0
+        self.timer_fresh = False
+        # Adapter clock cycle at which the engine goes idle.
+        self.idle_at = 0
+        # Length of the result of the last transaction.
+        self.result_length = 0
+
+    def exchange(self, byte, clock):
+        """
+        Clocks a byte to the target like the engine does, starting no
+        earlier than clock.
+
+        Returns:
+            Tuple of the byte clocked out and the cycle it's done at.
+        """
+        clock = max(clock, self.busy_until)
+        clock += 16 * (self.sclk + 1)
+        self.timer_fresh = False
+        out, busy = self.target.exchange(byte)
+        if not self.target.keeps_up(self.tclk, self.sclk):
+            out ^= 1 << self.target.rng.randrange(8)
+        if busy:
+            self.timer = busy * 2 * (self.tclk + 1)
+            self.timer_start = clock
+            self.busy_until = clock + self.timer
+            self.timer_fresh = True
+        return out, clock
+
+    def run(self, clock, pad_length=0, skip_length=0):
+        """Runs a transaction starting at clock, sets idle_at."""
+        clock = max(clock, self.idle_at)
+        while self.txbuffer or pad_length:
+            if self.txbuffer:
+                byte = self.txbuffer.popleft()
+            else:
+                byte = 0xff
+                pad_length -= 1
+            out, clock = self.exchange(byte, clock)
+            if skip_length:
+                skip_length -= 1
+            elif len(self.rxbuffer) < Emulator.FIFO_SIZE:
+                self.rxbuffer.append(out)
+        self.idle_at = clock
+
+    def timer_running(self, clock):
+        return clock < self.busy_until
+
+    def timer_value(self, clock):
+        if self.timer_running(clock):
+            return clock - self.timer_start
+        return self.timer
+
+
+class Emulator(object):
+    """
+    Model of the adapter state machine (see adapter/top.py) driving Targets.
+
+    Time is kept in adapter clock cycles. It advances with every byte on the
+    host link, every bit clocked to a target and every busy time waited
+    out, so busy timer values and timeouts match the real adapter. Channels
+    run transactions on their own, so each keeps the time its transaction is
+    done at, which the adapter catches up with when it waits for it. In
+    realtime mode time also follows the wall clock and responses are held
+    back until the time they would've been sent, for benchmarking.
+    """
+    CLKFREQ = 12000000
+    BAUDRATE = 1200000
+    STEP_BITS = 16
+    MAX_STEP = 2**14
+    VERSION = 'b'
+    # Result length bits of transact requests asking for check data, for
+    # only check data instead of the result, and for blank results to be
+    # left out.
+    CHECK_FLAG = 0x8000
+    DROP_FLAG = 0x4000
+    BLANK_FLAG = 0x2000
+    LENGTH_MASK = 0x1fff
+    FIFO_SIZE = 512
+    SWEEP_TEMPLATE_SIZE = 32
+    TRANSACT_WATCHDOG = 2**24
+    SWEEP_WATCHDOG = 2**20
+
+    def __init__(self, fd, targets, latency=0.0, realtime=False,
+                 corrupt=0.0, rng=None):
+        """
+        Args:
+            fd: File descriptor of the host link.
+            targets: List of Targets to drive, one per channel.
+            latency: Seconds every response is delayed by on the host link.
+            realtime: Whether to pace the emulation to the wall clock.
+            corrupt: Fraction of transaction result bytes that get a bit
+                flipped on the host link.
+            rng: random.Random to draw corrupted bytes from.
+        """
+        self.fd = fd
+        # Written to by stop to wake serve up.
+        self.stop_fds = os.pipe()
+        self.channels = [Channel(target) for target in targets]
+        self.channel = self.channels[0]
+        self.latency = latency
+        self.realtime = realtime
+        self.corrupt = corrupt
+        self.rng = rng or random.Random()
+        self.clock = 0
+        # Host UART baud generator step.
+        self.step = (self.BAUDRATE * 2**self.STEP_BITS) // self.CLKFREQ
+        self.start = time.time()
+        self.input = collections.deque()
+        # Response chunks waiting to be sent, with the time they're due.
+        self.pending = collections.deque()
+        self.response = []
+        self.handlers = {
+            'v': self._version,
+            'C': self._select_channel,
+            'f': self._flush,
+            'r': self._reset_target,
+            'w': self._fifo_write,
+            'b': self._fifo_block_write,
+            'W': self._send,
+            'x': self._transact,
+            'X': self._timed_transact,
+            'q': self._queue_transact,
+            'k': self._finish_transact,
+            'K': self._timed_finish_transact,
+            'R': self._fifo_read,
+            't': self._get_timer,
+            'T': self._timer_status,
+            'c': self._sweep,
+            's': self._set_tclk,
+            'S': self._set_sclk,
+            'B': self._set_baud_rate,
+            'e': self._echo,
+        }
+
+    def _byte_cycles(self):
+        # Start bit, 8 data bits, stop bit.
+        return 10 * 2**self.STEP_BITS // self.step
+
+    def _wall(self, clock):
+        return self.start + float(clock) / self.CLKFREQ
+
+    def _flush_pending(self):
+        now = time.time()
+        while self.pending and self.pending[0][0] <= now:
+            _, data = self.pending.popleft()
+            os.write(self.fd, data)
+
+    def _read(self, count):
+        data = []
+        while len(data) < count:
+            if not self.input:
+                self._flush_pending()
+                timeout = None
+                if self.pending:
+                    timeout = max(0, self.pending[0][0] - time.time())
+                readable, _, _ = select.select(
+                        [self.fd, self.stop_fds[0]], [], [], timeout)
+                if self.stop_fds[0] in readable:
+                    raise EOFError()
+                if not readable:
+                    continue
+                try:
+                    chunk = os.read(self.fd, 4096)
+                except OSError:
+                    chunk = ''
+                if not chunk:
+                    raise EOFError()
+                self.input.extend(chunk)
+                if self.realtime:
+                    now = (time.time() - self.start) * self.CLKFREQ
+                    self.clock = max(self.clock, int(now))
+            data.append(self.input.popleft())
+            self.clock += self._byte_cycles()
+        return ''.join(data)
+
+    def _respond(self, data):
+        self.response.append(data)
+        self.clock += len(data) * self._byte_cycles()
+
+    def _commit(self):
+        """Queues the response of the request just handled."""
+        if not self.response:
+            return
+        data, self.response = ''.join(self.response), []
+        due = time.time()
+        if self.realtime:
+            due = max(due, self._wall(self.clock))
+        self.pending.append((due + self.latency, data))
+
+    def _idle(self):
+        """Waits for the selected channel to finish its transaction."""
+        self.clock = max(self.clock, self.channel.idle_at)
+
+    def _exchange(self, byte):
+        """Clocks a byte to the selected target and waits for it."""
+        self._idle()
+        out, self.clock = self.channel.exchange(byte, self.clock)
+        self.channel.idle_at = self.clock
+        return out
+
+    def _wait_timer(self, watchdog):
+        """Waits for a fresh busy timer to stop, returns False on timeout."""
+        c = self.channel
+        if not c.timer_fresh or c.timer > watchdog:
+            self.clock += watchdog
+            return False
+        self.clock = max(self.clock, c.busy_until)
+        return True
+
+    def _run(self, pad_length=0, skip_length=0):
+        self.channel.run(self.clock, pad_length, skip_length)
+
+    def _push(self, data):
+        """Writes bytes to the command FIFO, returns False on overflow."""
+        txbuffer = self.channel.txbuffer
+        room = self.FIFO_SIZE - len(txbuffer)
+        txbuffer.extend(ord(c) for c in data[:room])
+        return len(data) <= room
+
+    def _version(self):
+        self._respond(self.VERSION)
+
+    def _select_channel(self):
+        index = ord(self._read(1))
+        if index >= len(self.channels):
+            self._respond('!')
+            return
+        self.channel = self.channels[index]
+        self._respond('.')
+
+    def _flush(self):
+        self._idle()
+        self.channel.txbuffer.clear()
+        self.channel.rxbuffer.clear()
+        self._respond('.')
+
+    def _reset_target(self):
+        self._idle()
+        self.clock += 120000
+        self.channel.idle_at = self.clock
+        self.channel.target.reset()
+        self._respond('.')
+
+    def _fifo_write(self):
+        self._respond('.' if self._push(self._read(1)) else '!')
+
+    def _fifo_block_write(self):
+        length, = struct.unpack('<H', self._read(2))
+        self._respond('.' if self._push(self._read(length)) else '!')
+
+    def _send(self):
+        self._idle()
+        self._run()
+        self._idle()
+        self._respond('.')
+
+    def _start_transact(self):
+        """Loads and starts a transaction, returns False on overflow."""
+        command_length, result_length = struct.unpack('<HH', self._read(4))
+        self._idle()
+        self.channel.txbuffer.clear()
+        self.channel.rxbuffer.clear()
+        self.channel.result_length = result_length
+        if not self._push(self._read(command_length)):
+            self._respond('!')
+            return False
+        self._run(result_length & self.LENGTH_MASK, command_length)
+        return True
+
+    def _finish(self, timed=False):
+        """Waits for the transaction and responds with its result."""
+        self._idle()
+        if timed:
+            if not self._wait_timer(self.TRANSACT_WATCHDOG):
+                self._respond('!')
+                return
+            self._respond('.' + struct.pack('<I', self.channel.timer))
+        else:
+            self._respond('.')
+        result_length = self.channel.result_length
+        self._drain(result_length & self.LENGTH_MASK,
+                    check=bool(result_length & self.CHECK_FLAG),
+                    drop=bool(result_length & self.DROP_FLAG),
+                    skip_blank=bool(result_length & self.BLANK_FLAG))
+
+    def _transact(self, timed=False):
+        if self._start_transact():
+            self._finish(timed)
+
+    def _timed_transact(self):
+        self._transact(timed=True)
+
+    def _queue_transact(self):
+        if self._start_transact():
+            self._respond('.')
+
+    def _finish_transact(self):
+        self._finish()
+
+    def _timed_finish_transact(self):
+        self._finish(timed=True)
+
+    def _drain(self, count, check=False, drop=False, skip_blank=False):
+        """
+        Sends count bytes from the response FIFO (unless dropping them, or
+        leaving them out for being all 0xFF) and their check data.
+        """
+        rxbuffer = self.channel.rxbuffer
+        data = bytearray()
+        for _ in range(count):
+            data.append(rxbuffer.popleft() if rxbuffer else 0xff)
+        check_data = struct.pack('<I', binascii.crc32(str(data)) & 0xffffffff)
+        if skip_blank:
+            blank = data == bytearray('\xff' * count)
+            self._respond('\x01' if blank else '\x00')
+            drop = drop or blank
+        if self.corrupt:
+            for i in range(count):
+                if self.rng.random() < self.corrupt:
+                    data[i] ^= 1 << self.rng.randrange(8)
+        if not drop:
+            self._respond(str(data))
+        if check:
+            self._respond(check_data)
+
+    def _fifo_read(self):
+        count, = struct.unpack('<I', self._read(4))
+        self._drain(count)
+
+    def _get_timer(self):
+        value = self.channel.timer_value(self.clock)
+        self._respond(struct.pack('<I', value & 0xffffffff))
+
+    def _timer_status(self):
+        self._respond('r' if self.channel.timer_running(self.clock) else 's')
+
+    def _sweep(self):
+        length, offset, rounds = struct.unpack('<BBB', self._read(3))
+        template = bytearray(self._read(length))
+        # The adapter only has room for this much of the template.
+        del template[self.SWEEP_TEMPLATE_SIZE:]
+        for _ in range(rounds):
+            results = []
+            for candidate in range(256):
+                for index, byte in enumerate(template):
+                    self._exchange(candidate if index == offset else byte)
+                if self._wait_timer(self.SWEEP_WATCHDOG):
+                    results.append(self.channel.timer)
+                else:
+                    results.append(0xffffffff)
+            self._respond(struct.pack('<256I', *results))
+            # Rounds get sent as soon as they're done.
+            self._commit()
+
+    def _set_tclk(self):
+        self.channel.tclk = ord(self._read(1))
+        self._respond('.')
+
+    def _set_sclk(self):
+        self.channel.sclk, = struct.unpack('<H', self._read(2))
+        self._respond('.')
+
+    def _set_baud_rate(self):
+        step, = struct.unpack('<H', self._read(2))
+        if not 0 < step <= self.MAX_STEP:
+            self._respond('!')
+            return
+        self._respond('.')
+        self._commit()
+        # The pty doesn't care about baud rates, only timing changes. The
+        # host has to confirm the switch like on the adapter.
+        old_step, self.step = self.step, step
+        if self._read(1) != 'B':
+            self.step = old_step
+            return
+        self._respond('.')
+
+    def _echo(self):
+        length, = struct.unpack('<H', self._read(2))
+        self._respond(self._read(length))
+
+    def handle(self):
+        """Handles one host request."""
+        request = self._read(1)
+        handler = self.handlers.get(request)
+        if handler is None:
+            self._respond('?')
+        else:
+            handler()
+        self._commit()
+
+    def serve(self):
+        """
+        Handles host requests until the host link is closed or stop is
+        called.
+        """
+        try:
+            while True:
+                self.handle()
+        except EOFError:
+            pass
+
+    def stop(self):
+        """Makes serve return, from another thread."""
+        os.write(self.stop_fds[1], 'x')
+
+
+def open_pty():
+    """
+    Opens a pseudo-terminal for the host link.
+
+    Returns:
+        Tuple of the emulator side file descriptor and the host side port
+        name.
+    """
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    # Keep the host side open so that reopening the port doesn't hang up the
+    # emulator side.
+    return master, os.ttyname(slave)
+
+
+def first(*values):
+    """Returns the first of values that is not None."""
+    return next(v for v in values if v is not None)
+
+
+def default_flash(rng):
+    """Returns a 128KiB flash image of random data and erased blocks."""
+    data = bytearray(rng.getrandbits(8) for _ in range(0x20000))
+    # Leave the upper half of the first 64KiB block erased.
+    data[0x8000:0x10000] = '\xff' * 0x8000
+    return str(data)
+
+
+parser = argparse.ArgumentParser(
+        description='Adapter and M16C target emulator.')
+parser.add_argument('--pin', help='Target ID code (hexadecimal).',
+                    default='4ddeadbeefcafe')
+parser.add_argument('--flash', help='Flash image, mapped to the end of the '
+                    'address space (default random).', type=str)
+parser.add_argument('--device', help='Device to emulate the version and busy '
+                    'time leak of.', type=str, default='M306K9FCLRP')
+parser.add_argument('--busy-base', help='Busy time after a wrong first ID '
+                    'code byte, in target clock cycles.', type=int,
+                    default=250)
+parser.add_argument('--leak', help='Busy time added by every correct ID code '
+                    'byte, in target clock cycles (default from the device, '
+                    'or 2).', type=int)
+parser.add_argument('--jitter', help='Standard deviation of busy time noise, '
+                    'in target clock cycles.', type=float, default=1.0)
+parser.add_argument('--sio-cycles', help='Target clock cycles the target '
+                    'needs per serial clock half period.', type=int,
+                    default=4)
+parser.add_argument('--channels', help='Number of SIO channels (targets).',
+                    type=int, default=2)
+parser.add_argument('--latency', help='Host link latency in seconds.',
+                    type=float, default=0.0)
+parser.add_argument('--realtime', help='Run at the speed of real hardware.',
+                    action='store_true')
+parser.add_argument('--corrupt', help='Fraction of transaction result bytes '
+                    'to corrupt on the host link.', type=float, default=0.0)
+parser.add_argument('--seed', help='Random seed.', type=int)
+parser.add_argument('--verbose', '-v', help='Increase output verbosity.',
+                    action='store_true')
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(message)s')
+
+    try:
+        pin = args.pin.decode('hex')
+    except TypeError:
+        logging.fatal("PIN must be in hexadecimal format.")
+        return 1
+    try:
+        device = devices.by_name(args.device)
+    except devices.DeviceException as e:
+        logging.fatal(str(e))
+        return 1
+    version = device.versions[0] if device.versions else Target.VERSION
+    leak = first(args.leak, device.leak, 2)
+    rng = random.Random(args.seed)
+    if args.flash:
+        with open(args.flash, 'rb') as f:
+            flash = f.read()
+    else:
+        flash = default_flash(rng)
+
+    # Targets of all channels have the same code and flash contents.
+    targets = [Target(pin, flash, busy_base=args.busy_base, leak=leak,
+                      jitter=args.jitter, sio_cycles=args.sio_cycles,
+                      version=version,
+                      memory_size=(device.regions[-1].last + 1) << 8, rng=rng)
+               for _ in range(args.channels)]
+    fd, port = open_pty()
+    emulator = Emulator(fd, targets, latency=args.latency,
+                        realtime=args.realtime, corrupt=args.corrupt, rng=rng)
+    logging.info("Emulating adapter on {}".format(port))
+    while True:
+        emulator.serve()
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)
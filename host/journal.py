@@ -0,0 +1,188 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Append-only journal of PIN cracking samples and decisions."""
+
+import collections
+import os
+import struct
+
+import numpy
+
+
+class JournalException(Exception):
+    pass
+
+
+class Journal(object):
+    """
+    Records every busy time sample and every decided PIN byte of a crack
+    run, so that an interrupted run can be resumed.
+
+    The file is a magic string followed by fixed-size records, each written
+    and flushed as soon as it's known. A partial record at the end (from an
+    interrupted write) is dropped when opening.
+    """
+    MAGIC = 'M16CJRN\x01'
+    # Record kind, position of the code byte, known code bytes before it
+    # (zero padded), value tried or decided, busy time, target clock and
+    # serial clock settings.
+    RECORD = struct.Struct('<cB6sBIBH')
+    KIND_SAMPLE = 's'
+    KIND_DECISION = 'd'
+    # NumPy equivalent of RECORD. The prefix is kept as bytes rather than a
+    # string, which would lose trailing zero bytes.
+    DTYPE = numpy.dtype([
+        ('kind', 'S1'),
+        ('position', 'u1'),
+        ('prefix', 'u1', 6),
+        ('value', 'u1'),
+        ('timer', '<u4'),
+        ('tclk', 'u1'),
+        ('sclk', '<u2'),
+    ])
+
+    def __init__(self, path):
+        self.path = path
+        # Samples by (known code, tclk, sclk) and tried value.
+        self._samples = collections.defaultdict(
+                lambda: collections.defaultdict(list))
+        # Decided values by position.
+        self._decisions = {}
+
+        data = ''
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        if not data:
+            self.f = open(path, 'wb')
+            self.f.write(self.MAGIC)
+            self.f.flush()
+            return
+        if not data.startswith(self.MAGIC):
+            raise JournalException("Not a journal: {}".format(path))
+
+        size = self.RECORD.size
+        count = (len(data) - len(self.MAGIC)) / size
+        for i in range(count):
+            self._load(self.RECORD.unpack_from(data, len(self.MAGIC) + i*size))
+        self.f = open(path, 'r+b')
+        self.f.truncate(len(self.MAGIC) + count*size)
+        self.f.seek(0, os.SEEK_END)
+
+    def _load(self, record):
+        kind, position, prefix, value, timer, tclk, sclk = record
+        code = tuple(ord(c) for c in prefix[:position])
+        if kind == self.KIND_SAMPLE:
+            self._samples[(code, tclk, sclk)][value].append(timer)
+        elif kind == self.KIND_DECISION:
+            self._decisions[position] = value
+
+    def _append(self, kind, code, value, timer=0, tclk=0, sclk=0):
+        prefix = ''.join(chr(c) for c in code)
+        self.f.write(self.RECORD.pack(kind, len(code), prefix, value, timer,
+                                      tclk, sclk))
+
+    def code(self):
+        """Returns the code bytes decided so far."""
+        code = []
+        while len(code) in self._decisions:
+            code.append(self._decisions[len(code)])
+        return code
+
+    def samples(self, code, tclk, sclk):
+        """
+        Returns recorded busy times for values of the code byte after the
+        given known code bytes, as a dict from value to list of busy times.
+        """
+        return self._samples[(tuple(code), tclk, sclk)]
+
+    def add_samples(self, code, value, timers, tclk, sclk):
+        """Records busy times of value tried after known code bytes."""
+        for timer in timers:
+            self._append(self.KIND_SAMPLE, code, value, timer, tclk, sclk)
+        self.f.flush()
+        self._samples[(tuple(code), tclk, sclk)][value].extend(timers)
+
+    def add_decision(self, code, value):
+        """Records that value was decided for the byte after code."""
+        self._append(self.KIND_DECISION, code, value)
+        self.f.flush()
+        self._decisions[len(code)] = value
+
+    def close(self):
+        self.f.close()
+
+
+def read_records(path):
+    """Returns all complete records of a journal as a NumPy record array."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(Journal.MAGIC):
+        raise JournalException("Not a journal: {}".format(path))
+    size = Journal.DTYPE.itemsize
+    count = (len(data) - len(Journal.MAGIC)) / size
+    return numpy.frombuffer(data, Journal.DTYPE, count,
+                            len(Journal.MAGIC)).view(numpy.recarray)
+
+
+class JournalSampler(object):
+    """
+    Wraps a sampler, returning samples recorded in a journal before taking
+    new ones, and recording all new samples.
+    """
+
+    def __init__(self, sampler, journal, code, tclk, sclk):
+        self.sampler = sampler
+        self.journal = journal
+        self.code = code
+        self.tclk = tclk
+        self.sclk = sclk
+        # Number of recorded samples already returned, by value.
+        self._used = collections.Counter()
+
+    def sample(self, candidates, count):
+        """Returns count busy times for every candidate value."""
+        recorded = self.journal.samples(self.code, self.tclk, self.sclk)
+        res = []
+        # Values that need new samples, by number of samples needed.
+        missing = collections.defaultdict(list)
+        for c in candidates:
+            used = self._used[c]
+            reuse = recorded[c][used:used+count]
+            self._used[c] += len(reuse)
+            res.append(list(reuse))
+            if len(reuse) < count:
+                missing[count - len(reuse)].append(c)
+
+        index = dict((c, i) for i, c in enumerate(candidates))
+        for needed, values in missing.items():
+            for c, timers in zip(values, self.sampler.sample(values, needed)):
+                self.journal.add_samples(self.code, c, timers, self.tclk,
+                                         self.sclk)
+                self._used[c] += len(timers)
+                res[index[c]].extend(timers)
+        return res
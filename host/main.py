@@ -25,55 +25,442 @@
 
 import argparse
 import logging
+import mmap
+import os
+import stat
 import sys
 
 import adapter
+import aio
+import clocks
+import devices
+import journal
+import reference
 import serialio
+import stats
+import timings
+import tracefile
+
+
+class UnlockSampler(object):
+    """Measures busy times of unlock attempts for values of one code byte."""
+
+    def __init__(self, s, code):
+        self.s = s
+        # Known code bytes before the one being sampled.
+        self.code = code
+
+    def _code(self, value):
+        # Send code right-padded with 0xDE.
+        bin_code = ''.join(chr(c) for c in self.code) + chr(value)
+        return bin_code.ljust(7, '\xDE')
+
+    def sample(self, candidates, count):
+        """Returns count busy times for every candidate value."""
+        if list(candidates) == range(256):
+            # Have the adapter try every value by itself.
+            res = self.s.sweep_unlock(self._code(0), len(self.code), count)
+        else:
+            res = [[self.s.timed_unlock(self._code(c)) for _ in range(count)]
+                   for c in candidates]
+        self._report(candidates, res)
+        return res
+
+    def _report(self, candidates, res):
+        for c, samples in zip(candidates, res):
+            if not samples:
+                logging.warning("Code {}, target never went busy".format(c))
+            logging.debug("Code {}, times {}".format(c, samples))
+
+
+class ParallelSampler(UnlockSampler):
+    """
+    Measures busy times like UnlockSampler, but on several targets with the
+    same code (on different adapters or channels of one) at once, merging
+    their samples.
+
+    Sweeps are split by rounds and single attempts are dealt out in turns,
+    so that every value gets about as many samples from every target and
+    differences between the targets don't favor any value.
+    """
+
+    def __init__(self, targets, code):
+        super(ParallelSampler, self).__init__(targets[0], code)
+        self.targets = [aio.AsyncSerialIO(s) for s in targets]
+        self.loop = aio.Loop()
+
+    def _sweep(self, target, rounds):
+        if rounds == 0:
+            raise aio.Return([[] for _ in range(256)])
+        res = yield target.sweep_unlock(self._code(0), len(self.code), rounds)
+        raise aio.Return(res)
+
+    def _unlock(self, target, values):
+        res = []
+        for value in values:
+            timer = yield target.timed_unlock(self._code(value))
+            res.append((value, timer))
+        raise aio.Return(res)
+
+    def sample(self, candidates, count):
+        """Returns count busy times for every candidate value."""
+        candidates = list(candidates)
+        n = len(self.targets)
+        if candidates == range(256):
+            rounds = [count // n + (i < count % n) for i in range(n)]
+            parts = self.loop.gather(self._sweep(t, r)
+                                     for t, r in zip(self.targets, rounds))
+            res = [sum((part[c] for part in parts), []) for c in candidates]
+        else:
+            values = [c for _ in range(count) for c in candidates]
+            parts = self.loop.gather(self._unlock(t, values[i::n])
+                                     for i, t in enumerate(self.targets))
+            times = dict((c, []) for c in candidates)
+            for part in parts:
+                for value, timer in part:
+                    times[value].append(timer)
+            res = [times[c] for c in candidates]
+        self._report(candidates, res)
+        return res
+
+
+def crack_last(s, code, hints=None):
+    """
+    Finds the last code byte by trying values until the target reports a
+    successful unlock. Values with busy times in hints (a dict from value to
+    busy times, e.g. recorded in a journal) are tried first, shortest busy
+    time first, then the others in order (so without hints, up to 256
+    attempts from 0 on). The target is reset first, as after the wrong codes
+    of the timing measurements it may not take even the correct one.
+
+    Returns:
+        Tuple of the value (None if no value unlocked the target) and the
+        number of unlock attempts made.
+    """
+    hints = hints or {}
+    order = sorted(range(256),
+                   key=lambda v: min(hints.get(v) or [float('inf')]))
+    s.adapter.reset_target()
+    attempts = 0
+    for value in order:
+        attempts += 1
+        s.unlock(''.join(chr(c) for c in code + [value]))
+        if s.unlock_status() == serialio.UNLOCK_SUCCESSFUL:
+            return value, attempts
+    return None, attempts
+
+
+def find_device(args):
+    """
+    Returns the devices.Device of the targets, selected with --device or by
+    their version.
+
+    Raises:
+        devices.DeviceException: If the device couldn't be found.
+    """
+    if args.device:
+        return devices.by_name(args.device)
+    versions = set(t.version() for t in args.targets)
+    if len(versions) > 1:
+        raise devices.DeviceException(
+            "Targets have different versions ({}).".format(
+                ', '.join(versions)))
+    return devices.by_version(versions.pop())
+
+
+def setup_clocks(args, tclks, sclk):
+    """
+    Sets the clocks of all targets: the first of tclks and serial clock
+    setting sclk, or with --tune-clocks the fastest settings that work for
+    every target, tuned on first use.
+
+    Returns:
+        Whether the clocks of all targets could be set.
+    """
+    if not args.tune_clocks:
+        for target in args.targets:
+            target.adapter.set_tclk(tclks[0])
+            target.adapter.set_sclk(sclk)
+        return True
+    cache = clocks.ClockCache(args.clock_cache)
+    for target, device in zip(args.targets, args.devices):
+        try:
+            tclk, sclk = clocks.set_clocks(target, device, tclks, cache)
+        except clocks.ClockException as e:
+            logging.fatal(str(e))
+            return False
+        logging.info("Clocks of {}: tclk {}, sclk {}.".format(device, tclk,
+                                                              sclk))
+    return True
 
 
 def crack(args, s):
-    # Run target clock at 3MHz.
-    s.adapter.set_tclk(1)
-    # Run serial clock at 1.5MHz.
-    s.adapter.set_sclk(127)
+    # Cracking doesn't need a memory map, so any target will do, with
+    # default clock settings unless its device is known.
+    tclks, sclk = devices.CRACK_TCLKS, clocks.SAFE_SCLK
+    device = None
+    try:
+        device = find_device(args)
+        tclks, sclk = device.crack_tclks, device.sclk
+    except devices.DeviceException as e:
+        if args.device:
+            logging.fatal(str(e))
+            return 1
+        logging.info("{} Using default clock settings.".format(e))
+    if not setup_clocks(args, tclks, sclk):
+        return
+    if args.engine == 'median':
+        engine = stats.MedianEngine(samples=args.samples)
+    elif args.engine == 'scan':
+        # A correct byte stands out by the device's leak, so don't take
+        # anything that stands out by less than half of it.
+        leak = device.leak_ticks(s.adapter.tclk) if device else None
+        engine = stats.ScanEngine(samples=args.samples,
+                                  threshold=args.threshold,
+                                  confidence=args.confidence,
+                                  max_samples=args.max_samples,
+                                  min_step=(leak or 0) / 2.0)
+    else:
+        engine = stats.SequentialEngine(confidence=args.confidence,
+                                        initial=args.samples,
+                                        max_samples=args.max_samples)
+
     code = []
+    crack_journal = None
+    if args.journal:
+        crack_journal = journal.Journal(args.journal)
+        code = crack_journal.code()[:7]
+        if code:
+            logging.info("Resuming with code {} from journal.".format(code))
+
+    def sampler(code):
+        if len(args.targets) > 1:
+            res = ParallelSampler(args.targets, code)
+        else:
+            res = UnlockSampler(s, code)
+        if crack_journal is not None:
+            res = journal.JournalSampler(res, crack_journal, code,
+                                         s.adapter.tclk, s.adapter.sclk)
+        return res
+
+    attempts = 0
     while len(code) != 7:
         logging.info("Cracking byte {}/7...".format(len(code)+1, 7))
-        byte_times = []
-        for try_byte in range(256):
-            samples = []
-            for _ in range(args.samples):
-                # Send code right-padded with 0xDE.
-                bin_code = ''.join(chr(c) for c in code) + chr(try_byte)
-                s.unlock(bin_code.ljust(7, '\xDE'))
-                # Measure response time.
-                samples.append(s.adapter.busy_timer())
-            # Take median time.
-            samples = sorted(samples)
-            median = samples[args.samples/2]
-            logging.debug("Code {}, times {}, median {}".format(try_byte,
-                                                                samples,
-                                                                median))
-            byte_times.append(median)
+        value = None
+        if len(code) == 6 and args.oracle:
+            hints = None
+            if crack_journal is not None:
+                hints = crack_journal.samples(code, s.adapter.tclk,
+                                              s.adapter.sclk)
+            value, tries = crack_last(s, code, hints)
+            attempts += tries
+            if value is not None:
+                logging.info("Byte 7/7 -> {} (target unlocked, {} attempts)"
+                             .format(value, tries))
+            else:
+                logging.warning("No value unlocked the target, deciding last "
+                                "byte by timing.")
+        if value is None:
+            # For every byte apart from the last one, the correct byte results
+            # in a longer busy time.
+            try:
+                decision = engine.decide(sampler(code), len(code) != 6)
+            except stats.StatsException as e:
+                logging.fatal(str(e))
+                return 1
+            attempts += decision.attempts
+            logging.info("Byte {}/7 -> {} (confidence {:.4f}, {} attempts)"
+                         .format(len(code)+1, decision.value,
+                                 decision.confidence, decision.attempts))
+            value = decision.value
+        if crack_journal is not None:
+            crack_journal.add_decision(code, value)
+        code.append(value)
+    bin_code = ''.join(chr(c) for c in code).encode('hex')
+    logging.info("Finished. Code: {}, {}".format(code, bin_code))
+    logging.info("{} unlock attempts in total.".format(attempts))
+    if crack_journal is not None:
+        crack_journal.close()
+
+
+def analyze(args, s):
+    records = journal.read_records(args.journal)
+    samples = records[records.kind == journal.Journal.KIND_SAMPLE]
+    decisions = records[records.kind == journal.Journal.KIND_DECISION]
+    estimators = args.estimator or stats.ESTIMATORS.keys()
+
+    prefixes = [tuple(p) for p in samples.prefix.tolist()]
+    groups = sorted(set(zip(samples.position.tolist(), prefixes,
+                            samples.tclk.tolist(), samples.sclk.tolist())))
+    for position, prefix, tclk, sclk in groups:
+        if args.position is not None and position+1 != args.position:
+            continue
+        code = list(prefix[:position])
+        group = samples[(samples.position == position) &
+                        (samples.prefix == prefix).all(axis=1) &
+                        (samples.tclk == tclk) & (samples.sclk == sclk)]
+        sample_set = stats.SampleSet.from_arrays(group.value, group.timer)
+        decided = decisions[(decisions.position == position) &
+                            (decisions.prefix == prefix).all(axis=1)]
+        logging.info("Byte {}/7 after {} (tclk {}, sclk {}), {} samples, "
+                     "decided {}:".format(position+1, code, tclk, sclk,
+                                          len(group),
+                                          list(decided.value) or None))
         # For every byte apart from the last one, the correct byte results in
         # a longer busy time.
-        correct = None
-        if len(code) == 6:
-            correct = byte_times.index(min(byte_times))
+        longest = position != 6
+        for name in estimators:
+            scores = stats.ESTIMATORS[name](sample_set)
+            ranking = stats.rank(scores, longest)[:args.top]
+            logging.info("  {:>10}: {}".format(name, ', '.join(
+                "{} ({:.1f})".format(c, scores[c]) for c in ranking)))
+
+
+class DumpWriter(object):
+    """
+    Writes dumped runs of pages (see devices.Device.plan) to an image file
+    that starts at the first page of the first run. The file is allocated
+    at its full size and memory mapped up front, so pages go straight to
+    their offset in any order. Pages between runs are written as blank (all
+    0xFF). Anything but a regular file (e.g. a pipe or /dev/null) can't be
+    mapped and gets the pages written in order instead, without holes.
+
+    Sparse writers don't write blank pages, leaving holes in the file that
+    read as zeroes, and write a region map of the pages that were written to
+    PATH.map instead: one line per run of pages, with its first and last
+    address in hexadecimal. Everything outside of those is blank.
+    """
+
+    def __init__(self, path, runs, sparse=False):
+        self.path = path
+        self.runs = runs
+        self.start = runs[0][0]
+        self.end = runs[-1][1]
+        self.sparse = sparse
+        # Runs of written pages as [first, last], and number of dumped and
+        # of blank pages.
+        self.regions = []
+        self.pages = 0
+        self.blank = 0
+        # Next page to write to an unmapped file.
+        self.next = self.start
+        self.image = None
+        self.f = open(path, 'wb')
+        if not stat.S_ISREG(os.fstat(self.f.fileno()).st_mode):
+            if sparse:
+                logging.warning("{} is not a regular file, writing blank "
+                                "pages to it.".format(path))
+                self.sparse = False
+            return
+        if not sparse and os.path.exists(path + '.map'):
+            # A map left by an earlier sparse dump would blank pages of this
+            # one when it's used as a reference.
+            os.remove(path + '.map')
+        size = (self.end - self.start + 1) * 256
+        self.f.close()
+        self.f = open(path, 'r+b')
+        self.f.truncate(size)
+        self.image = mmap.mmap(self.f.fileno(), size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def write(self, page, data):
+        self.pages += 1
+        if data == '\xff' * len(data):
+            self.blank += 1
+            if self.sparse:
+                return
+        if self.regions and self.regions[-1][1] == page - 1:
+            self.regions[-1][1] = page
         else:
-            correct = byte_times.index(max(byte_times))
-        logging.info("Byte {}/7 -> {}".format(len(code)+1, correct))
-        code.append(correct)
-    bin_code = ''.join(chr(c) for c in code).encode('hex')
-    logging.info("Finished. Code: {}, {}".format(code, bin_code))
+            self.regions.append([page, page])
+        if self.image is None:
+            self.f.write('\xff' * ((page - self.next) * 256))
+            self.f.write(data)
+            self.next = page + 1
+            return
+        offset = (page - self.start) * 256
+        self.image[offset:offset+256] = data
 
+    def close(self, complete=True):
+        if self.image is None:
+            self.f.close()
+            return
+        if complete and self.sparse:
+            with open(self.path + '.map', 'w') as f:
+                for first, last in self.regions:
+                    f.write("{:x}00-{:x}ff\n".format(first, last))
+        elif complete:
+            for (_, last), (first, _) in zip(self.runs, self.runs[1:]):
+                offset = (last + 1 - self.start) * 256
+                self.image[offset:(first - self.start) * 256] = (
+                    '\xff' * ((first - last - 1) * 256))
+        self.image.close()
+        self.f.close()
 
-def dump(args, s):
-    # Run target clock at 6MHz.
-    s.adapter.set_tclk(0)
-    # Run target serial clock at 1.5MHz
-    s.adapter.set_sclk(127)
 
+def dump_pages(s, writer, ref=None):
+    """
+    Coroutine writing the runs of pages of writer (a DumpWriter) from s.
+    With a reference.Reference, pages with the same check data as in the
+    reference are taken from it instead of being read.
+
+    Returns:
+        Number of pages read.
+    """
+    read = 0
+    with writer:
+        for page in run_pages(writer.runs):
+            if ref is not None:
+                check = yield s.check_page(page)
+                if check == ref.check(page):
+                    writer.write(page, ref.page(page))
+                    continue
+            data = yield s.read_page(page)
+            read += 1
+            logging.debug("Dumped {:x}00-{:x}ff to {}.".format(
+                page, page, writer.path))
+            writer.write(page, data)
+    raise aio.Return(read)
+
+
+def run_pages(runs):
+    """Yields the pages of runs of pages."""
+    for first, last in runs:
+        for page in range(first, last+1):
+            yield page
+
+
+def changed_pages(s, ref, start, end, depth):
+    """
+    Yields pages start to end (inclusive) like SerialIO.read_pages, but
+    only reads pages whose check data differs from the one in the
+    reference.Reference ref, taking the others from ref.
+    """
+    changed = set(page for page, check in s.check_pages(start, end, depth)
+                  if check != ref.check(page))
+    logging.info("{} of {} pages differ from the reference.".format(
+        len(changed), end - start + 1))
+    page = start
+    while page <= end:
+        if page not in changed:
+            yield page, ref.page(page)
+            page += 1
+            continue
+        # Read runs of changed pages with reads in flight.
+        last = page
+        while last + 1 in changed:
+            last += 1
+        for res in s.read_pages(page, last, depth=depth):
+            yield res
+        page = last + 1
+
+
+def dump(args, s):
     try:
         code = args.code.decode('hex')
     except TypeError:
@@ -83,29 +470,129 @@ def dump(args, s):
         logging.fatal("Code must be 7 bytes long.")
         return
 
-    s.unlock(code)
-    status = s.unlock_status()
-    if status != serialio.UNLOCK_SUCCESSFUL:
-        logging.fatal("Target did not unlock.")
+    try:
+        device = find_device(args)
+        runs = device.plan(args.region)
+    except devices.DeviceException as e:
+        logging.fatal(str(e))
+        return 1
+
+    if not setup_clocks(args, device.dump_tclks, device.sclk):
         return
+    for target in args.targets:
+        target.unlock(code)
+        status = target.unlock_status()
+        if status != serialio.UNLOCK_SUCCESSFUL:
+            logging.fatal("Target did not unlock.")
+            return
     logging.info("Target unlocked.")
 
-    start = 0x0e00
-    end = 0x0fff
+    ref = None
+    if args.reference:
+        try:
+            ref = reference.Reference(args.reference, runs[0][0])
+        except (IOError, reference.ReferenceException) as e:
+            logging.fatal(str(e))
+            return
+        if ref.end != runs[-1][1]:
+            logging.fatal("Reference must cover pages {:x}-{:x}.".format(
+                runs[0][0], runs[-1][1]))
+            return
+        # Targets still read every page to compute check data, only the
+        # host link is spared. That only pays off when targets share it.
+        links = [t.adapter.link for t in args.targets]
+        if any(links.count(link) < 2 for link in links):
+            logging.warning("Adapters with a single target read every page "
+                            "with --reference, which is slower than a plain "
+                            "dump.")
 
-    with open(args.output, 'w') as f:
-        logging.info("Writing pages {:x}-{:x} to {}...".format(start, end,
-                                                               args.output))
-        for page in range(start, end+1):
-            logging.debug("Dumping {:x}00-{:x}ff...".format(page, page))
-            data = s.read_page(page)
-            f.write(data)
+    for target in args.targets:
+        # Erased pages cost a byte on the host link instead of a page.
+        target.adapter.skip_blank = True
+        if args.verify:
+            target.adapter.check_data = True
+    try:
+        dump_targets(args, s, runs, ref)
+    except serialio.SerialIOException as e:
+        logging.fatal(str(e))
+        return 1
+    if args.verify:
+        logging.info("Verified, read {} corrupted pages again.".format(
+            sum(t.retried_reads for t in args.targets)))
+
+
+def dump_targets(args, s, runs, ref):
+    pages = ', '.join('{:x}-{:x}'.format(first, last) for first, last in runs)
+    if len(args.targets) > 1:
+        # Dump all targets at once, into numbered files.
+        paths = ['{}.{}'.format(args.output, i)
+                 for i in range(len(args.targets))]
+        logging.info("Writing pages {} to {}...".format(pages,
+                                                        ', '.join(paths)))
+        writers = [DumpWriter(path, runs, args.sparse) for path in paths]
+        loop = aio.Loop()
+        read = loop.gather(dump_pages(aio.AsyncSerialIO(t), writer, ref)
+                           for t, writer in zip(args.targets, writers))
+        for writer, count in zip(writers, read):
+            if ref is not None:
+                logging.info("{} of {} pages of {} differ from the "
+                             "reference.".format(count, writer.pages,
+                                                 writer.path))
+            log_blank(writer)
+        return
+
+    with DumpWriter(args.output, runs, args.sparse) as writer:
+        logging.info("Writing pages {} to {}...".format(pages, args.output))
+        for first, last in runs:
+            if ref is None:
+                run = s.read_pages(first, last, depth=args.depth)
+            else:
+                run = changed_pages(s, ref, first, last, args.depth)
+            for page, data in run:
+                logging.debug("Dumped {:x}00-{:x}ff.".format(page, page))
+                writer.write(page, data)
+    log_blank(writer)
+
+
+def log_blank(writer):
+    logging.info("{} of {} pages of {} are blank{}.".format(
+        writer.blank, writer.pages, writer.path,
+        ", see {}.map".format(writer.path) if writer.sparse else ""))
+
+
+def list_devices(args, s):
+    for device in devices.DEVICES.values():
+        logging.info("{} ({}):".format(
+            device.name, ', '.join(device.versions) or "select by name"))
+        for region in device.regions:
+            logging.info("  {}: {:x}00-{:x}ff, {}KiB blocks".format(
+                region.name, region.first, region.last,
+                region.block_size // 1024))
+
+
+def baud_rate(value):
+    """Parses a --baud-rate argument."""
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid baud rate: {!r}"
+                                         .format(value))
 
 
 parser = argparse.ArgumentParser(
         description='Renesas M16C SerialIO Programmer.')
-parser.add_argument('--port', '-p', help='Adapter serial port.',
-                    default='/dev/ttyUSB1')
+parser.add_argument('--port', '-p', help='Adapter serial port (default '
+                    '/dev/ttyUSB1). Repeat to crack or dump with several '
+                    'adapters at once, with targets that have the same code.',
+                    action='append')
+parser.add_argument('--channel', '-C', help='Adapter SIO channel of the '
+                    'target (default 0). Repeat like --port to use several '
+                    'targets on every adapter.', type=int, action='append')
+parser.add_argument('--baud-rate', '-b', help='Host link baud rate, or '
+                    '"auto" to use the fastest one that works (default '
+                    '{}).'.format(adapter.Adapter.BAUD_RATE), type=baud_rate)
 parser.add_argument('--verbose', '-v', help='Increase output verbosity.',
                     action='store_true')
 parser.add_argument('--debug-protocol', '-d', help='Log protocol bytes.',
@@ -114,20 +601,86 @@ parser.add_argument('--debug-adapter', '-D', help='Log adapter bytes.',
                     action='store_true')
 parser.add_argument('--timestamps', '-t', help='Include timestamps in log.',
                     action='store_true')
+parser.add_argument('--trace', help='Record adapter bytes to a trace file.',
+                    type=str)
+parser.add_argument('--timings', help='Log adapter request latency '
+                    'histograms at the end.', action='store_true')
+parser.add_argument('--replay', help='Answer with adapter bytes from a trace '
+                    'file instead of using the adapter.', type=str)
+parser.add_argument('--tune-clocks', help='Use the fastest target and serial '
+                    'clock settings that work, tuned on first use of every '
+                    'target and kept in the clock cache.',
+                    action='store_true')
+parser.add_argument('--clock-cache', help='File of tuned clock settings '
+                    '(default {}).'.format(clocks.DEFAULT_CACHE), type=str,
+                    default=clocks.DEFAULT_CACHE)
+parser.add_argument('--device', help='Target device (default: found by '
+                    'target version), see the devices command.', type=str)
+parser.set_defaults(hardware=True)
 subparsers = parser.add_subparsers(help='Mode of operation.')
 
 parser_crack = subparsers.add_parser('crack', help='Crack security PIN.')
-parser_crack.add_argument('--samples', help='Samples per byte.', type=int,
+parser_crack.add_argument('--samples', help='Samples per byte (initial '
+                          'samples for the sequential engine).', type=int,
                           default=3)
+parser_crack.add_argument('--engine', help='Statistics engine deciding bytes.',
+                          choices=['median', 'scan', 'sequential'],
+                          default='sequential')
+parser_crack.add_argument('--confidence', help='Confidence at which the '
+                          'sequential and scan engines stop sampling.',
+                          type=float, default=0.999)
+parser_crack.add_argument('--max-samples', help='Maximum samples per byte for '
+                          'the sequential and scan engines.', type=int,
+                          default=64)
+parser_crack.add_argument('--no-oracle', help='Decide last byte by timing '
+                          'instead of trying values until the target '
+                          'unlocks.', dest='oracle', action='store_false')
+parser_crack.add_argument('--journal', '-j', help='Journal file to record '
+                          'samples to and resume from.', type=str)
+parser_crack.add_argument('--threshold', help='Robust standard deviations by '
+                          'which a byte has to stand out for the scan engine '
+                          'to stop.', type=float, default=6.0)
 parser_crack.set_defaults(func=crack)
 
+parser_analyze = subparsers.add_parser('analyze', help='Rank PIN bytes from '
+                                       'samples recorded in a crack journal.')
+parser_analyze.add_argument('journal', help='Crack journal file.', type=str)
+parser_analyze.add_argument('--estimator', '-e', help='Estimator to rank by '
+                            '(repeatable, default all).', action='append',
+                            choices=stats.ESTIMATORS.keys())
+parser_analyze.add_argument('--position', help='Only analyze this byte '
+                            '(1-7).', type=int)
+parser_analyze.add_argument('--top', help='Number of best ranked values to '
+                            'show.', type=int, default=5)
+parser_analyze.set_defaults(func=analyze, hardware=False)
+
 parser_dump = subparsers.add_parser('dump', help='Dump flash memory.')
 parser_dump.add_argument('--output', '-o', help='Output file.', type=str,
                          required=True)
 parser_dump.add_argument('--code', '-c', help='Unlock code.', type=str,
                          required=True)
+parser_dump.add_argument('--depth', help='Page reads to keep in flight.',
+                         type=int, default=2)
+parser_dump.add_argument('--reference', '-r', help='Image that most pages '
+                         'are expected to match. Pages with the same check '
+                         'data are taken from it instead of being read. '
+                         'Targets still read every page, so this is only '
+                         'faster with several targets per adapter.',
+                         type=str)
+parser_dump.add_argument('--verify', help='Check every page against check '
+                         'data from the adapter, read corrupted pages again.',
+                         action='store_true')
+parser_dump.add_argument('--sparse', help='Leave blank (all 0xFF) pages out of '
+                         'the output file as holes, write a map of the other '
+                         'pages to OUTPUT.map.', action='store_true')
+parser_dump.add_argument('--region', help='Region of the device to dump '
+                         '(repeatable, default all).', action='append')
 parser_dump.set_defaults(func=dump)
 
+parser_devices = subparsers.add_parser('devices', help='List known devices '
+                                       'and their regions.')
+parser_devices.set_defaults(func=list_devices, hardware=False)
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -140,17 +693,75 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(level=logging.INFO, format=fmt)
 
+    if not args.hardware:
+        sys.exit(args.func(args, None) or 0)
+
+    ports = args.port or ['/dev/ttyUSB1']
+    # Several targets are driven by aio, which ReplaySerial can't stand in
+    # for.
+    if ((len(ports) > 1 or len(args.channel or []) > 1) and
+            (args.trace or args.replay)):
+        parser.error("Tracing and replaying only work with a single port "
+                     "and channel.")
+
     adapter_logger, protocol_logger = None, None
     if args.debug_adapter:
         adapter_logger = logging
     if args.debug_protocol:
         protocol_logger = logging
 
-    a = adapter.Adapter(args.port, logger=adapter_logger)
-    s = serialio.SerialIO(a, logger=protocol_logger)
-    s.adapter.connect()
-    logging.info("Connected to adapter version {}".format(s.adapter.version()))
-    s.connect()
-    logging.info("Connected to target version {}".format(s.version()))
+    tracer, device, request_timings = None, None, None
+    if args.trace:
+        tracer = tracefile.TraceWriter(args.trace)
+    if args.replay:
+        device = tracefile.ReplaySerial(args.replay)
+    if args.timings:
+        request_timings = timings.Timings()
+
+    adapters = []
+    try:
+        # Subcommands use the first target, those that can use all of them
+        # find them in args.targets.
+        args.targets = []
+        # Names of targets to keep tuned clock settings by.
+        args.devices = []
+        for port in ports:
+            a = adapter.Adapter(port, logger=adapter_logger, tracer=tracer,
+                                device=device, timings=request_timings)
+            a.connect()
+            adapters.append(a)
+            logging.info("Connected to adapter version {} on {}"
+                         .format(a.version(), port))
+            if args.baud_rate == 'auto':
+                logging.info("Host link tuned to {} baud."
+                             .format(a.tune_baud_rate()))
+            elif args.baud_rate:
+                logging.info("Host link switched to {} baud."
+                             .format(a.set_baud_rate(args.baud_rate)))
+            for channel in args.channel or [0]:
+                s = serialio.SerialIO(a.channel(channel),
+                                      logger=protocol_logger)
+                s.connect()
+                version = s.version()
+                logging.info("Connected to target version {} on channel {}"
+                             .format(version, channel))
+                args.targets.append(s)
+                args.devices.append('{}:{}:{}'.format(port, channel,
+                                                      version))
 
-    sys.exit(args.func(args, s) or 0)
+        res = args.func(args, args.targets[0])
+    finally:
+        # Leave adapters at the default baud rate for the next run.
+        for a in adapters:
+            if a.link.baud_rate == a.BAUD_RATE:
+                continue
+            try:
+                a.set_baud_rate(a.BAUD_RATE)
+            except adapter.AdapterException as e:
+                logging.warning("Could not restore baud rate: {}".format(e))
+        if tracer is not None:
+            tracer.close()
+        if request_timings is not None:
+            for line in request_timings.format():
+                logging.info(line)
+    sys.exit(res or 0)
@@ -0,0 +1,155 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Reference flash images for incremental dumps."""
+
+import array
+import os
+import struct
+import sys
+
+import adapter
+
+
+class ReferenceException(Exception):
+    pass
+
+
+class Reference(object):
+    """
+    Flash image that targets are compared against, and the check data (see
+    adapter.crc32) of each of its pages.
+
+    Check data is cached in an index file next to the image (PATH.idx): a
+    magic string, the size and modification time of the image it was
+    computed for and a little endian 32-bit word for every page. A stale
+    index is computed again and rewritten.
+
+    Sparse dumps (see main.DumpWriter) are read with their region map
+    (PATH.map), pages outside of it are blank (all 0xFF) rather than the
+    zeroes their holes read as.
+    """
+    MAGIC = 'M16CIDX\x02'
+    HEADER = struct.Struct('<Qd')
+    PAGE_SIZE = 256
+
+    def __init__(self, path, start):
+        """
+        Args:
+            path: Path of the image.
+            start: Page number of the start of the image.
+        """
+        self.path = path
+        self.start = start
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if len(self.data) % self.PAGE_SIZE:
+            raise ReferenceException("{} is not made of whole pages."
+                                     .format(path))
+        self.end = start + len(self.data) // self.PAGE_SIZE - 1
+        stat = os.stat(path)
+        mtime = stat.st_mtime
+        map_mtime = self._apply_map()
+        if map_mtime is not None:
+            mtime = max(mtime, map_mtime)
+        self._header = self.HEADER.pack(stat.st_size, mtime)
+        self.checks = self._load_index()
+        if self.checks is None:
+            self.checks = array.array('I', (
+                    adapter.crc32(self.page(p))
+                    for p in range(self.start, self.end + 1)))
+            self._save_index()
+
+    def _apply_map(self):
+        """
+        Blanks the pages outside of the region map of a sparse dump.
+
+        Returns:
+            Modification time of the map, None if there is none.
+        """
+        map_path = self.path + '.map'
+        try:
+            with open(map_path) as f:
+                lines = f.read().split()
+            mtime = os.stat(map_path).st_mtime
+        except (IOError, OSError):
+            return None
+        data = bytearray('\xff' * len(self.data))
+        for line in lines:
+            try:
+                first, last = (int(a, 16) >> 8 for a in line.split('-'))
+            except ValueError:
+                raise ReferenceException("Invalid region {} in {}.".format(
+                    line, map_path))
+            if first < self.start or last > self.end or first > last:
+                raise ReferenceException("Region {} in {} is outside of the "
+                                         "image.".format(line, map_path))
+            offset = (first - self.start) * self.PAGE_SIZE
+            end = (last - self.start + 1) * self.PAGE_SIZE
+            data[offset:end] = self.data[offset:end]
+        self.data = str(data)
+        return mtime
+
+    def _index_path(self):
+        return self.path + '.idx'
+
+    def _load_index(self):
+        """Returns check data from the index, None if it's stale."""
+        try:
+            with open(self._index_path(), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        prefix = self.MAGIC + self._header
+        if not data.startswith(prefix):
+            return None
+        checks = array.array('I')
+        checks.fromstring(data[len(prefix):])
+        if sys.byteorder != 'little':
+            checks.byteswap()
+        if len(checks) != self.end - self.start + 1:
+            return None
+        return checks
+
+    def _save_index(self):
+        checks = array.array('I', self.checks)
+        if sys.byteorder != 'little':
+            checks.byteswap()
+        # Write a new file and rename it over the old one, so that an
+        # interrupted write doesn't leave a broken index behind.
+        tmp = self._index_path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.MAGIC + self._header + checks.tostring())
+        os.rename(tmp, self._index_path())
+
+    def page(self, page):
+        """Returns the contents of a page."""
+        offset = (page - self.start) * self.PAGE_SIZE
+        return self.data[offset:offset + self.PAGE_SIZE]
+
+    def check(self, page):
+        """Returns the check data of a page."""
+        return self.checks[page - self.start]
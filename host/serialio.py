@@ -29,6 +29,8 @@ __author__ = "Serge 'q3k' Bazanski <serge@bazanski.pl>"
 
 import struct
 
+import adapter
+
 
 class SerialIOException(Exception):
     pass
@@ -42,10 +44,20 @@ class SerialIO(object):
     CMD_UNLOCK = '\xF5\xDF\xFF\x0F\x07'
     CMD_VERSION = '\xFB'
     CMD_READ = '\xFF'
+    # Times a page read is retried when it arrives corrupted.
+    READ_RETRIES = 3
 
     def __init__(self, adapter, logger=None):
+        """
+        Args:
+            adapter: adapter.Adapter handle of the target's channel.
+            logger: Logger for commands sent to and results received from
+                the target.
+        """
         self.adapter = adapter
         self.logger = logger
+        # Number of page reads retried so far.
+        self.retried_reads = 0
 
     def _log(self, msg):
         if self.logger is None:
@@ -53,10 +65,12 @@ class SerialIO(object):
         self.logger.info(msg)
 
     def _execute(self, cmd, return_bytes):
-        self._log("FPGA -> M16C {}, {}".format(
-            cmd.encode('hex'), return_bytes))
-        res = self.adapter.execute(cmd, return_bytes)
-        self._log("FPGA <- M16C {}".format(res.encode('hex')))
+        if self.logger is not None:
+            self._log("FPGA -> M16C {}, {}".format(
+                cmd.encode('hex'), return_bytes))
+        res = self.adapter.transact(cmd, return_bytes)
+        if self.logger is not None:
+            self._log("FPGA <- M16C {}".format(res.encode('hex')))
         return res
 
     def version(self):
@@ -73,11 +87,123 @@ class SerialIO(object):
     def unlock(self, code):
         self._execute(self.CMD_UNLOCK + code, 0)
 
+    def timed_unlock(self, code):
+        """Attempts to unlock, returns the busy time of the target."""
+        if self.logger is not None:
+            self._log("FPGA -> M16C {}, timed".format(
+                (self.CMD_UNLOCK + code).encode('hex')))
+        timer, _ = self.adapter.timed_transact(self.CMD_UNLOCK + code, 0)
+        if self.logger is not None:
+            self._log("FPGA <- M16C busy {}".format(timer))
+        return timer
+
+    def sweep_unlock(self, code, index, rounds):
+        """
+        Attempts to unlock with every value of one code byte.
+
+        Args:
+            code: Unlock code, the byte at index is ignored.
+            index: Index of the code byte to sweep.
+            rounds: Number of busy times to measure for every value.
+
+        Returns:
+            List of 256 lists of busy times, indexed by value of the code
+            byte. Attempts after which the target did not go busy are left
+            out.
+        """
+        template = self.CMD_UNLOCK + code
+        if self.logger is not None:
+            self._log("FPGA -> M16C {}, sweep {}, {} rounds".format(
+                template.encode('hex'), index, rounds))
+        results = self.adapter.sweep(template, len(self.CMD_UNLOCK) + index,
+                                     rounds)
+        timeout = self.adapter.SWEEP_TIMEOUT
+        return [[t for t in times if t != timeout] for times in zip(*results)]
+
     def unlock_status(self):
         status = self._execute('\x70', 2)
         return (ord(status[1]) >> 2) & 3
     
-    def read_page(self, page):
-        return self._execute(self.CMD_READ + struct.pack('<H', page), 256)
-    
+    def read_command(self, page):
+        """Returns the command reading page, its number little endian."""
+        if not 0 <= page <= 0xffff:
+            raise SerialIOException("Page {:x} is not addressable."
+                                    .format(page))
+        return self.CMD_READ + struct.pack('<H', page)
 
+    def read_page(self, page):
+        """
+        Reads a page. With check data enabled on the adapter, a read that
+        arrives corrupted is retried up to READ_RETRIES times.
+        """
+        retries = 0
+        while True:
+            try:
+                return self._execute(self.read_command(page), 256)
+            except adapter.CheckDataException:
+                retries = self.retry(page, retries)
+
+    def check_page(self, page):
+        """Returns check data of a page (see adapter.crc32)."""
+        return self.adapter.check(self.read_command(page), 256)
+
+    def check_pages(self, start, end, depth=2):
+        """
+        Gets check data of pages start to end (inclusive) like check_page,
+        keeping depth reads in flight.
+
+        Yields:
+            Tuples of page number and check data.
+        """
+        requests = ((self.read_command(page), 256)
+                    for page in range(start, end+1))
+        self._log("FPGA -> M16C check pages {:x}-{:x}, depth {}".format(
+            start, end, depth))
+        results = self.adapter.pipeline(requests, depth, check_only=True)
+        for page, check in enumerate(results, start):
+            yield page, check
+
+    def retry(self, page, retries):
+        """
+        Counts a retry of reading page after retries earlier ones, returns
+        the new number of retries.
+
+        Raises:
+            SerialIOException: If that's more than READ_RETRIES.
+        """
+        if retries == self.READ_RETRIES:
+            raise SerialIOException("Page {:x} corrupted {} times."
+                                    .format(page, retries + 1))
+        self._log("FPGA <- M16C page {:x} corrupted, retrying".format(page))
+        self.retried_reads += 1
+        return retries + 1
+
+    def read_pages(self, start, end, depth=2):
+        """
+        Reads pages start to end (inclusive), keeping depth reads in flight.
+        With check data enabled on the adapter, reading starts over from a
+        page that arrives corrupted, up to READ_RETRIES times per page.
+
+        Yields:
+            Tuples of page number and string containing the 256 page bytes.
+        """
+        retries = 0
+        while start <= end:
+            try:
+                for page, data in self._read_pages(start, end, depth):
+                    yield page, data
+                    start, retries = page + 1, 0
+            except adapter.CheckDataException:
+                retries = self.retry(start, retries)
+
+    def _read_pages(self, start, end, depth):
+        requests = ((self.read_command(page), 256)
+                    for page in range(start, end+1))
+        self._log("FPGA -> M16C read pages {:x}-{:x}, depth {}".format(
+            start, end, depth))
+        results = self.adapter.pipeline(requests, depth)
+        for page, data in enumerate(results, start):
+            if self.logger is not None:
+                self._log("FPGA <- M16C page {:x}: {}".format(
+                    page, data.encode('hex')))
+            yield page, data
@@ -0,0 +1,414 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Statistics engines deciding PIN bytes from busy time samples."""
+
+import collections
+import math
+
+import numpy
+
+
+class StatsException(Exception):
+    pass
+
+
+class Decision(object):
+    """Outcome of deciding a single PIN byte."""
+
+    def __init__(self, value, confidence, attempts):
+        # Decided byte value.
+        self.value = value
+        # Estimated probability that value is the correct byte.
+        self.confidence = confidence
+        # Number of unlock attempts made to reach the decision.
+        self.attempts = attempts
+
+
+class SampleSet(object):
+    """Busy time samples of every candidate value of a PIN byte."""
+
+    def __init__(self, candidates=256):
+        self.times = numpy.full((candidates, 16), numpy.nan)
+        self.counts = numpy.zeros(candidates, dtype=int)
+
+    @classmethod
+    def from_arrays(cls, values, timers, candidates=256):
+        """Builds a sample set from arrays of tried values and busy times."""
+        res = cls(candidates)
+        order = numpy.argsort(values, kind='mergesort')
+        values = numpy.asarray(values)[order]
+        timers = numpy.asarray(timers)[order]
+        res.counts = numpy.bincount(values, minlength=candidates)
+        starts = numpy.cumsum(res.counts) - res.counts
+        columns = numpy.arange(len(values)) - starts[values]
+        res.times = numpy.full((candidates, max(res.counts.max(), 1)),
+                               numpy.nan)
+        res.times[values, columns] = timers
+        return res
+
+    def add(self, candidate, samples):
+        """Appends samples of a candidate value."""
+        n = self.counts[candidate]
+        end = n + len(samples)
+        if end > self.times.shape[1]:
+            grow = max(end, 2 * self.times.shape[1]) - self.times.shape[1]
+            pad = numpy.full((self.times.shape[0], grow), numpy.nan)
+            self.times = numpy.hstack((self.times, pad))
+        self.times[candidate, n:end] = samples
+        self.counts[candidate] = end
+
+    def total(self):
+        """Returns the number of samples taken."""
+        return int(self.counts.sum())
+
+    def medians(self):
+        """Returns the median of every candidate, NaN if not sampled."""
+        return _nanreduce(numpy.nanmedian, self.times, self.counts)
+
+    def means(self):
+        """Returns the mean of every candidate, NaN if not sampled."""
+        return _nanreduce(numpy.nanmean, self.times, self.counts)
+
+    def variances(self):
+        """Returns the sample variance of every candidate, NaN if it has less
+        than two samples."""
+        res = numpy.full(self.times.shape[0], numpy.nan)
+        valid = self.counts > 1
+        if valid.any():
+            res[valid] = numpy.nanvar(self.times[valid], axis=1, ddof=1)
+        return res
+
+    def pooled_variance(self):
+        """Returns the sample variance around the mean of every candidate,
+        pooled over all candidates, 0 if no candidate has two samples."""
+        means = numpy.nan_to_num(self.means())
+        deviations = numpy.nansum((self.times - means[:, None]) ** 2)
+        dof = numpy.maximum(self.counts - 1, 0).sum()
+        return deviations / dof if dof else 0.0
+
+
+def _nanreduce(f, times, counts):
+    res = numpy.full(times.shape[0], numpy.nan)
+    valid = counts > 0
+    if valid.any():
+        res[valid] = f(times[valid], axis=1)
+    return res
+
+
+def _draw(sampler, samples, candidates, count):
+    """Samples every candidate count times, adds results to samples."""
+    candidates = [int(c) for c in candidates]
+    for c, times in zip(candidates, sampler.sample(candidates, count)):
+        samples.add(c, times)
+
+
+def _require_samples(samples):
+    """Raises StatsException if no candidate was sampled at all."""
+    if not samples.total():
+        raise StatsException("No busy time samples, the target never went "
+                             "busy.")
+
+
+# Complementary error function applied to every element of an array.
+_erfc = numpy.vectorize(math.erfc, otypes=[float])
+
+
+def _upper_tail(z):
+    """Returns P(Z > z) of the standard normal distribution for every
+    element of z."""
+    return 0.5 * _erfc(numpy.asarray(z) / math.sqrt(2))
+
+
+def _scores(values, longest):
+    """Flips values so that the correct byte always has the highest score."""
+    return values if longest else -values
+
+
+def _confidence(samples, longest, winner, min_variance, pooled=False):
+    """
+    Estimates the probability that winner is the correct candidate, by
+    bounding the chance of any other sampled candidate actually being better
+    with a normal approximation of the difference of means. With pooled, the
+    variance is pooled over all candidates, for when most of them only have
+    a few samples.
+    """
+    scores = _scores(samples.means(), longest)
+    if pooled:
+        variances = numpy.full(len(scores), max(samples.pooled_variance(),
+                                                min_variance))
+    else:
+        variances = numpy.fmax(numpy.nan_to_num(samples.variances()),
+                               min_variance)
+    errors = variances / numpy.maximum(samples.counts, 1)
+    others = (samples.counts > 0)
+    others[winner] = False
+    if not others.any():
+        return 0.0
+    z = (scores[winner] - scores[others]) / numpy.sqrt(errors[winner] +
+                                                       errors[others])
+    return max(0.0, 1.0 - float(_upper_tail(z).sum()))
+
+
+def trimmed_means(samples, proportion=0.1):
+    """Returns the mean of every candidate after cutting off proportion of
+    its samples at both ends."""
+    # NaNs sort last, so the valid samples of every row come first.
+    times = numpy.sort(samples.times, axis=1)
+    cut = numpy.floor(samples.counts * proportion).astype(int)
+    columns = numpy.arange(times.shape[1])
+    keep = ((columns >= cut[:, None]) &
+            (columns < (samples.counts - cut)[:, None]))
+    kept = keep.sum(axis=1)
+    sums = numpy.where(keep, times, 0).sum(axis=1)
+    res = numpy.full(times.shape[0], numpy.nan)
+    res[kept > 0] = sums[kept > 0] / kept[kept > 0]
+    return res
+
+
+def percentiles(samples, percentile=10):
+    """Returns a low percentile of every candidate, which ignores busy times
+    lengthened by noise."""
+    return _nanreduce(lambda a, axis: numpy.nanpercentile(a, percentile,
+                                                          axis=axis),
+                      samples.times, samples.counts)
+
+
+def t_statistics(samples):
+    """Returns the t statistic of every candidate against the samples of all
+    other candidates. The variance is pooled over all candidates, as the
+    noise on busy times doesn't depend on the value tried."""
+    counts = samples.counts.astype(float)
+    sums = numpy.nansum(samples.times, axis=1)
+    means = sums / numpy.maximum(counts, 1)
+    variance = max(samples.pooled_variance(), 1.0)
+
+    rest_counts = counts.sum() - counts
+    rest_means = (sums.sum() - sums) / numpy.maximum(rest_counts, 1)
+    t = (means - rest_means) / numpy.sqrt(
+        variance * (1 / numpy.maximum(counts, 1) +
+                    1 / numpy.maximum(rest_counts, 1)))
+    t[counts == 0] = numpy.nan
+    return t
+
+
+# Estimators for offline analysis, returning a score per candidate from
+# which the correct one is the highest (or lowest).
+ESTIMATORS = collections.OrderedDict([
+    ('median', lambda samples: samples.medians()),
+    ('mean', lambda samples: samples.means()),
+    ('trimmed', trimmed_means),
+    ('percentile', percentiles),
+    ('ttest', t_statistics),
+])
+
+
+def rank(scores, longest):
+    """Returns candidates ordered from most to least likely correct."""
+    scores = _scores(numpy.asarray(scores, dtype=float), longest)
+    # Unsampled candidates go last.
+    keys = numpy.where(numpy.isnan(scores), numpy.inf, -scores)
+    return [int(c) for c in numpy.argsort(keys, kind='mergesort')]
+
+
+class MedianEngine(object):
+    """
+    Takes a fixed number of samples of every candidate and picks the one
+    with the highest (or lowest) median.
+    """
+
+    def __init__(self, samples=3, min_variance=1.0):
+        self.samples = samples
+        self.min_variance = min_variance
+
+    def decide(self, sampler, longest):
+        """
+        Decides a PIN byte.
+
+        Args:
+            sampler: Object with a sample(candidates, count) method returning
+                a list of busy time lists, one per candidate.
+            longest: Whether the correct byte has the longest (or shortest)
+                busy time.
+
+        Returns:
+            Decision.
+
+        Raises:
+            StatsException: If no candidate could be sampled.
+        """
+        samples = SampleSet()
+        _draw(sampler, samples, range(256), self.samples)
+        _require_samples(samples)
+        scores = _scores(samples.medians(), longest)
+        winner = int(numpy.nanargmax(scores))
+        confidence = _confidence(samples, longest, winner, self.min_variance)
+        return Decision(winner, confidence, samples.total())
+
+
+class SequentialEngine(object):
+    """
+    Successive elimination: samples all candidates a few times, then keeps
+    sampling only the candidates that cannot yet be ruled out as the best
+    one, until a single candidate is left with the requested confidence or
+    the sample budget is spent.
+    """
+
+    def __init__(self, confidence=0.999, initial=3, batch=2, max_samples=64,
+                 min_variance=1.0):
+        self.confidence = confidence
+        self.initial = initial
+        self.batch = batch
+        self.max_samples = max_samples
+        # Busy times are integer timer ticks and often repeat exactly, so
+        # never trust a variance below quantization noise.
+        self.min_variance = min_variance
+
+    def decide(self, sampler, longest):
+        """Decides a PIN byte, see MedianEngine.decide."""
+        samples = SampleSet()
+        active = numpy.arange(256)
+        _draw(sampler, samples, active, self.initial)
+        _require_samples(samples)
+
+        while True:
+            active = active[samples.counts[active] > 0]
+            scores = _scores(samples.means(), longest)
+            leader = active[numpy.argmax(scores[active])]
+            if len(active) == 1:
+                break
+
+            # Eliminate candidates that are worse than the leader with
+            # significance corrected for the number of comparisons.
+            variances = numpy.fmax(numpy.nan_to_num(samples.variances()),
+                                   self.min_variance)
+            errors = variances / numpy.maximum(samples.counts, 1)
+            z = (scores[leader] - scores[active]) / numpy.sqrt(
+                errors[leader] + errors[active])
+            alpha = (1.0 - self.confidence) / (len(active) - 1)
+            keep = _upper_tail(z) >= alpha
+            keep[active == leader] = True
+            active = active[keep]
+            if len(active) == 1:
+                break
+            if samples.counts[active].min() >= self.max_samples:
+                break
+
+            _draw(sampler, samples, active, self.batch)
+
+        winner = int(leader)
+        confidence = _confidence(samples, longest, winner, self.min_variance)
+        return Decision(winner, confidence, samples.total())
+
+
+class ScanEngine(object):
+    """
+    Early exit scan: samples candidates one after another until one stands
+    out from the running baseline of all candidates sampled so far by more
+    than threshold robust standard deviations (and at least min_step, e.g.
+    half of the busy time leak expected of the device), and keeps doing so
+    when resampled. Then confirms the best few candidates sampled so far by
+    resampling them, and stops if the best one reaches the requested
+    confidence, or else goes on scanning. If no candidate gets there,
+    confirms the best few of all of them.
+    """
+
+    def __init__(self, samples=3, calibration=16, threshold=6.0, confirm=5,
+                 finalists=8, confidence=0.999, max_samples=64,
+                 min_variance=1.0, min_step=0.0):
+        self.samples = samples
+        # Number of candidates sampled before looking for outliers.
+        self.calibration = calibration
+        self.threshold = threshold
+        # Number of additional samples taken of an outlier to confirm it,
+        # and of every finalist per confirmation round.
+        self.confirm = confirm
+        # Number of candidates resampled per confirmation round.
+        self.finalists = finalists
+        self.confidence = confidence
+        self.max_samples = max_samples
+        self.min_variance = min_variance
+        self.min_step = min_step
+
+    def _outlier(self, samples, longest, candidate):
+        """Checks whether candidate stands out from all other candidates."""
+        scores = _scores(samples.medians(), longest)
+        others = (samples.counts > 0)
+        others[candidate] = False
+        if not others.any():
+            return False
+        baseline = numpy.median(scores[others])
+        mad = numpy.median(numpy.abs(scores[others] - baseline))
+        sigma = max(1.4826 * mad, math.sqrt(self.min_variance))
+        return scores[candidate] > baseline + max(self.threshold * sigma,
+                                                  self.min_step)
+
+    def _confirm(self, sampler, samples, longest):
+        """
+        Resamples the candidates least ruled out as the best one, until the
+        best one reaches the requested confidence or all of them have
+        max_samples.
+
+        Returns:
+            Tuple of the best candidate and its confidence.
+        """
+        _require_samples(samples)
+        while True:
+            scores = _scores(samples.means(), longest)
+            leader = int(numpy.nanargmax(scores))
+            confidence = _confidence(samples, longest, leader,
+                                     self.min_variance, pooled=True)
+            if confidence >= self.confidence:
+                return leader, confidence
+            # Rank by how far every candidate is behind the leader, in
+            # standard errors, so that candidates with few samples get
+            # resampled before they can be ruled out.
+            variance = max(samples.pooled_variance(), self.min_variance)
+            counts = numpy.maximum(samples.counts, 1)
+            z = (scores - scores[leader]) / numpy.sqrt(
+                variance / counts + variance / counts[leader])
+            finalists = rank(z, True)[:self.finalists]
+            if samples.counts[finalists].min() >= self.max_samples:
+                return leader, confidence
+            _draw(sampler, samples, finalists, self.confirm)
+
+    def decide(self, sampler, longest):
+        """Decides a PIN byte, see MedianEngine.decide."""
+        samples = SampleSet()
+        _draw(sampler, samples, range(self.calibration), self.samples)
+        for candidate in range(256):
+            if candidate >= self.calibration:
+                _draw(sampler, samples, [candidate], self.samples)
+            if not self._outlier(samples, longest, candidate):
+                continue
+            _draw(sampler, samples, [candidate], self.confirm)
+            if not self._outlier(samples, longest, candidate):
+                continue
+            winner, confidence = self._confirm(sampler, samples, longest)
+            if confidence >= self.confidence:
+                return Decision(winner, confidence, samples.total())
+        winner, confidence = self._confirm(sampler, samples, longest)
+        return Decision(winner, confidence, samples.total())
@@ -0,0 +1,104 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Latency histograms of adapter requests."""
+
+import collections
+import time
+
+
+try:
+    clock = time.monotonic
+except AttributeError:
+    # Python 2 has no monotonic clock.
+    clock = time.time
+
+
+class Histogram(object):
+    """
+    Counts durations in power of two buckets of microseconds: bucket 0 holds
+    durations under 1us, bucket n durations from 2**(n-1) to 2**n us. The
+    last bucket also holds everything longer.
+    """
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+
+    def add(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.longest:
+            self.longest = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Returns the upper bound in seconds of the bucket that holds the p-th
+        percentile.
+        """
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return (1 << bucket) / 1000000.0
+        return 0.0
+
+
+class Timings(object):
+    """Latency histograms by name (request opcode or request phase)."""
+
+    def __init__(self):
+        self.histograms = collections.OrderedDict()
+
+    def add(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def format(self):
+        """Returns lines of a table of all histograms."""
+        res = ['{:>20} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+            'request', 'count', 'mean', 'p50 <', 'p99 <', 'max')]
+        for name, h in self.histograms.items():
+            res.append('{:>20} {:>8} {:>8.0f}us {:>8.0f}us {:>8.0f}us '
+                       '{:>8.0f}us'.format(name, h.count, h.mean() * 1e6,
+                                           h.percentile(50) * 1e6,
+                                           h.percentile(99) * 1e6,
+                                           h.longest * 1e6))
+            buckets = ['{}us: {}'.format(1 << b, c)
+                       for b, c in enumerate(h.counts) if c]
+            res.append('{:>20} {}'.format('<', ', '.join(buckets)))
+        return res
@@ -0,0 +1,176 @@
+# Copyright (c) 2017, Serge 'q3k' Bazanski <serge@bazanski.pl>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Binary traces of the host link, and replaying them.
+
+Print a trace recorded with main.py --trace:
+
+    $ python2 tracefile.py trace.bin
+"""
+
+import argparse
+import struct
+import sys
+import time
+
+
+class TraceException(Exception):
+    pass
+
+
+# Frame directions.
+HOST_TO_ADAPTER = 'w'
+ADAPTER_TO_HOST = 'r'
+
+
+class TraceWriter(object):
+    """
+    Records raw bytes sent to and received from the adapter.
+
+    The file is a magic string followed by frames, each a header (time in
+    seconds since the epoch, direction and data length) followed by the
+    data.
+    """
+    MAGIC = 'M16CTRC\x01'
+    HEADER = struct.Struct('<dcI')
+
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(self.MAGIC)
+
+    def frame(self, direction, data):
+        self.f.write(self.HEADER.pack(time.time(), direction, len(data)))
+        self.f.write(data)
+
+    def close(self):
+        self.f.close()
+
+
+def read_frames(path):
+    """
+    Reads a trace.
+
+    Yields:
+        Tuples of time, direction and data of every frame. A partial frame
+        at the end (from an interrupted run) is dropped.
+    """
+    header = TraceWriter.HEADER
+    with open(path, 'rb') as f:
+        if f.read(len(TraceWriter.MAGIC)) != TraceWriter.MAGIC:
+            raise TraceException("{} is not a trace.".format(path))
+        while True:
+            raw = f.read(header.size)
+            if len(raw) != header.size:
+                return
+            timestamp, direction, length = header.unpack(raw)
+            data = f.read(length)
+            if len(data) != length:
+                return
+            yield timestamp, direction, data
+
+
+class ReplaySerial(object):
+    """
+    Stands in for the adapter serial port, answering with the bytes of a
+    trace.
+
+    Whatever the host writes has to match what was written when the trace
+    was recorded, so that the host code takes the same path as it did back
+    then. Reads return what was read back then, short reads included.
+    """
+
+    def __init__(self, path):
+        self.frames = [(d, data) for _, d, data in read_frames(path)]
+        self.index = 0
+        # Bytes of the current frame already consumed.
+        self.offset = 0
+        self.timeout = None
+
+    def _frame(self, direction, data):
+        if self.index == len(self.frames):
+            raise TraceException("Host did {!r} {!r} after end of trace."
+                                 .format(direction, data))
+        frame_direction, frame_data = self.frames[self.index]
+        if frame_direction != direction:
+            raise TraceException("Host did {!r} {!r}, trace has {!r} {!r} at "
+                                 "frame {}.".format(direction, data,
+                                                    frame_direction,
+                                                    frame_data, self.index))
+        return frame_data
+
+    def _advance(self, count, length):
+        self.offset += count
+        if self.offset == length:
+            self.index += 1
+            self.offset = 0
+
+    def write(self, data):
+        written = 0
+        while written < len(data):
+            frame = self._frame(HOST_TO_ADAPTER, data[written:])
+            chunk = frame[self.offset:self.offset+len(data)-written]
+            if data[written:written+len(chunk)] != chunk:
+                raise TraceException("Host wrote {!r}, trace has {!r} at "
+                                     "frame {}.".format(data[written:], chunk,
+                                                        self.index))
+            self._advance(len(chunk), len(frame))
+            written += len(chunk)
+        return written
+
+    def read(self, size):
+        # A read ends where it ended when recording, timeouts included.
+        frame = self._frame(ADAPTER_TO_HOST, size)
+        chunk = frame[self.offset:self.offset+size]
+        self._advance(len(chunk), len(frame))
+        return chunk
+
+    # Breaks and dropped input aren't recorded, the bytes around them are.
+
+    def send_break(self, duration=0.25):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+
+parser = argparse.ArgumentParser(description='Print a host link trace.')
+parser.add_argument('trace', help='Trace file.', type=str)
+
+
+def main():
+    args = parser.parse_args()
+    start = None
+    for timestamp, direction, data in read_frames(args.trace):
+        if start is None:
+            start = timestamp
+        arrow = '->' if direction == HOST_TO_ADAPTER else '<-'
+        print '{:12.6f} Host {} FPGA {}'.format(timestamp - start, arrow,
+                                               data.encode('hex'))
+
+
+if __name__ == '__main__':
+    sys.exit(main() or 0)